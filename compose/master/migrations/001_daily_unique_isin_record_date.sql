@@ -0,0 +1,45 @@
+-- Adds a unique (isin, record_date) key to the daily tables.
+-- Duplicated rows left by reruns are removed first, keeping the most recently inserted one.
+-- Run once against an existing tse_market database:
+--   mysql -u master -p tse_market < 001_daily_unique_isin_record_date.sql
+Use tse_market;
+
+CREATE INDEX ix_daily_trade_candle_isin_record_date ON daily_trade_candle (isin, record_date);
+DELETE older FROM daily_trade_candle older
+INNER JOIN daily_trade_candle newer
+	ON older.isin = newer.isin
+	AND older.record_date = newer.record_date
+	AND older.daily_trade_candle_id < newer.daily_trade_candle_id;
+ALTER TABLE daily_trade_candle
+	ADD CONSTRAINT uq_daily_trade_candle_isin_record_date UNIQUE (isin, record_date),
+	DROP INDEX ix_daily_trade_candle_isin_record_date;
+
+CREATE INDEX ix_daily_client_type_isin_record_date ON daily_client_type (isin, record_date);
+DELETE older FROM daily_client_type older
+INNER JOIN daily_client_type newer
+	ON older.isin = newer.isin
+	AND older.record_date = newer.record_date
+	AND older.daily_client_type_id < newer.daily_client_type_id;
+ALTER TABLE daily_client_type
+	ADD CONSTRAINT uq_daily_client_type_isin_record_date UNIQUE (isin, record_date),
+	DROP INDEX ix_daily_client_type_isin_record_date;
+
+CREATE INDEX ix_daily_instrument_detail_isin_record_date ON daily_instrument_detail (isin, record_date);
+DELETE older FROM daily_instrument_detail older
+INNER JOIN daily_instrument_detail newer
+	ON older.isin = newer.isin
+	AND older.record_date = newer.record_date
+	AND older.daily_instrument_detail_id < newer.daily_instrument_detail_id;
+ALTER TABLE daily_instrument_detail
+	ADD CONSTRAINT uq_daily_instrument_detail_isin_record_date UNIQUE (isin, record_date),
+	DROP INDEX ix_daily_instrument_detail_isin_record_date;
+
+CREATE INDEX ix_daily_index_value_isin_record_date ON daily_index_value (isin, record_date);
+DELETE older FROM daily_index_value older
+INNER JOIN daily_index_value newer
+	ON older.isin = newer.isin
+	AND older.record_date = newer.record_date
+	AND older.daily_index_value_id < newer.daily_index_value_id;
+ALTER TABLE daily_index_value
+	ADD CONSTRAINT uq_daily_index_value_isin_record_date UNIQUE (isin, record_date),
+	DROP INDEX ix_daily_index_value_isin_record_date;
@@ -0,0 +1,26 @@
+-- Creates the data_watermark table and seeds it from the existing history,
+-- so that the catchers no longer need GROUP BY max(record_date) queries on startup.
+-- Run once against an existing tse_market database, after 001:
+--   mysql -u master -p tse_market < 002_data_watermark.sql
+Use tse_market;
+
+CREATE TABLE IF NOT EXISTS data_watermark(
+	isin NCHAR(12) NOT NULL,
+	dataset NVARCHAR(32) NOT NULL,
+	last_record_date DATE NULL,
+	last_fetch_at DATETIME NULL,
+	last_status NVARCHAR(16) NULL,
+	CONSTRAINT pk_data_watermark PRIMARY KEY (dataset, isin)
+);
+
+INSERT INTO data_watermark (isin, dataset, last_record_date)
+SELECT isin, 'trade', MAX(record_date) FROM daily_trade_candle GROUP BY isin
+ON DUPLICATE KEY UPDATE last_record_date = GREATEST(COALESCE(data_watermark.last_record_date, VALUES(last_record_date)), VALUES(last_record_date));
+
+INSERT INTO data_watermark (isin, dataset, last_record_date)
+SELECT isin, 'client_type', MAX(record_date) FROM daily_client_type GROUP BY isin
+ON DUPLICATE KEY UPDATE last_record_date = GREATEST(COALESCE(data_watermark.last_record_date, VALUES(last_record_date)), VALUES(last_record_date));
+
+INSERT INTO data_watermark (isin, dataset, last_record_date)
+SELECT isin, 'index', MAX(record_date) FROM daily_index_value GROUP BY isin
+ON DUPLICATE KEY UPDATE last_record_date = GREATEST(COALESCE(data_watermark.last_record_date, VALUES(last_record_date)), VALUES(last_record_date));
@@ -0,0 +1,11 @@
+-- Creates the table holding the content hash of the last processed TSE client lists.
+-- Run once against an existing tse_market database:
+--   mysql -u master -p tse_market < 003_snapshot_fingerprint.sql
+Use tse_market;
+
+CREATE TABLE IF NOT EXISTS snapshot_fingerprint(
+	snapshot_key NVARCHAR(64) NOT NULL,
+	fingerprint NCHAR(64) NOT NULL,
+	updated_at DATETIME NOT NULL,
+	CONSTRAINT pk_snapshot_fingerprint PRIMARY KEY (snapshot_key)
+);
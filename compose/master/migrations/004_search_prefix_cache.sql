@@ -0,0 +1,12 @@
+-- Creates the table memoising the instrument searches of the prefix crawler.
+-- Run once against an existing tse_market database:
+--   mysql -u master -p tse_market < 004_search_prefix_cache.sql
+Use tse_market;
+
+CREATE TABLE IF NOT EXISTS search_prefix_cache(
+	prefix NVARCHAR(32) NOT NULL,
+	result_count INT NOT NULL,
+	results TEXT NOT NULL,
+	searched_at DATETIME NOT NULL,
+	CONSTRAINT pk_search_prefix_cache PRIMARY KEY (prefix)
+);
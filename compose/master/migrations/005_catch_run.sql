@@ -0,0 +1,25 @@
+-- Creates the checkpoint tables of resumable catcher runs.
+-- Run once against an existing tse_market database:
+--   mysql -u master -p tse_market < 005_catch_run.sql
+Use tse_market;
+
+CREATE TABLE IF NOT EXISTS catch_run(
+	catch_run_id INT NOT NULL AUTO_INCREMENT,
+	worker NVARCHAR(64) NOT NULL,
+	parent_run_id INT NULL,
+	started_at DATETIME NOT NULL,
+	finished_at DATETIME NULL,
+	status NVARCHAR(16) NOT NULL,
+	CONSTRAINT pk_catch_run PRIMARY KEY (catch_run_id),
+	CONSTRAINT fk_catch_run_parent FOREIGN KEY (parent_run_id) REFERENCES catch_run(catch_run_id)
+);
+
+CREATE TABLE IF NOT EXISTS catch_run_item(
+	catch_run_id INT NOT NULL,
+	dataset NVARCHAR(32) NOT NULL,
+	isin NCHAR(12) NOT NULL,
+	status NVARCHAR(16) NOT NULL,
+	committed_at DATETIME NULL,
+	CONSTRAINT pk_catch_run_item PRIMARY KEY (catch_run_id, dataset, isin),
+	CONSTRAINT fk_catch_run_item_catch_run FOREIGN KEY (catch_run_id) REFERENCES catch_run(catch_run_id)
+);
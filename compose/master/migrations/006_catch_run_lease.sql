@@ -0,0 +1,9 @@
+-- Adds the lease and the owner of catcher runs, so that a live run is never resumed twice.
+-- Run once against a tse_market database migrated with 005_catch_run.sql:
+--   mysql -u master -p tse_market < 006_catch_run_lease.sql
+Use tse_market;
+
+ALTER TABLE catch_run
+	ADD COLUMN heartbeat_at DATETIME NULL AFTER started_at,
+	ADD COLUMN owner_host NVARCHAR(64) NULL AFTER heartbeat_at,
+	ADD COLUMN owner_process NCHAR(32) NULL AFTER owner_host;
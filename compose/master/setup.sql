@@ -89,6 +89,7 @@ CREATE TABLE daily_trade_candle(
 	trade_volume BIGINT NOT NULL,
 	trade_value BIGINT NOT NULL,
 	CONSTRAINT pk_daily_trade_candle PRIMARY KEY (daily_trade_candle_id),
+	CONSTRAINT uq_daily_trade_candle_isin_record_date UNIQUE (isin, record_date),
 	CONSTRAINT fk_daily_trade_candle_instrument_identification FOREIGN KEY (isin) REFERENCES instrument_identification(Isin)
 );
 
@@ -109,6 +110,7 @@ CREATE TABLE daily_client_type(
 	natural_sell_volume BIGINT NOT NULL,
 	legal_sell_volume BIGINT NOT NULL,
 	CONSTRAINT pk_daily_client_type PRIMARY KEY (daily_client_type_id),
+	CONSTRAINT uq_daily_client_type_isin_record_date UNIQUE (isin, record_date),
 	CONSTRAINT fk_daily_client_type_instrument_identification FOREIGN KEY (isin) REFERENCES instrument_identification(isin)
 );
 
@@ -121,6 +123,7 @@ CREATE TABLE daily_instrument_detail(
 	max_price_threshold BIGINT,
 	min_price_threshold BIGINT,
 	CONSTRAINT pk_daily_instrument_detail PRIMARY KEY (daily_instrument_detail_id),
+	CONSTRAINT uq_daily_instrument_detail_isin_record_date UNIQUE (isin, record_date),
 	CONSTRAINT fk_daily_instrument_detail_instrument_identification FOREIGN KEY (isin) REFERENCES instrument_identification(isin)
 );
 
@@ -144,5 +147,54 @@ CREATE TABLE daily_index_value(
 	max_value FLOAT NOT NULL,
 	min_value FLOAT NOT NULL,
 	CONSTRAINT pk_daily_index_value PRIMARY KEY (daily_index_value_id),
+	CONSTRAINT uq_daily_index_value_isin_record_date UNIQUE (isin, record_date),
 	CONSTRAINT fk_daily_index_value_index_identification FOREIGN KEY (isin) REFERENCES index_identification(isin)
 );
+
+CREATE TABLE data_watermark(
+	isin NCHAR(12) NOT NULL,
+	dataset NVARCHAR(32) NOT NULL,
+	last_record_date DATE NULL,
+	last_fetch_at DATETIME NULL,
+	last_status NVARCHAR(16) NULL,
+	CONSTRAINT pk_data_watermark PRIMARY KEY (dataset, isin)
+);
+
+CREATE TABLE snapshot_fingerprint(
+	snapshot_key NVARCHAR(64) NOT NULL,
+	fingerprint NCHAR(64) NOT NULL,
+	updated_at DATETIME NOT NULL,
+	CONSTRAINT pk_snapshot_fingerprint PRIMARY KEY (snapshot_key)
+);
+
+CREATE TABLE search_prefix_cache(
+	prefix NVARCHAR(32) NOT NULL,
+	result_count INT NOT NULL,
+	results TEXT NOT NULL,
+	searched_at DATETIME NOT NULL,
+	CONSTRAINT pk_search_prefix_cache PRIMARY KEY (prefix)
+);
+
+CREATE TABLE catch_run(
+	catch_run_id INT NOT NULL AUTO_INCREMENT,
+	worker NVARCHAR(64) NOT NULL,
+	parent_run_id INT NULL,
+	started_at DATETIME NOT NULL,
+	heartbeat_at DATETIME NULL,
+	owner_host NVARCHAR(64) NULL,
+	owner_process NCHAR(32) NULL,
+	finished_at DATETIME NULL,
+	status NVARCHAR(16) NOT NULL,
+	CONSTRAINT pk_catch_run PRIMARY KEY (catch_run_id),
+	CONSTRAINT fk_catch_run_parent FOREIGN KEY (parent_run_id) REFERENCES catch_run(catch_run_id)
+);
+
+CREATE TABLE catch_run_item(
+	catch_run_id INT NOT NULL,
+	dataset NVARCHAR(32) NOT NULL,
+	isin NCHAR(12) NOT NULL,
+	status NVARCHAR(16) NOT NULL,
+	committed_at DATETIME NULL,
+	CONSTRAINT pk_catch_run_item PRIMARY KEY (catch_run_id, dataset, isin),
+	CONSTRAINT fk_catch_run_item_catch_run FOREIGN KEY (catch_run_id) REFERENCES catch_run(catch_run_id)
+);
@@ -0,0 +1,4 @@
+"""
+This package holds the benchmarks of the lines, \
+run against local stand-ins of TSETMC and the database
+"""
@@ -0,0 +1,371 @@
+"""
+A local stand-in for TSETMC, serving synthetic payloads, or recorded ones \
+from a response archive, with configurable latency, errors and rate limits.
+Run as python -m benchmarks.fake_tsetmc to serve it on its own.
+"""
+from __future__ import annotations
+import argparse
+import asyncio
+import json
+import random
+import time
+from dataclasses import dataclass
+from datetime import date, timedelta
+from pathlib import Path
+from typing import Any, Callable
+from urllib.parse import unquote
+import httpx
+from utils.latency import endpoint_name
+from utils.response_archive import archive_key, read_records
+
+_SEARCH_LIMIT: int = 50
+_TICKER_LETTERS: str = "abcdefghijklmnopqrstuvwxyz"
+_TRADED_DAY_RATIO: float = 0.9
+
+
+@dataclass
+class FakeTsetmcSettings:
+    """
+    Configuration of a FakeTsetmcServer. Every response takes latency \
+    seconds, give or take jitter, fails with a 500 at error_rate, \
+    and gets a 429 beyond rate_limit requests per second, if set. \
+    Recorded responses from the archive at recorded are served \
+    where there are any, synthetic ones otherwise.
+    """
+
+    # pylint: disable=too-many-instance-attributes
+    # Each attribute is a knob of the synthetic market or of the server
+    instruments: int = 200
+    indices: int = 10
+    days: int = 250
+    latency: float = 0.05
+    jitter: float = 0.02
+    error_rate: float = 0.0
+    rate_limit: float = 0.0
+    recorded: str = None
+    seed: int = 0
+
+
+@dataclass
+class ServerStatistics:
+    """Requests served by a FakeTsetmcServer and how"""
+
+    requests: int = 0
+    errors: int = 0
+    rate_limited: int = 0
+    recorded: int = 0
+    not_found: int = 0
+
+
+def instrument_code(index: int) -> str:
+    """Gets the TSETMC code of a synthetic instrument"""
+    return str(1_000_000 + index)
+
+
+def instrument_isin(index: int) -> str:
+    """Gets the ISIN of a synthetic instrument"""
+    return f"IRO1B{index:06d}1"
+
+
+def instrument_ticker(index: int) -> str:
+    """Gets the ticker of a synthetic instrument, four letters spelling its index"""
+    letters = []
+    for _ in range(4):
+        index, letter = divmod(index, len(_TICKER_LETTERS))
+        letters.append(_TICKER_LETTERS[letter])
+    return "".join(reversed(letters))
+
+
+def index_code(index: int) -> str:
+    """Gets the TSETMC code of a synthetic market index"""
+    return str(2_000_000 + index)
+
+
+def index_isin(index: int) -> str:
+    """Gets the ISIN of a synthetic market index"""
+    return f"IRX6XB{index:06d}"
+
+
+class FakeTsetmcServer:
+    """Serves the TSETMC API paths used by the lines over HTTP/1.1 keep-alive"""
+
+    # pylint: disable=too-many-instance-attributes
+    # The attributes hold the server's state and the simulated conditions
+
+    def __init__(self, settings: FakeTsetmcSettings = None):
+        self.settings: FakeTsetmcSettings = (
+            settings if settings else FakeTsetmcSettings()
+        )
+        self.statistics: ServerStatistics = ServerStatistics()
+        self.__random: random.Random = random.Random(self.settings.seed)
+        # TSETMC does not order the search results by ticker, so a saturated
+        # search samples every branch below its prefix rather than the first
+        self.__tickers: list[tuple[str, int]] = [
+            (instrument_ticker(x), x) for x in range(self.settings.instruments)
+        ]
+        random.Random(self.settings.seed).shuffle(self.__tickers)
+        self.__recorded: dict[tuple[str, str], str] = self.__load_recorded()
+        self.__tokens: float = self.settings.rate_limit
+        self.__refilled_at: float = time.monotonic()
+        self.__server: asyncio.Server = None
+        self.__connections: set[asyncio.StreamWriter] = set()
+        self.__handlers: dict[str, Callable[[list[str]], dict[str, Any]]] = {
+            "GetClosingPriceDailyList": self.__closing_price_daily_list,
+            "GetClientTypeHistory": self.__client_type_history,
+            "GetIndexB2History": self.__index_history,
+            "GetInstrumentSearch": self.__instrument_search,
+            "GetInstrumentIdentity": self.__instrument_identity,
+        }
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> int:
+        """Starts serving and returns the port"""
+        self.__server = await asyncio.start_server(self.__serve, host, port)
+        return self.__server.sockets[0].getsockname()[1]
+
+    async def close(self) -> None:
+        """Stops serving, closing the connections left open"""
+        self.__server.close()
+        for writer in self.__connections:
+            writer.close()
+        await self.__server.wait_closed()
+
+    async def __serve(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        """Serves the requests of a connection until it is closed"""
+        self.__connections.add(writer)
+        try:
+            while request_line := await reader.readline():
+                method, target, _ = request_line.decode().split(" ", 2)
+                headers = {}
+                while (line := await reader.readline()) not in (b"\r\n", b""):
+                    name, _, value = line.decode().partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                await reader.readexactly(int(headers.get("content-length", 0)))
+                status, body = await self.__respond(method, target)
+                writer.write(
+                    f"HTTP/1.1 {status} {httpx.codes.get_reason_phrase(status)}\r\n\
+Content-Type: application/json; charset=utf-8\r\n\
+Content-Length: {len(body)}\r\n\r\n".encode()
+                    + body
+                )
+                await writer.drain()
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            self.__connections.discard(writer)
+            writer.close()
+
+    async def __respond(self, method: str, target: str) -> tuple[int, bytes]:
+        """Gets the status and the body of the response to a request"""
+        self.statistics.requests += 1
+        if self.settings.rate_limit and not self.__take_token():
+            self.statistics.rate_limited += 1
+            return 429, b"{}"
+        await asyncio.sleep(
+            max(
+                0.0,
+                self.settings.latency
+                + self.__random.uniform(-self.settings.jitter, self.settings.jitter),
+            )
+        )
+        if self.__random.random() < self.settings.error_rate:
+            self.statistics.errors += 1
+            return 500, b"{}"
+        url = httpx.URL(target)
+        endpoint = endpoint_name(url)
+        recorded = self.__recorded.get((endpoint, archive_key(url)))
+        if recorded is not None:
+            self.statistics.recorded += 1
+            return 200, recorded.encode()
+        segments = [unquote(x) for x in url.path.split("/")]
+        handler = self.__handlers.get(endpoint)
+        if method != "GET" or not handler or len(segments) < 5:
+            self.statistics.not_found += 1
+            return 404, b"{}"
+        return 200, json.dumps(handler(segments[4:])).encode()
+
+    def payload(self, endpoint: str, parameters: list[str]) -> dict[str, Any]:
+        """Builds the synthetic payload of an endpoint without serving it"""
+        return self.__handlers[endpoint](parameters)
+
+    def __take_token(self) -> bool:
+        """Takes a token of the rate limit, if one is left"""
+        now = time.monotonic()
+        self.__tokens = min(
+            self.settings.rate_limit,
+            self.__tokens + (now - self.__refilled_at) * self.settings.rate_limit,
+        )
+        self.__refilled_at = now
+        if self.__tokens < 1:
+            return False
+        self.__tokens -= 1
+        return True
+
+    def __load_recorded(self) -> dict[tuple[str, str], str]:
+        """Loads the latest archived response of every path"""
+        recorded: dict[tuple[str, str], str] = {}
+        if not self.settings.recorded:
+            return recorded
+        for segment in sorted(Path(self.settings.recorded).glob("*/*.ndjson.gz")):
+            endpoint = segment.name.removesuffix(".ndjson.gz")
+            for record in read_records(segment):
+                recorded[(endpoint, record["key"])] = record["body"]
+        return recorded
+
+    def __days(self, tsetmc_code: str) -> list[tuple[date, bool]]:
+        """Gets the days of the history of an instrument, newest first"""
+        days_random = random.Random(f"{self.settings.seed}/{tsetmc_code}")
+        today = date.today()
+        return [
+            (today - timedelta(days=x), days_random.random() < _TRADED_DAY_RATIO)
+            for x in range(1, self.settings.days + 1)
+        ]
+
+    def __closing_price_daily_list(self, parameters: list[str]) -> dict[str, Any]:
+        """Serves api/ClosingPrice/GetClosingPriceDailyList/<tsetmc_code>/0"""
+        price = 1000 + int(parameters[0]) % 9000
+        return {
+            "closingPriceDaily": [
+                {
+                    "dEven": int(f"{x:%Y%m%d}"),
+                    "hEven": 122959,
+                    "priceYesterday": price,
+                    "priceFirst": price + 10,
+                    "pDrCotVal": price + 20,
+                    "pClosing": price + 15,
+                    "priceMax": price + 30,
+                    "priceMin": price - 30,
+                    "zTotTran": 120 if traded else 0,
+                    "qTotCap": price * 100_000 if traded else 0,
+                    "qTotTran5J": 100_000 if traded else 0,
+                }
+                for x, traded in self.__days(parameters[0])
+            ]
+        }
+
+    def __client_type_history(self, parameters: list[str]) -> dict[str, Any]:
+        """Serves api/ClientType/GetClientTypeHistory/<tsetmc_code>"""
+        return {
+            "clientType": [
+                {"recDate": int(f"{x:%Y%m%d}")}
+                | {
+                    f"{side}_{client}_{field}": value if traded else 0
+                    for side in ("buy", "sell")
+                    for client, share in (("N", 3), ("I", 1))
+                    for field, value in (
+                        ("Count", 30 * share),
+                        ("Volume", 25_000 * share),
+                        ("Value", 25_000_000 * share),
+                    )
+                }
+                for x, traded in self.__days(parameters[0])
+            ]
+        }
+
+    def __index_history(self, parameters: list[str]) -> dict[str, Any]:
+        """Serves api/Index/GetIndexB2History/<tsetmc_code>"""
+        return {
+            "indexB2": [
+                {
+                    "dEven": int(f"{x:%Y%m%d}"),
+                    "xNivInuPbMresIbs": 1_000_000.0,
+                    "xNivInuPhMresIbs": 1_020_000.0,
+                    "xNivInuClMresIbs": 1_010_000.0,
+                }
+                for x, _ in self.__days(parameters[0])
+            ]
+        }
+
+    def __instrument_search(self, parameters: list[str]) -> dict[str, Any]:
+        """Serves api/Instrument/GetInstrumentSearch/<search_value>"""
+        return {
+            "instrumentSearch": [
+                {
+                    "lVal18AFC": ticker,
+                    "lVal30": f"{ticker} name",
+                    "insCode": instrument_code(x),
+                    "flowTitle": "bourse",
+                    "lastDate": 1,
+                }
+                for ticker, x in self.__tickers
+                if ticker.startswith(parameters[0])
+            ][:_SEARCH_LIMIT]
+        }
+
+    def __instrument_identity(self, parameters: list[str]) -> dict[str, Any]:
+        """Serves api/Instrument/GetInstrumentIdentity/<tsetmc_code>"""
+        index = int(parameters[0]) - 1_000_000
+        sector = 10 + index % 20
+        return {
+            "instrumentIdentity": {
+                "cgrValCotTitle": "bourse",
+                "cComVal": "1",
+                "sector": {"cSecVal": f"{sector} ", "lSecVal": f"sector {sector}"},
+                "subSector": {
+                    "cSoSecVal": f"{sector}{index % 5:02d}",
+                    "lSoSecVal": f"sub sector {sector}{index % 5:02d}",
+                },
+                "yVal": "300",
+                "instrumentID": instrument_isin(index),
+                "lVal18AFC": instrument_ticker(index),
+                "lVal30": f"{instrument_ticker(index)} name",
+                "lVal18": instrument_ticker(index).upper(),
+            }
+        }
+
+
+async def serve_forever(settings: FakeTsetmcSettings, port: int) -> None:
+    """Serves a FakeTsetmcServer on a port until cancelled"""
+    server = FakeTsetmcServer(settings)
+    port = await server.start(port=port)
+    print(f"Serving a fake TSETMC on http://127.0.0.1:{port}/")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await server.close()
+
+
+def add_settings_arguments(parser: argparse.ArgumentParser) -> None:
+    """Adds the options of a FakeTsetmcSettings to a parser"""
+    defaults = FakeTsetmcSettings()
+    for name in (
+        "instruments",
+        "indices",
+        "days",
+        "latency",
+        "jitter",
+        "error_rate",
+        "rate_limit",
+        "recorded",
+    ):
+        default = getattr(defaults, name)
+        parser.add_argument(
+            f"--{name.replace('_', '-')}",
+            type=type(default) if default is not None else str,
+            default=default,
+        )
+
+
+def settings_from_arguments(arguments: argparse.Namespace) -> FakeTsetmcSettings:
+    """Creates a FakeTsetmcSettings of parsed options"""
+    return FakeTsetmcSettings(
+        instruments=arguments.instruments,
+        indices=arguments.indices,
+        days=arguments.days,
+        latency=arguments.latency,
+        jitter=arguments.jitter,
+        error_rate=arguments.error_rate,
+        rate_limit=arguments.rate_limit,
+        recorded=arguments.recorded,
+    )
+
+
+if __name__ == "__main__":
+    _parser = argparse.ArgumentParser(description=__doc__)
+    _parser.add_argument("--port", type=int, default=8080)
+    add_settings_arguments(_parser)
+    _arguments = _parser.parse_args()
+    asyncio.run(serve_forever(settings_from_arguments(_arguments), _arguments.port))
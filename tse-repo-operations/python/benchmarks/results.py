@@ -0,0 +1,105 @@
+"""
+Saving benchmark results as JSON and comparing them to a baseline, \
+so that a regression fails the benchmark run
+"""
+from __future__ import annotations
+import argparse
+import json
+import subprocess
+from datetime import datetime
+from pathlib import Path
+
+Results = dict[str, dict[str, float]]
+
+
+def _commit() -> str:
+    """Gets the commit the benchmarks run on, if in a git checkout"""
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            check=True,
+            text=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def save_results(path: str, results: Results) -> None:
+    """Writes the metrics of every benchmark to a JSON file"""
+    Path(path).write_text(
+        json.dumps(
+            {
+                "created_at": datetime.now().isoformat(timespec="seconds"),
+                "commit": _commit(),
+                "results": results,
+            },
+            indent=2,
+        ),
+        encoding="utf-8",
+    )
+
+
+def load_results(path: str) -> Results:
+    """Reads the metrics of every benchmark from a JSON file"""
+    return json.loads(Path(path).read_text(encoding="utf-8"))["results"]
+
+
+def compare_to_baseline(
+    results: Results,
+    baseline: Results,
+    higher_is_better: set[str],
+    lower_is_better: set[str],
+    tolerance: float,
+) -> list[str]:
+    """
+    Describes every metric worse than its baseline by more than tolerance, \
+    a share of the baseline value
+    """
+    regressions = []
+    for benchmark, metrics in results.items():
+        for metric, value in metrics.items():
+            base = baseline.get(benchmark, {}).get(metric)
+            if not base:
+                continue
+            change = (value - base) / base
+            if (metric in higher_is_better and change < -tolerance) or (
+                metric in lower_is_better and change > tolerance
+            ):
+                regressions.append(
+                    f"{benchmark} {metric}: {value:.4g} against {base:.4g} ({change:+.0%})"
+                )
+    return regressions
+
+
+def add_results_arguments(parser: argparse.ArgumentParser) -> None:
+    """Adds the options of saving and comparing the results to a parser"""
+    parser.add_argument("--output", default=None)
+    parser.add_argument("--baseline", default=None)
+    parser.add_argument("--tolerance", type=float, default=0.2)
+
+
+def finish(
+    results: Results,
+    arguments: argparse.Namespace,
+    higher_is_better: set[str],
+    lower_is_better: set[str],
+) -> int:
+    """
+    Saves the results to the output and prints their regressions \
+    against the baseline, if given, returning the exit code of the run
+    """
+    if arguments.output:
+        save_results(arguments.output, results)
+    if not arguments.baseline:
+        return 0
+    regressions = compare_to_baseline(
+        results=results,
+        baseline=load_results(arguments.baseline),
+        higher_is_better=higher_is_better,
+        lower_is_better=lower_is_better,
+        tolerance=arguments.tolerance,
+    )
+    for regression in regressions:
+        print(f"Regression: {regression}")
+    return 1 if regressions else 0
@@ -0,0 +1,380 @@
+"""
+Times the CPU hot paths of the backfills on synthetic rows: \
+parsing the TSETMC payloads, converting them to database rows, \
+filtering the new days, and the strategies of writing the rows \
+to an in-process SQLite database.
+Run as python -m benchmarks.run_hot_paths from the python folder.
+"""
+from __future__ import annotations
+import argparse
+import gc
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from dataclasses import asdict, dataclass
+from datetime import date, timedelta
+from itertools import groupby
+from operator import itemgetter
+from typing import Any, Callable
+import sqlalchemy
+from tse_utils import tsetmc
+from tse_utils_db.batch import ColumnBatch
+from tse_utils_db.bulk import bulk_insert
+from tse_utils_db.checkpoint import CheckpointStatus, checkpoint_row, start_run
+from tse_utils_db.watermark import WatermarkStatus, watermark_row
+from tse_utils_db.tse_market import get_tse_market_session, DailyTradeCandle
+from utils.daily_datasets import CLIENT_TYPE_DATASET, Dataset, TRADE_DATASET
+from lines.tsetmc_daily_historical_catcher import (
+    TsetmcDailyHistoricalCatcher,
+    _Shift,
+    _WriteUnit,
+)
+from lines.tsetmc_index_historical_catcher import TsetmcIndexHistoricalCatcher
+from .fake_tsetmc import (
+    FakeTsetmcServer,
+    FakeTsetmcSettings,
+    instrument_code,
+    instrument_isin,
+)
+from .results import add_results_arguments, finish
+from .run_lines import prepare_database
+
+HIGHER_IS_BETTER: set[str] = {"rows_per_second"}
+LOWER_IS_BETTER: set[str] = {"best", "held_mb"}
+
+_GROUPS: list[str] = ["trade", "client_type", "index", "write"]
+
+
+@dataclass
+class HotPathMetrics:
+    """
+    Timing of a hot path over its repeats, on rows rows each, \
+    and the memory held by what it returns, if measured
+    """
+
+    rows: int = 0
+    best: float = 0.0
+    mean: float = 0.0
+    rows_per_second: float = 0.0
+    held_mb: float = 0.0
+
+
+@dataclass
+class _ParsedDataset:
+    """Describes how the payloads of a dataset are parsed, converted and filtered"""
+
+    endpoint: str
+    parameters: Callable[[str], list[str]]
+    payload: str
+    parse: Callable[[dict], Any]
+    to_db: Callable[..., dict[str, Any]]
+    filter_new_data: Callable[[str, list[Any], date], list[dict[str, Any]]]
+
+
+def _daily_filter(
+    dataset: Dataset,
+) -> Callable[[str, list[Any], date], list[dict[str, Any]]]:
+    """Binds the new data filter of the daily catcher to a dataset"""
+    return lambda isin, tsetmc_data, previous_last_record_date: (
+        _Shift.filter_new_data(
+            dataset=dataset,
+            isin=isin,
+            tsetmc_data=tsetmc_data,
+            previous_last_record_date=previous_last_record_date,
+        )
+    )
+
+
+_DATASETS: dict[str, _ParsedDataset] = {
+    "trade": _ParsedDataset(
+        endpoint="GetClosingPriceDailyList",
+        parameters=lambda tsetmc_code: [tsetmc_code, "0"],
+        payload="closingPriceDaily",
+        parse=lambda x: tsetmc.ClosingPriceDaily(tsetmc_raw_data=x),
+        to_db=TRADE_DATASET.to_db,
+        filter_new_data=_daily_filter(TRADE_DATASET),
+    ),
+    "client_type": _ParsedDataset(
+        endpoint="GetClientTypeHistory",
+        parameters=lambda tsetmc_code: [tsetmc_code],
+        payload="clientType",
+        parse=lambda x: tsetmc.ClientTypeDaily(tsetmc_raw_data=x),
+        to_db=CLIENT_TYPE_DATASET.to_db,
+        filter_new_data=_daily_filter(CLIENT_TYPE_DATASET),
+    ),
+    "index": _ParsedDataset(
+        endpoint="GetIndexB2History",
+        parameters=lambda tsetmc_code: [tsetmc_code],
+        payload="indexB2",
+        parse=lambda x: tsetmc.IndexDaily(tsetmc_raw_data=x),
+        to_db=TsetmcIndexHistoricalCatcher.index_data_tsetmc_to_db,
+        filter_new_data=lambda isin, tsetmc_data, previous_last_record_date: (
+            TsetmcIndexHistoricalCatcher.filter_new_data(
+                isin=isin,
+                tsetmc_data=tsetmc_data,
+                previous_last_record_date=previous_last_record_date,
+            )
+        ),
+    ),
+}
+
+
+def _measure(
+    run: Callable[[], Any],
+    rows: int,
+    repeat: int,
+    setup: Callable[[], None] = None,
+    held: bool = False,
+) -> tuple[HotPathMetrics, Any]:
+    """
+    Times run repeat times with the garbage collector off, \
+    calling setup untimed before each, and returns the metrics \
+    along with what the last run returned. With held, the memory \
+    of what it returns is traced on one more, untimed run.
+    """
+    timings = []
+    result = None
+    for _ in range(repeat):
+        if setup:
+            setup()
+        result = None
+        gc.collect()
+        gc.disable()
+        try:
+            started = time.perf_counter()
+            result = run()
+            timings.append(time.perf_counter() - started)
+        finally:
+            gc.enable()
+    best = min(timings)
+    metrics = HotPathMetrics(
+        rows=rows,
+        best=best,
+        mean=sum(timings) / len(timings),
+        rows_per_second=rows / best if best else 0.0,
+    )
+    if held:
+        result = None
+        gc.collect()
+        tracemalloc.start()
+        try:
+            result = run()
+            metrics.held_mb = tracemalloc.get_traced_memory()[0] / (1 << 20)
+        finally:
+            tracemalloc.stop()
+    return metrics, result
+
+
+def _time_dataset(
+    name: str, settings: FakeTsetmcSettings, repeat: int
+) -> dict[str, HotPathMetrics]:
+    """
+    Times parsing, converting and filtering the synthetic history \
+    of every instrument for a dataset, filtering at half the history
+    """
+    dataset = _DATASETS[name]
+    server = FakeTsetmcServer(settings)
+    payloads = {
+        instrument_isin(x): server.payload(
+            dataset.endpoint, dataset.parameters(instrument_code(x))
+        )[dataset.payload]
+        for x in range(settings.instruments)
+    }
+    rows = sum(len(x) for x in payloads.values())
+    results = {}
+    results[f"{name}_parse"], parsed = _measure(
+        lambda: {
+            isin: [dataset.parse(x) for x in raw] for isin, raw in payloads.items()
+        },
+        rows=rows,
+        repeat=repeat,
+    )
+    del payloads
+    results[f"{name}_convert"], _ = _measure(
+        lambda: [
+            dataset.to_db(isin=isin, tsetmc_data=x)
+            for isin, data in parsed.items()
+            for x in data
+        ],
+        rows=rows,
+        repeat=repeat,
+        held=True,
+    )
+    previous_last_record_date = date.today() - timedelta(days=settings.days // 2)
+    results[f"{name}_filter"], _ = _measure(
+        lambda: [
+            dataset.filter_new_data(isin, data, previous_last_record_date)
+            for isin, data in parsed.items()
+        ],
+        rows=rows,
+        repeat=repeat,
+        held=True,
+    )
+    return results
+
+
+def _write_orm_add_all(rows: list[dict[str, Any]]) -> None:
+    """Writes the rows as ORM objects through the unit of work"""
+    with get_tse_market_session() as session:
+        session.add_all(DailyTradeCandle(**x) for x in rows)
+        session.commit()
+
+
+def _write_core_executemany(rows: list[dict[str, Any]]) -> None:
+    """Writes the rows in a single Core executemany"""
+    with get_tse_market_session() as session:
+        session.connection().execute(
+            sqlalchemy.insert(DailyTradeCandle.__table__), rows
+        )
+        session.commit()
+
+
+def _write_bulk_insert(rows: list[dict[str, Any]], upsert: bool) -> None:
+    """Writes the rows in batches of the line's size through bulk_insert"""
+    # pylint: disable=protected-access
+    # The line's own batch size is the one being measured
+    with get_tse_market_session() as session:
+        bulk_insert(
+            session=session,
+            model=DailyTradeCandle,
+            rows=rows,
+            batch_size=_Shift._insert_batch_size,
+            upsert=upsert,
+        )
+        session.commit()
+
+
+def _prepare_line_write(
+    settings: FakeTsetmcSettings, rows: list[dict[str, Any]]
+) -> tuple[_Shift, list[_WriteUnit]]:
+    """
+    Recreates the database and starts a checkpointed run, then groups \
+    the rows into the units of the daily catcher's background writer, \
+    one per instrument with its watermark and its checkpoint
+    """
+    # pylint: disable=protected-access
+    # The line's own logger and worker name are the ones it writes with
+    prepare_database(settings)
+    shift = _Shift(
+        job_description=TsetmcDailyHistoricalCatcher.default_job_description(),
+        logger=TsetmcDailyHistoricalCatcher._LOGGER,
+        traffic_controller=None,
+        http_clients=None,
+    )
+    dataset = TRADE_DATASET.watermark
+    isins = list(dict.fromkeys(x["isin"] for x in rows))
+    with get_tse_market_session() as session:
+        shift.run_id = start_run(
+            session, shift._worker, [(dataset.value, x) for x in isins]
+        )
+        session.commit()
+    units = []
+    for isin, instrument_rows in groupby(rows, itemgetter("isin")):
+        new_data = ColumnBatch(DailyTradeCandle, instrument_rows)
+        units.append(
+            _WriteUnit(
+                model=DailyTradeCandle,
+                rows=new_data,
+                watermark=watermark_row(
+                    isin=isin,
+                    dataset=dataset,
+                    last_record_date=max(new_data.column("record_date")),
+                    status=WatermarkStatus.SUCCESS,
+                ),
+                checkpoint=checkpoint_row(
+                    run_id=shift.run_id,
+                    dataset=dataset.value,
+                    isin=isin,
+                    status=CheckpointStatus.SUCCEEDED,
+                ),
+            )
+        )
+    return shift, units
+
+
+def _time_writes(
+    settings: FakeTsetmcSettings, rows_count: int, repeat: int
+) -> dict[str, HotPathMetrics]:
+    """
+    Times the write strategies on the first rows_count trade rows, \
+    each into empty tables of a fresh SQLite database
+    """
+    server = FakeTsetmcServer(settings)
+    dataset = _DATASETS["trade"]
+    rows = []
+    for x in range(settings.instruments):
+        rows.extend(
+            dataset.to_db(isin=instrument_isin(x), tsetmc_data=y)
+            for y in map(
+                dataset.parse,
+                server.payload(
+                    dataset.endpoint, dataset.parameters(instrument_code(x))
+                )[dataset.payload],
+            )
+        )
+        if len(rows) >= rows_count:
+            break
+    rows = rows[:rows_count]
+    os.environ["TSE_MARKET_SQLITE_PATH"] = os.path.join(
+        tempfile.mkdtemp(), "hot_paths.sqlite"
+    )
+    strategies: dict[str, Callable[[list[dict[str, Any]]], None]] = {
+        "write_orm_add_all": _write_orm_add_all,
+        "write_core_executemany": _write_core_executemany,
+        "write_bulk_insert": lambda x: _write_bulk_insert(x, upsert=False),
+        "write_bulk_upsert": lambda x: _write_bulk_insert(x, upsert=True),
+    }
+    results = {
+        name: _measure(
+            lambda write=write: write(rows),
+            rows=len(rows),
+            repeat=repeat,
+            setup=lambda: prepare_database(settings),
+        )[0]
+        for name, write in strategies.items()
+    }
+    prepared: dict[str, tuple[_Shift, list[_WriteUnit]]] = {}
+    results["write_line"], _ = _measure(
+        lambda: prepared["line"][0].insert_data_batch_in_database(prepared["line"][1]),
+        rows=len(rows),
+        repeat=repeat,
+        setup=lambda: prepared.update(line=_prepare_line_write(settings, rows)),
+    )
+    return results
+
+
+def main() -> int:
+    """Runs the benchmarks and returns the exit code"""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--groups", nargs="+", choices=_GROUPS, default=_GROUPS)
+    parser.add_argument("--instruments", type=int, default=4000)
+    parser.add_argument("--days", type=int, default=250)
+    parser.add_argument("--write-rows", type=int, default=200_000)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    add_results_arguments(parser)
+    arguments = parser.parse_args()
+
+    settings = FakeTsetmcSettings(
+        instruments=arguments.instruments, days=arguments.days, seed=arguments.seed
+    )
+    measured: dict[str, HotPathMetrics] = {}
+    for group in arguments.groups:
+        if group == "write":
+            measured |= _time_writes(settings, arguments.write_rows, arguments.repeat)
+        else:
+            measured |= _time_dataset(group, settings, arguments.repeat)
+    for name, metrics in measured.items():
+        print(
+            f"{name}: {metrics.rows} rows, best {metrics.best:.3f}s, \
+mean {metrics.mean:.3f}s ({metrics.rows_per_second:.0f} rows/s), \
+held {metrics.held_mb:.1f} MB"
+        )
+    results = {x: asdict(y) for x, y in measured.items()}
+    return finish(results, arguments, HIGHER_IS_BETTER, LOWER_IS_BETTER)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,314 @@
+"""
+Runs lines end to end against a FakeTsetmcServer and a stand-in database, \
+reporting their throughput, peak RSS and database time.
+Every line runs in a process of its own, on a fresh SQLite database \
+unless --mysql is given, in which case the MYSQL_* environment is used \
+and its tables are dropped and recreated, so it must be a disposable one.
+Run as python -m benchmarks.run_lines from the python folder.
+"""
+from __future__ import annotations
+import argparse
+import asyncio
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import asdict, dataclass
+from typing import Callable
+import sqlalchemy
+from sqlalchemy.engine import Engine
+from telegram_task import line
+from tse_utils_db.engine import dispose_tse_market_async_engine, get_tse_market_engine
+from tse_utils_db.tse_market import (
+    get_tse_market_session,
+    Base,
+    DailyClientType,
+    DailyIndexValue,
+    DailyTradeCandle,
+    IndexIdentification,
+    InstrumentIdentification,
+    InstrumentType,
+)
+from utils.http_clients import HttpClientRegistry, HttpClientSettings
+from utils.traffic import (
+    TSETMC_HOST,
+    TrafficControlled,
+    TrafficController,
+    TrafficPolicy,
+)
+from lines.tsetmc_daily_historical_catcher import TsetmcDailyHistoricalCatcher
+from lines.tsetmc_index_historical_catcher import TsetmcIndexHistoricalCatcher
+from lines.tsetmc_instrument_searcher import TsetmcInstrumentSearcher
+from .fake_tsetmc import (
+    FakeTsetmcServer,
+    FakeTsetmcSettings,
+    ServerStatistics,
+    add_settings_arguments,
+    index_code,
+    index_isin,
+    instrument_code,
+    instrument_isin,
+    instrument_ticker,
+    settings_from_arguments,
+)
+from .results import add_results_arguments, finish
+
+_INSTRUMENT_TYPE_ID: int = 300
+_INDEX_TYPE_ID: int = 6
+
+HIGHER_IS_BETTER: set[str] = {"items_per_second", "rows_per_second"}
+LOWER_IS_BETTER: set[str] = {"elapsed", "peak_rss_mb", "db_time"}
+
+
+@dataclass
+class LineMetrics:
+    """What a line did in a benchmark run and what it took"""
+
+    # pylint: disable=too-many-instance-attributes
+    # Each attribute is a reported metric
+    items: int = 0
+    elapsed: float = 0.0
+    items_per_second: float = 0.0
+    rows: int = 0
+    rows_per_second: float = 0.0
+    requests: int = 0
+    peak_rss_mb: float = 0.0
+    db_time: float = 0.0
+    db_statements: int = 0
+
+
+@dataclass
+class _LineBenchmark:
+    """Describes how a line is set up for a benchmark run and what it processes"""
+
+    worker: type[TrafficControlled]
+    job_description: Callable[[line.JobDescription], None]
+    seeded: Callable[[int], bool]
+    items: Callable[[FakeTsetmcSettings, int], int]
+    tables: list[type[Base]]
+
+
+def _daily_job_description(job_description: line.JobDescription) -> None:
+    """Catches every instrument in a single unresumable run"""
+    job_description.force_full = True
+    job_description.resume = False
+
+
+def _searcher_job_description(job_description: line.JobDescription) -> None:
+    """Crawls the tickers as the scheduled search does"""
+    job_description.crawl = True
+
+
+_LINES: dict[str, _LineBenchmark] = {
+    "daily": _LineBenchmark(
+        worker=TsetmcDailyHistoricalCatcher,
+        job_description=_daily_job_description,
+        seeded=lambda x: True,
+        items=lambda settings, rows: settings.instruments,
+        tables=[DailyTradeCandle, DailyClientType],
+    ),
+    "index": _LineBenchmark(
+        worker=TsetmcIndexHistoricalCatcher,
+        job_description=lambda job_description: None,
+        seeded=lambda x: False,
+        items=lambda settings, rows: settings.indices,
+        tables=[DailyIndexValue],
+    ),
+    "searcher": _LineBenchmark(
+        worker=TsetmcInstrumentSearcher,
+        job_description=_searcher_job_description,
+        seeded=lambda x: x % 2 == 0,
+        items=lambda settings, rows: rows,
+        tables=[InstrumentIdentification],
+    ),
+}
+
+
+def prepare_database(
+    settings: FakeTsetmcSettings, seeded: Callable[[int], bool] = lambda x: True
+) -> None:
+    """
+    Recreates the tables and seeds the identifications of the indices \
+    and of the synthetic instruments that are seeded
+    """
+    engine = get_tse_market_engine()
+    Base.metadata.drop_all(engine)
+    Base.metadata.create_all(engine)
+    with get_tse_market_session() as session:
+        session.add_all(
+            [
+                InstrumentType(instrument_type_id=_INSTRUMENT_TYPE_ID, title="stock"),
+                InstrumentType(instrument_type_id=_INDEX_TYPE_ID, title="index"),
+            ]
+        )
+        session.flush()
+        session.add_all(
+            InstrumentIdentification(
+                isin=instrument_isin(x),
+                tsetmc_code=instrument_code(x),
+                ticker=instrument_ticker(x),
+                instrument_type_id=_INSTRUMENT_TYPE_ID,
+            )
+            for x in range(settings.instruments)
+            if seeded(x)
+        )
+        for x in range(settings.indices):
+            session.add_all(
+                [
+                    InstrumentIdentification(
+                        isin=index_isin(x),
+                        tsetmc_code=index_code(x),
+                        ticker=f"index{x}",
+                        instrument_type_id=_INDEX_TYPE_ID,
+                    ),
+                    IndexIdentification(isin=index_isin(x), tsetmc_code=index_code(x)),
+                ]
+            )
+        session.commit()
+
+
+def _count_rows(tables: list[type[Base]]) -> int:
+    """Counts the rows of the tables a line writes to"""
+    # pylint: disable=not-callable
+    # sqlalchemy.func members are generated dynamically
+    with get_tse_market_session() as session:
+        return sum(
+            session.scalar(sqlalchemy.select(sqlalchemy.func.count()).select_from(x))
+            for x in tables
+        )
+
+
+def _time_database(metrics: LineMetrics) -> None:
+    """Accumulates the time spent executing statements on any engine"""
+
+    @sqlalchemy.event.listens_for(Engine, "before_cursor_execute")
+    def before_cursor_execute(connection, *_):
+        connection.info.setdefault("benchmark_started_at", []).append(
+            time.perf_counter()
+        )
+
+    @sqlalchemy.event.listens_for(Engine, "after_cursor_execute")
+    def after_cursor_execute(connection, *_):
+        metrics.db_time += (
+            time.perf_counter() - connection.info["benchmark_started_at"].pop()
+        )
+        metrics.db_statements += 1
+
+
+async def _perform_line(
+    benchmark: _LineBenchmark, arguments: argparse.Namespace, port: int
+) -> LineMetrics:
+    """Performs a line once against the stand-ins and measures it"""
+    metrics = LineMetrics()
+    traffic_controller = TrafficController(
+        TrafficPolicy(initial_rate=arguments.initial_rate, max_rate=arguments.max_rate)
+    )
+    http_clients = HttpClientRegistry(
+        HttpClientSettings(base_urls={TSETMC_HOST: f"http://127.0.0.1:{port}/"})
+    )
+    worker = benchmark.worker(
+        traffic_controller=traffic_controller, http_clients=http_clients
+    )
+    job_description = worker.default_job_description()
+    benchmark.job_description(job_description)
+    if arguments.concurrency and hasattr(job_description, "concurrency"):
+        job_description.concurrency = arguments.concurrency
+    rows_before = _count_rows(benchmark.tables)
+    _time_database(metrics)
+    started = time.perf_counter()
+    try:
+        await worker.perform_task(job_description)
+    finally:
+        metrics.elapsed = time.perf_counter() - started
+        await http_clients.aclose()
+        await dispose_tse_market_async_engine()
+    metrics.rows = _count_rows(benchmark.tables) - rows_before
+    metrics.items = benchmark.items(settings_from_arguments(arguments), metrics.rows)
+    metrics.items_per_second = metrics.items / metrics.elapsed
+    metrics.rows_per_second = metrics.rows / metrics.elapsed
+    metrics.requests = traffic_controller.statistics(TSETMC_HOST).requests
+    metrics.peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return metrics
+
+
+def _run_line(name: str, arguments: argparse.Namespace, port: int) -> LineMetrics:
+    """Runs a line in a fresh process, on a database of its own"""
+    if not arguments.mysql:
+        os.environ["TSE_MARKET_SQLITE_PATH"] = os.path.join(
+            tempfile.mkdtemp(), f"{name}.sqlite"
+        )
+    benchmark = _LINES[name]
+    prepare_database(settings_from_arguments(arguments), benchmark.seeded)
+    return asyncio.run(_perform_line(benchmark, arguments, port))
+
+
+def _serve(
+    settings: FakeTsetmcSettings,
+    ports: multiprocessing.Queue,
+    stop: multiprocessing.Event,
+) -> None:
+    """Serves a FakeTsetmcServer until stopped, then sends its statistics"""
+
+    async def serve() -> ServerStatistics:
+        server = FakeTsetmcServer(settings)
+        ports.put(await server.start())
+        while not stop.is_set():
+            await asyncio.sleep(0.1)
+        await server.close()
+        return server.statistics
+
+    ports.put(asyncio.run(serve()))
+
+
+def main() -> int:
+    """Runs the benchmarks and returns the exit code"""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--lines", nargs="+", choices=list(_LINES), default=list(_LINES)
+    )
+    add_settings_arguments(parser)
+    parser.add_argument("--concurrency", type=int, default=None)
+    parser.add_argument(
+        "--initial-rate", type=float, default=TrafficPolicy.initial_rate
+    )
+    parser.add_argument("--max-rate", type=float, default=TrafficPolicy.max_rate)
+    parser.add_argument("--mysql", action="store_true")
+    add_results_arguments(parser)
+    arguments = parser.parse_args()
+
+    context = multiprocessing.get_context("spawn")
+    ports, stop = context.Queue(), context.Event()
+    server = context.Process(
+        target=_serve, args=(settings_from_arguments(arguments), ports, stop)
+    )
+    server.start()
+    port = ports.get()
+    results = {}
+    try:
+        for name in arguments.lines:
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                metrics = executor.submit(_run_line, name, arguments, port).result()
+            results[name] = asdict(metrics)
+            print(
+                f"{name}: {metrics.items} items in {metrics.elapsed:.1f}s \
+({metrics.items_per_second:.1f}/s), {metrics.rows} rows \
+({metrics.rows_per_second:.0f}/s), {metrics.requests} requests, \
+peak RSS {metrics.peak_rss_mb:.0f} MB, DB {metrics.db_time:.1f}s \
+over {metrics.db_statements} statements"
+            )
+    finally:
+        stop.set()
+        statistics = ports.get()
+        server.join()
+    print(
+        f"server: {statistics.requests} requests, {statistics.errors} errors, \
+{statistics.rate_limited} rate limited, {statistics.recorded} recorded"
+    )
+    return finish(results, arguments, HIGHER_IS_BETTER, LOWER_IS_BETTER)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
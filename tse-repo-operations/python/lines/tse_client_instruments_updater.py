@@ -2,17 +2,24 @@
 Using the line implementation in this module, \
 the instruments table in the database will be kept up-to-date.
 """
-from typing import Callable
+from typing import Any, Callable
 from dataclasses import dataclass
-from datetime import date
+from datetime import date, datetime
+import sqlalchemy
+from sqlalchemy.orm import Session
 from telegram_task import line
-from tse_utils.tse_client import TseClientInstrumentIdentitification, TseClientScraper
+from tse_utils.tse_client import TseClientInstrumentIdentitification
+from utils.change_set import ChangeSet, diff_by_key
+from utils.fingerprint import fingerprint_records
 from utils.persian_arabic import arabic_to_persian
+from utils.traffic import TrafficControlled, TSE_CLIENT_HOST
+from tse_utils_db.bulk import bulk_insert
 from tse_utils_db.tse_market import (
-    get_tse_market_session,
+    get_tse_market_async_session,
     InstrumentType,
     InstrumentIdentification,
     IndexIdentification,
+    SnapshotFingerprint,
 )
 
 
@@ -21,21 +28,47 @@ class JobDescription(line.JobDescription):
     """Overriden JobDescription for module tse_client_instruments_updater"""
 
     min_acceptable_last_change_date: date = None
+    force_full: bool = None
 
 
-class TseClientInstrumentsUpdater(line.Worker):
+@dataclass
+class _TseClientSnapshot:
+    """Processed instruments and indices fetched from TSE client"""
+
+    instruments: list[TseClientInstrumentIdentitification]
+    indices: list[TseClientInstrumentIdentitification]
+    global_isins: set[str]
+
+
+class TseClientInstrumentsUpdater(TrafficControlled, line.Worker):
     """Overriden worker for module tse_client_instruments_updater"""
 
+    _instrument_fields: tuple[str, ...] = (
+        "tsetmc_code",
+        "ticker",
+        "name_persian",
+        "name_english",
+    )
+    _index_fields: tuple[str, ...] = ("tsetmc_code", "name_persian", "name_english")
+    _instrument_snapshot_fields: tuple[str, ...] = (
+        "isin",
+        *_instrument_fields,
+        "type_id",
+    )
+    _index_snapshot_fields: tuple[str, ...] = ("isin", *_index_fields)
+    _instruments_snapshot_key: str = "tse_client_instruments"
+    _indices_snapshot_key: str = "tse_client_indices"
+
     async def perform_task(self, job_description: JobDescription) -> line.JobReport:
         """Performs the task using the provided job description"""
         report = line.JobReport(
             information=[f"Result ➡️ {job_description.min_acceptable_last_change_date}"]
         )
-        instruments, indices = await self.__get_global_instruments_from_tse_client(
+        snapshot = await self.__get_global_instruments_from_tse_client(
             job_description=job_description, report=report
         )
         await self.__update_database(
-            instruments=instruments, indices=indices, report=report
+            snapshot=snapshot, job_description=job_description, report=report
         )
         return report
 
@@ -43,131 +76,250 @@ class TseClientInstrumentsUpdater(line.Worker):
     def default_job_description(cls) -> JobDescription:
         """Creates the default job description for this worker"""
         return JobDescription(
-            min_acceptable_last_change_date=date(year=2023, month=1, day=1)
+            min_acceptable_last_change_date=date(year=2023, month=1, day=1),
+            force_full=False,
         )
 
     async def __update_database(
         self,
-        instruments: list[TseClientInstrumentIdentitification],
-        indices: list[TseClientInstrumentIdentitification],
+        snapshot: _TseClientSnapshot,
+        job_description: JobDescription,
         report: line.JobReport,
     ):
-        """Updates the database with the instruments and the indices"""
-        with get_tse_market_session() as session:
-            instrument_types = session.query(InstrumentType).all()
-            instruments_known_type = self.__filter_identifications_by_type(
-                instruments, instrument_types, report
+        """
+        Updates the database with the instruments and the indices, \
+        skipping each list if it is identical to the last processed one
+        """
+        async with get_tse_market_async_session() as session:
+            await session.run_sync(
+                self.__update_database_in_session, snapshot, job_description, report
             )
-            old_instruments = session.query(InstrumentIdentification).all()
-            old_indices = session.query(IndexIdentification).all()
-            new_instruments = [
-                x
-                for x in instruments_known_type
-                if not any(y for y in old_instruments if y.isin == x.isin)
-            ]
-            session.add_all(
+            await session.commit()
+
+    def __update_database_in_session(
+        self,
+        session: Session,
+        snapshot: _TseClientSnapshot,
+        job_description: JobDescription,
+        report: line.JobReport,
+    ):
+        """Runs the database update in the session's transaction"""
+        type_ids = set(
+            session.scalars(sqlalchemy.select(InstrumentType.instrument_type_id))
+        )
+        previous_fingerprints = self.__load_fingerprints(session)
+        fingerprints = {
+            self._instruments_snapshot_key: fingerprint_records(
                 [
-                    self.tse_client_to_database_instrument_identification(raw=x)
-                    for x in new_instruments
+                    [getattr(x, y) for y in self._instrument_snapshot_fields]
+                    for x in snapshot.instruments
                 ]
-            )
-            report.information.append(
-                f"New instruments added ➡️ {len(new_instruments)}"
-            )
-            for ind in new_instruments:
-                self._LOGGER.info("New instrument : %s", repr(ind))
-            new_indices = [
-                x
-                for x in indices
-                if not any(y for y in old_indices if y.isin == x.isin)
-            ]
-            session.add_all(
+                + [["type_ids", *sorted(type_ids)]]
+            ),
+            self._indices_snapshot_key: fingerprint_records(
                 [
-                    self.tse_client_to_database_index_identification(raw=x)
-                    for x in new_indices
+                    [getattr(x, y) for y in self._index_snapshot_fields]
+                    for x in snapshot.indices
                 ]
-            )
-            report.information.append(f"New indices added ➡️ {len(new_indices)}")
-            for ind in new_indices:
-                self._LOGGER.info("New index : %s", repr(ind))
-            self.__handle_changed_instruments(
-                instruments=instruments, old_instruments=old_instruments, report=report
-            )
-            session.commit()
+            ),
+        }
+        unchanged = {
+            x
+            for x, y in fingerprints.items()
+            if y == previous_fingerprints.get(x) and not job_description.force_full
+        }
+        if self._instruments_snapshot_key in unchanged:
+            report.information.append("Instruments ➡️ unchanged since last run")
+        else:
+            self.__update_instruments(session, snapshot, type_ids, report)
+        if self._indices_snapshot_key in unchanged:
+            report.information.append("Indices ➡️ unchanged since last run")
+        else:
+            self.__update_indices(session, snapshot, report)
+        self.__save_fingerprints(session, fingerprints)
 
-    def __handle_changed_instruments(
+    def __update_instruments(
         self,
-        instruments: list[TseClientInstrumentIdentitification],
-        old_instruments: list[InstrumentIdentification],
+        session: Session,
+        snapshot: _TseClientSnapshot,
+        type_ids: set[int],
         report: line.JobReport,
-    ):
-        """Update changed instruments on database"""
-        updated = 0
-        for old_instrument in old_instruments:
-            new_instrument = next(
-                (x for x in instruments if x.isin == old_instrument.isin), None
+    ) -> None:
+        """Adds new instruments and applies the changed ones"""
+        instruments = snapshot.instruments
+        known_type_isins = {
+            x.isin
+            for x in self.__filter_identifications_by_type(
+                instruments, type_ids, report
             )
-            if new_instrument:
-                if self.__old_instrument_has_updates(old_instrument, new_instrument):
-                    updated += 1
-                    self._LOGGER.info(
-                        "Instrument changed: %s => %s",
-                        repr(old_instrument),
-                        repr(new_instrument),
-                    )
-                    old_instrument.ticker = new_instrument.ticker
-                    old_instrument.name_english = new_instrument.name_english
-                    old_instrument.name_persian = new_instrument.name_persian
-                    old_instrument.tsetmc_code = new_instrument.tsetmc_code
-        report.information.append(f"Updated instruments ➡️ {updated}")
-
-    def __old_instrument_has_updates(
+        }
+        instrument_changes = diff_by_key(
+            old=self.__database_snapshot(
+                session, InstrumentIdentification, self._instrument_fields
+            ),
+            new={
+                x.isin: {y: getattr(x, y) for y in self._instrument_fields}
+                for x in instruments
+            },
+            fields=self._instrument_fields,
+        )
+        new_instruments = [
+            x
+            for x in instruments
+            if x.isin in instrument_changes.added and x.isin in known_type_isins
+        ]
+        bulk_insert(
+            session=session,
+            model=InstrumentIdentification,
+            rows=[
+                self.tse_client_to_database_instrument_identification(raw=x)
+                for x in new_instruments
+            ],
+        )
+        report.information.append(f"New instruments added ➡️ {len(new_instruments)}")
+        for ind in new_instruments:
+            self._LOGGER.info("New instrument : %s", repr(ind))
+        self.__apply_changes(
+            session, InstrumentIdentification, instrument_changes, "instruments"
+        )
+        report.information.append(
+            f"Updated instruments ➡️ {len(instrument_changes.changed)}"
+        )
+        if instrument_changes.field_changes:
+            report.information.append(
+                f"Changed fields ➡️ {instrument_changes.field_changes_summary()}"
+            )
+        self.__report_disappeared(
+            instrument_changes.removed - snapshot.global_isins, "instruments", report
+        )
+
+    def __update_indices(
+        self, session: Session, snapshot: _TseClientSnapshot, report: line.JobReport
+    ) -> None:
+        """Adds new indices and applies the changed ones"""
+        indices = snapshot.indices
+        index_changes = diff_by_key(
+            old=self.__database_snapshot(
+                session, IndexIdentification, self._index_fields
+            ),
+            new={
+                x.isin: {y: getattr(x, y) for y in self._index_fields} for x in indices
+            },
+            fields=self._index_fields,
+        )
+        new_indices = [x for x in indices if x.isin in index_changes.added]
+        bulk_insert(
+            session=session,
+            model=IndexIdentification,
+            rows=[
+                self.tse_client_to_database_index_identification(raw=x)
+                for x in new_indices
+            ],
+        )
+        report.information.append(f"New indices added ➡️ {len(new_indices)}")
+        for ind in new_indices:
+            self._LOGGER.info("New index : %s", repr(ind))
+        self.__apply_changes(session, IndexIdentification, index_changes, "indices")
+        report.information.append(f"Updated indices ➡️ {len(index_changes.changed)}")
+        self.__report_disappeared(
+            index_changes.removed - snapshot.global_isins, "indices", report
+        )
+
+    @classmethod
+    def __load_fingerprints(cls, session: Session) -> dict[str, str]:
+        """Loads the fingerprints of the last processed snapshots"""
+        rows = session.execute(
+            sqlalchemy.select(
+                SnapshotFingerprint.snapshot_key, SnapshotFingerprint.fingerprint
+            )
+        )
+        return dict(rows.tuples().all())
+
+    @classmethod
+    def __save_fingerprints(cls, session: Session, fingerprints: dict[str, str]):
+        """Stores the fingerprints of the processed snapshots"""
+        bulk_insert(
+            session=session,
+            model=SnapshotFingerprint,
+            rows=[
+                {"snapshot_key": x, "fingerprint": y, "updated_at": datetime.now()}
+                for x, y in fingerprints.items()
+            ],
+            upsert=True,
+        )
+
+    def __apply_changes(
         self,
-        old_instrument: InstrumentIdentification,
-        new_instrument: TseClientInstrumentIdentitification,
-    ) -> bool:
-        """Checks if there is a mismatch between old and new instrument"""
-        return not (
-            old_instrument.ticker == new_instrument.ticker
-            and old_instrument.name_persian == new_instrument.name_persian
-            and old_instrument.name_english == new_instrument.name_english
-            and old_instrument.tsetmc_code == new_instrument.tsetmc_code
+        session: Session,
+        model: type[InstrumentIdentification] | type[IndexIdentification],
+        change_set: ChangeSet,
+        title: str,
+    ) -> None:
+        """Updates the changed fields of the existing rows in bulk"""
+        for isin, changes in change_set.changed.items():
+            self._LOGGER.info("Changed %s [%s]: %s", title, isin, repr(changes))
+        if change_set.changed:
+            session.execute(
+                sqlalchemy.update(model),
+                [{"isin": x, **y} for x, y in change_set.changed.items()],
+            )
+
+    def __report_disappeared(
+        self, disappeared: set[str], title: str, report: line.JobReport
+    ) -> None:
+        """Reports the rows that are no longer present in the TSE client list"""
+        report.information.append(f"Disappeared {title} ➡️ {len(disappeared)}")
+        if disappeared:
+            self._LOGGER.warning(
+                "Disappeared %s: %s", title, ", ".join(sorted(disappeared))
+            )
+
+    @classmethod
+    def __database_snapshot(
+        cls,
+        session: Session,
+        model: type[InstrumentIdentification] | type[IndexIdentification],
+        fields: tuple[str, ...],
+    ) -> dict[str, dict[str, Any]]:
+        """Loads the compared columns of a table, keyed by isin"""
+        rows = session.execute(
+            sqlalchemy.select(model.isin, *[getattr(model, x) for x in fields])
         )
+        return {x.isin: x._asdict() for x in rows}
 
     @classmethod
     def tse_client_to_database_index_identification(
         cls, raw: TseClientInstrumentIdentitification
-    ) -> IndexIdentification:
-        """Converts an instrument identification from TseClient to database model"""
-        return IndexIdentification(
-            isin=raw.isin,
-            tsetmc_code=raw.tsetmc_code,
-            name_persian=raw.name_persian,
-            name_english=raw.name_english,
-        )
+    ) -> dict[str, Any]:
+        """Converts an index identification from TseClient to a database row"""
+        return {
+            "isin": raw.isin,
+            "tsetmc_code": raw.tsetmc_code,
+            "name_persian": raw.name_persian,
+            "name_english": raw.name_english,
+        }
 
     @classmethod
     def tse_client_to_database_instrument_identification(
         cls, raw: TseClientInstrumentIdentitification
-    ) -> InstrumentIdentification:
-        """Converts an instrument identification from TseClient to database model"""
-        return InstrumentIdentification(
-            isin=raw.isin,
-            ticker=raw.ticker,
-            tsetmc_code=raw.tsetmc_code,
-            name_persian=raw.name_persian,
-            name_english=raw.name_english,
-            instrument_type_id=raw.type_id,
-        )
+    ) -> dict[str, Any]:
+        """Converts an instrument identification from TseClient to a database row"""
+        return {
+            "isin": raw.isin,
+            "ticker": raw.ticker,
+            "tsetmc_code": raw.tsetmc_code,
+            "name_persian": raw.name_persian,
+            "name_english": raw.name_english,
+            "instrument_type_id": raw.type_id,
+        }
 
     def __filter_identifications_by_type(
         self,
         instruments: list[TseClientInstrumentIdentitification],
-        instrument_types: list[InstrumentType],
+        type_ids: set[int],
         report: line.JobReport,
     ) -> list[TseClientInstrumentIdentitification]:
         """Filters out the instruments with unknown types"""
-        type_ids = [x.instrument_type_id for x in instrument_types]
         unknown = [x for x in instruments if x.type_id not in type_ids]
         if unknown:
             set_unknown = {x.type_id for x in unknown}
@@ -178,20 +330,22 @@ class TseClientInstrumentsUpdater(line.Worker):
 
     async def __get_global_instruments_from_tse_client(
         self, job_description: JobDescription, report: line.JobReport
-    ) -> tuple[
-        list[TseClientInstrumentIdentitification],
-        list[TseClientInstrumentIdentitification],
-    ]:
+    ) -> _TseClientSnapshot:
         """Get instruments from TSE client"""
         self._LOGGER.info("Fetching global instruments.")
-        async with TseClientScraper() as tse_client:
-            instruments, indices = await tse_client.get_instruments_list()
+        async with self.http_clients.tse_client_scraper() as tse_client:
+            instruments, indices = await self.traffic_controller.request(
+                TSE_CLIENT_HOST, tse_client.get_instruments_list
+            )
         self._LOGGER.info(
             "Global instruments count: [%d], Global indices count: [%d]",
             len(instruments),
             len(indices),
         )
         report.information.append(f"Global instruments ➡️ {len(instruments)}")
+        report.information.append(
+            f"TSE client connections ➡️ {self.http_clients.summary(TSE_CLIENT_HOST)}"
+        )
         self.__pre_process_identifications(instruments)
         self.__pre_process_identifications(indices)
         instruments_ok, _ = self.__filter_by_last_change_date(
@@ -201,7 +355,11 @@ class TseClientInstrumentsUpdater(line.Worker):
             "Filtered instruments count: [%d]",
             len(instruments_ok),
         )
-        return instruments_ok, indices
+        return _TseClientSnapshot(
+            instruments=instruments_ok,
+            indices=indices,
+            global_isins={x.isin for x in instruments} | {x.isin for x in indices},
+        )
 
     @classmethod
     def __pre_process_identifications(
@@ -0,0 +1,280 @@
+"""
+Using the line implementation in this module, \
+one can rebuild the daily historical tables from the archived TSETMC responses.
+"""
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from datetime import date, datetime
+from pathlib import Path
+from typing import Any, Callable
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import time
+import sqlalchemy
+from telegram_task import line
+from tse_utils import tsetmc
+from utils.daily_datasets import CLIENT_TYPE_DATASET, Dataset, TRADE_DATASET
+from utils.response_archive import ResponseArchive, read_index, read_records
+from tse_utils_db.batch import ColumnBatch
+from tse_utils_db.bulk import bulk_insert
+from tse_utils_db.watermark import WatermarkStatus, save_watermarks, watermark_row
+from tse_utils_db.tse_market import (
+    get_tse_market_session,
+    get_tse_market_async_session,
+    InstrumentIdentification,
+)
+
+
+@dataclass
+class JobDescription(line.JobDescription):
+    """Overriden JobDescription for module tsetmc_archive_reparser"""
+
+    get_trade_data: bool = None
+    get_client_type_data: bool = None
+    start_date: date = None
+    end_date: date = None
+    processes: int = None
+    upsert: bool = None
+
+
+class TsetmcArchiveReparser(line.Worker):
+    """Overriden worker for module tsetmc_archive_reparser"""
+
+    def __init__(self, archive: ResponseArchive = None):
+        self.archive: ResponseArchive = archive if archive else ResponseArchive()
+
+    async def perform_task(self, job_description: JobDescription) -> line.JobReport:
+        """Performs the task using the provided job description"""
+        return await _Shift(
+            job_description=job_description,
+            logger=self._LOGGER,
+            archive=self.archive,
+        ).perform_task()
+
+    @classmethod
+    def default_job_description(cls) -> JobDescription:
+        """Creates the default job description for this worker"""
+        return JobDescription(
+            get_trade_data=True,
+            get_client_type_data=True,
+            start_date=None,
+            end_date=None,
+            processes=os.cpu_count(),
+            upsert=True,
+        )
+
+
+@dataclass
+class _ArchivedDataset:
+    """Describes where a daily dataset is archived and how it is parsed"""
+
+    dataset: Dataset
+    endpoint: str
+    payload: str
+    key: Callable[[str], str]
+    parse: Callable[[dict], Any]
+
+
+class _Shift:
+    """Internal class for simpler performance of the worker's task"""
+
+    _insert_batch_size: int = 1000
+
+    def __init__(
+        self,
+        job_description: JobDescription,
+        logger: logging.Logger,
+        archive: ResponseArchive,
+    ):
+        self._logger: logging.Logger = logger
+        self.job_description: JobDescription = job_description
+        self.archive: ResponseArchive = archive
+        self.report: line.JobReport = line.JobReport()
+
+    async def perform_task(self) -> line.JobReport:
+        """Performs the task using the provided job description"""
+        await self.archive.flush()
+        isins = await self.__get_isins()
+        self.report.information.append(f"Instruments count ➡️ {len(isins)}")
+        datasets = [
+            x
+            for x, enabled in (
+                (_ARCHIVED_TRADE_DATASET, self.job_description.get_trade_data),
+                (
+                    _ARCHIVED_CLIENT_TYPE_DATASET,
+                    self.job_description.get_client_type_data,
+                ),
+            )
+            if enabled
+        ]
+        started = time.perf_counter()
+        with ProcessPoolExecutor(
+            max_workers=self.job_description.processes,
+            mp_context=multiprocessing.get_context("spawn"),
+        ) as executor:
+            for archived in datasets:
+                await self.__reparse_dataset(executor, archived, isins)
+        self.report.information.append(
+            f"Reparse time ➡️ {time.perf_counter() - started:.1f}s"
+        )
+        return self.report
+
+    async def __reparse_dataset(
+        self,
+        executor: ProcessPoolExecutor,
+        archived: _ArchivedDataset,
+        isins: dict[str, str],
+    ) -> None:
+        """
+        Rebuilds the rows of a dataset from the latest archived response \
+        of every instrument, parsing the segments on the worker processes \
+        and inserting their rows as they come
+        """
+        plan = await asyncio.to_thread(self.__plan_segments, archived, isins)
+        loop = asyncio.get_running_loop()
+        inserted = 0
+        for parsed in asyncio.as_completed(
+            [
+                loop.run_in_executor(
+                    executor, _parse_segment, archived.dataset.title, str(x), y
+                )
+                for x, y in plan.items()
+            ]
+        ):
+            rows, watermarks = await parsed
+            self._logger.info(
+                "Inserting %d reparsed %s rows into database.",
+                len(rows),
+                archived.dataset.model.__name__,
+            )
+            inserted += await asyncio.to_thread(
+                self.insert_rows_in_database, rows, watermarks
+            )
+        title = archived.dataset.title
+        self.report.information.extend(
+            [
+                f"{title} segments ➡️ {len(plan)}",
+                f"{title} instruments ➡️ {sum(len(x) for x in plan.values())}",
+                f"{title} inserted ➡️ {inserted}",
+            ]
+        )
+
+    def __plan_segments(
+        self, archived: _ArchivedDataset, isins: dict[str, str]
+    ) -> dict[Path, dict[str, str]]:
+        """
+        Finds through the indices the segment holding the latest response \
+        of every instrument, and maps each segment to the archive keys \
+        and the ISINs of the instruments it has to parse
+        """
+        keys = {archived.key(x): y for x, y in isins.items()}
+        latest: dict[str, Path] = {}
+        for segment in self.archive.segments(
+            endpoint=archived.endpoint,
+            start=self.job_description.start_date,
+            end=self.job_description.end_date,
+        ):
+            for key, _ in read_index(segment):
+                if key in keys:
+                    latest[key] = segment
+        plan: dict[Path, dict[str, str]] = {}
+        for key, segment in latest.items():
+            plan.setdefault(segment, {})[key] = keys[key]
+        return plan
+
+    def insert_rows_in_database(
+        self, rows: ColumnBatch, watermarks: list[dict[str, Any]]
+    ) -> int:
+        """
+        Inserts the reparsed rows of a segment into database, \
+        along with the watermarks of the instruments they belong to
+        """
+        with get_tse_market_session() as session:
+            row_num = bulk_insert(
+                session=session,
+                model=rows.model,
+                rows=rows.rows(),
+                batch_size=self._insert_batch_size,
+                upsert=bool(self.job_description.upsert),
+            )
+            save_watermarks(session=session, watermarks=watermarks)
+            session.commit()
+        return row_num
+
+    @classmethod
+    async def __get_isins(cls) -> dict[str, str]:
+        """Gets the ISIN of every instrument by its TSETMC code"""
+        async with get_tse_market_async_session() as session:
+            instruments = await session.execute(
+                sqlalchemy.select(
+                    InstrumentIdentification.tsetmc_code,
+                    InstrumentIdentification.isin,
+                )
+            )
+            return dict(instruments.all())
+
+
+def _parse_segment(
+    title: str, segment: str, isins: dict[str, str]
+) -> tuple[ColumnBatch, list[dict[str, Any]]]:
+    """
+    Converts the latest archived response of each instrument in a segment \
+    to rows, isins mapping the archive keys of the instruments to their ISINs, \
+    along with the watermarks of the instruments, dated by when they were fetched. \
+    Runs on a worker process, reading only the members that hold them, \
+    and sends the rows back as columns, which pickle compactly.
+    """
+    archived = _ARCHIVED_DATASETS[title]
+    latest: dict[str, dict[str, Any]] = {}
+    for record in read_records(
+        Path(segment), [y for x, y in read_index(Path(segment)) if x in isins]
+    ):
+        if record["key"] in isins:
+            latest[record["key"]] = record
+    rows = ColumnBatch(archived.dataset.model)
+    watermarks = []
+    for key, record in latest.items():
+        traded = [
+            x
+            for x in map(archived.parse, json.loads(record["body"])[archived.payload])
+            if archived.dataset.has_trades(x)
+        ]
+        rows.extend(
+            archived.dataset.to_db(isin=isins[key], tsetmc_data=x) for x in traded
+        )
+        watermarks.append(
+            watermark_row(
+                isin=isins[key],
+                dataset=archived.dataset.watermark,
+                last_record_date=max(
+                    map(archived.dataset.record_date, traded), default=None
+                ),
+                status=WatermarkStatus.SUCCESS,
+                fetch_time=datetime.fromisoformat(record["fetched_at"]),
+            )
+        )
+    return rows, watermarks
+
+
+_ARCHIVED_TRADE_DATASET = _ArchivedDataset(
+    dataset=TRADE_DATASET,
+    endpoint="GetClosingPriceDailyList",
+    payload="closingPriceDaily",
+    key=lambda tsetmc_code: f"{tsetmc_code}/0",
+    parse=lambda x: tsetmc.ClosingPriceDaily(tsetmc_raw_data=x),
+)
+
+_ARCHIVED_CLIENT_TYPE_DATASET = _ArchivedDataset(
+    dataset=CLIENT_TYPE_DATASET,
+    endpoint="GetClientTypeHistory",
+    payload="clientType",
+    key=lambda tsetmc_code: tsetmc_code,
+    parse=lambda x: tsetmc.ClientTypeDaily(tsetmc_raw_data=x),
+)
+
+_ARCHIVED_DATASETS: dict[str, _ArchivedDataset] = {
+    x.dataset.title: x for x in (_ARCHIVED_TRADE_DATASET, _ARCHIVED_CLIENT_TYPE_DATASET)
+}
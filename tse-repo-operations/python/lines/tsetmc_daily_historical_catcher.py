@@ -3,16 +3,61 @@ Using the line implementation in this module, \
 one can fetch daily historical data from TSETMC.
 """
 from dataclasses import dataclass
-import logging
+from itertools import chain
+from collections import Counter
+from datetime import date, datetime, timedelta
+from typing import Any
+import time
 import httpx
 import sqlalchemy
+from sqlalchemy.ext.asyncio import AsyncSession
 from telegram_task import line
 from tse_utils import tsetmc
+from utils.concurrency import fetch_concurrently, FetchStatistics, FetchOutcome
+from utils.daily_datasets import CLIENT_TYPE_DATASET, Dataset, TRADE_DATASET
+from utils.pipeline import BackgroundWriter, StageStatistics, fetch_into_writer
+from utils.polling_policy import InstrumentActivity, PollingPolicy
+from utils.traffic import (
+    TrafficControlled,
+    TrafficControlledShift,
+    TSETMC_HOST,
+    traffic_report,
+)
+from tse_utils_db.batch import ColumnBatch
+from tse_utils_db.bulk import bulk_insert
+from tse_utils_db.checkpoint import (
+    CheckpointStatus,
+    abandon_runs,
+    checkpoint_row,
+    find_last_run,
+    find_running_runs,
+    finish_run,
+    is_left_by_previous_process,
+    load_run_items,
+    release_run,
+    renew_run_lease,
+    save_checkpoints,
+    start_run,
+    take_over_run,
+)
+from tse_utils_db.engine import (
+    get_tse_market_pool_statistics,
+    get_tse_market_async_pool_statistics,
+)
+from tse_utils_db.watermark import (
+    WatermarkDataset,
+    WatermarkStatus,
+    load_watermarks,
+    save_watermarks,
+    watermark_row,
+)
 from tse_utils_db.tse_market import (
     get_tse_market_session,
+    get_tse_market_async_session,
     InstrumentIdentification,
     DailyTradeCandle,
     DailyClientType,
+    DataWatermark,
 )
 
 
@@ -20,19 +65,30 @@ from tse_utils_db.tse_market import (
 class JobDescription(line.JobDescription):
     """Overriden JobDescription for module tsetmc_daily_historical_catcher"""
 
+    # pylint: disable=too-many-instance-attributes
+    # Each attribute is a job option shown on the Telegram panel
     get_trade_data: bool = None
     get_client_type_data: bool = None
     specific_instrument_identifier: str = None
     specific_instrument_type: int = None
+    concurrency: int = None
+    upsert: bool = None
+    single_pass: bool = None
+    force_full: bool = None
+    resume: bool = None
+    retry_failed: bool = None
 
 
-class TsetmcDailyHistoricalCatcher(line.Worker):
+class TsetmcDailyHistoricalCatcher(TrafficControlled, line.Worker):
     """Overriden worker for module tsetmc_daily_historical_catcher"""
 
     async def perform_task(self, job_description: JobDescription) -> line.JobReport:
         """Performs the task using the provided job description"""
         return await _Shift(
-            job_description=job_description, logger=self._LOGGER
+            job_description=job_description,
+            logger=self._LOGGER,
+            traffic_controller=self.traffic_controller,
+            http_clients=self.http_clients,
         ).perform_task()
 
     @classmethod
@@ -43,273 +99,734 @@ class TsetmcDailyHistoricalCatcher(line.Worker):
             get_client_type_data=True,
             specific_instrument_identifier=None,
             specific_instrument_type=None,
+            concurrency=8,
+            upsert=True,
+            single_pass=True,
+            force_full=False,
+            resume=True,
+            retry_failed=False,
         )
 
 
-class _Shift:
+@dataclass
+class _SinglePassResult:
+    """Trade and client type data fetched for an instrument in a single pass"""
+
+    trade_data: list[tsetmc.ClosingPriceDaily]
+    client_type_data: list[tsetmc.ClientTypeDaily] = None
+    client_type_exception: BaseException = None
+    client_type_skipped: bool = False
+
+
+@dataclass
+class _WriteUnit:
+    """
+    New rows of a dataset for an instrument, with its watermark \
+    and its checkpoint, which are committed along with the rows
+    """
+
+    model: type[DailyTradeCandle] | type[DailyClientType]
+    rows: ColumnBatch
+    watermark: dict[str, Any] = None
+    checkpoint: dict[str, Any] = None
+
+
+class _Shift(TrafficControlledShift):
     """Internal class for simpler performance of the worker's task"""
 
+    job_description: JobDescription
     _update_chunk_len: int = 10000
+    _update_interval: float = 5.0
+    _write_queue_size: int = 256
+    _insert_batch_size: int = 1000
+    _activity_window_days: int = 60
+    _activity_chunk_len: int = 1000
+    _run_lease: timedelta = timedelta(minutes=15)
+    _polling_policy: PollingPolicy = PollingPolicy()
+    _worker: str = "tsetmc_daily_historical_catcher"
 
-    def __init__(self, job_description: JobDescription, logger: logging.Logger):
-        self._logger: logging.Logger = logger
-        self.job_description: JobDescription = job_description
-        self.report: line.JobReport = line.JobReport()
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.run_id: int = None
+        self.skipped: Counter[str] = Counter()
 
     async def perform_task(self) -> line.JobReport:
         """Performs the task using the provided job description"""
-        instruments = self.get_instruments(
+        instruments = await self.get_instruments(
             search_by_instrument=self.job_description.specific_instrument_identifier,
             search_by_type=self.job_description.specific_instrument_type,
         )
         self.report.information.append(
             f"Instruments count ➡️ {len(instruments)}",
         )
-        if self.job_description.get_trade_data:
-            await self.__update_trade_data(instruments)
-        if self.job_description.get_client_type_data:
-            await self.__update_client_type_data(instruments)
+        if (
+            self.job_description.specific_instrument_identifier
+            or self.job_description.specific_instrument_type
+        ):
+            if not (
+                self.job_description.force_full
+                or self.job_description.specific_instrument_identifier
+            ):
+                instruments = await self.__apply_polling_policy(instruments)
+        else:
+            instruments = await self.__start_run(instruments)
+        try:
+            await self.__update_datasets(instruments)
+        except Exception:
+            if self.run_id:
+                async with get_tse_market_async_session() as session:
+                    await session.run_sync(release_run, self.run_id)
+                    await session.commit()
+            raise
+        if self.run_id:
+            async with get_tse_market_async_session() as session:
+                await session.run_sync(finish_run, self.run_id)
+                await session.commit()
+        self.report.information.extend(
+            traffic_report(self.traffic_controller, self.http_clients, TSETMC_HOST)
+        )
+        for title, pool_statistics in (
+            ("DB pool", get_tse_market_pool_statistics()),
+            ("DB async pool", get_tse_market_async_pool_statistics()),
+        ):
+            self.report.information.append(
+                f"{title} checkouts ➡️ {pool_statistics.checkouts} \
+(max wait {pool_statistics.max_wait_time:.3f}s, \
+{pool_statistics.checked_out} checked out, overflow {pool_statistics.overflow})"
+            )
         return self.report
 
-    async def __update_client_type_data(
+    async def __update_dataset(
+        self, instruments: list[InstrumentIdentification], dataset: Dataset
+    ):
+        """
+        Gets and updates a daily dataset for the instruments. \
+        Fetched data is converted on the event loop and written \
+        to database by a background writer, so fetching never waits for it.
+        """
+        watermarks = await self.__get_watermarks(dataset.watermark)
+        fetch_statistics = FetchStatistics()
+        convert_statistics = StageStatistics()
+        writer = self.__create_writer()
+        async with self.http_clients.tsetmc_scraper() as scraper, writer:
+
+            async def fetch(instrument: InstrumentIdentification) -> list[Any]:
+                self._logger.info(
+                    "Catching %s for %s", dataset.title.lower(), repr(instrument)
+                )
+                return await self.traffic_controller.request_or_skip(
+                    TSETMC_HOST,
+                    lambda: dataset.fetch(scraper, instrument.tsetmc_code),
+                )
+
+            await fetch_into_writer(
+                writer=writer,
+                convert=lambda outcome: self.__convert_outcome(
+                    dataset=dataset,
+                    outcome=outcome,
+                    previous_last_record_date=watermarks.get(outcome.item.isin),
+                    statistics=convert_statistics,
+                ),
+                items=instruments,
+                fetcher=fetch,
+                concurrency=self.job_description.concurrency,
+                expected_exceptions=(httpx.RequestError, tsetmc.TsetmcScrapeException),
+                statistics=fetch_statistics,
+                deferred_retries=self.traffic_controller.policy.deferred_retries,
+            )
+        self.__report_dataset(
+            dataset.title,
+            convert_statistics,
+            fetch_statistics.requests,
+        )
+        self.__report_pipeline(
+            dataset.title, fetch_statistics, convert_statistics, writer
+        )
+
+    async def __update_datasets_single_pass(
         self, instruments: list[InstrumentIdentification]
     ):
-        """Gets and updates client type data"""
-        max_record_dates = self.__get_max_client_type_data_dates()
-        success = 0
-        failure = 0
-        client_type_data_inserted = 0
-        new_batch_data = []
-        async with tsetmc.TsetmcScraper() as scraper:
-            for instrument in instruments:
-                previous_last_record = next(
-                    (x for x in max_record_dates if x.isin == instrument.isin), None
+        """
+        Gets and updates trade and client type data in a single pass \
+        over the instruments, sharing one HTTP session. The client type \
+        request is skipped when the trade data shows no new traded day.
+        """
+        trade_watermarks = await self.__get_watermarks(TRADE_DATASET.watermark)
+        client_type_watermarks = await self.__get_watermarks(
+            CLIENT_TYPE_DATASET.watermark
+        )
+        fetch_statistics = FetchStatistics()
+        convert_statistics = {
+            TRADE_DATASET.title: StageStatistics(),
+            CLIENT_TYPE_DATASET.title: StageStatistics(),
+        }
+        client_type_outcomes = 0
+        writer = self.__create_writer()
+        async with self.http_clients.tsetmc_scraper() as scraper, writer:
+
+            async def fetch(instrument: InstrumentIdentification) -> _SinglePassResult:
+                return await self.__fetch_single_pass(
+                    scraper, instrument, client_type_watermarks.get(instrument.isin)
                 )
-                try:
-                    self._logger.info(
-                        "Catching client type data for %s", repr(instrument)
-                    )
-                    client_type_data = await scraper.get_client_type_daily_list(
-                        tsetmc_code=instrument.tsetmc_code
-                    )
-                    success += 1
-                except (httpx.RequestError, tsetmc.TsetmcScrapeException):
-                    self._logger.error(
-                        "Catching client type data failed for %s", repr(instrument)
+
+            async for outcome in fetch_concurrently(
+                items=instruments,
+                fetcher=fetch,
+                concurrency=self.job_description.concurrency,
+                expected_exceptions=(httpx.RequestError, tsetmc.TsetmcScrapeException),
+                statistics=fetch_statistics,
+                deferred_retries=self.traffic_controller.policy.deferred_retries,
+            ):
+                instrument = outcome.item
+                await writer.put(
+                    self.__convert_outcome(
+                        dataset=TRADE_DATASET,
+                        outcome=FetchOutcome(
+                            item=instrument,
+                            result=outcome.result.trade_data
+                            if outcome.succeeded
+                            else None,
+                            exception=outcome.exception,
+                        ),
+                        previous_last_record_date=trade_watermarks.get(instrument.isin),
+                        statistics=convert_statistics[TRADE_DATASET.title],
                     )
-                    failure += 1
+                )
+                if not outcome.succeeded or outcome.result.client_type_skipped:
+                    if self.run_id:
+                        await writer.put(
+                            self.__checkpoint_unit(
+                                dataset=CLIENT_TYPE_DATASET,
+                                isin=instrument.isin,
+                                status=CheckpointStatus.FAILED
+                                if not outcome.succeeded
+                                else CheckpointStatus.SKIPPED,
+                            )
+                        )
                     continue
-                new_data = [
-                    self.client_type_data_tsetmc_to_db(
-                        isin=instrument.isin, tsetmc_data=x
-                    )
-                    for x in client_type_data
-                    if x.trade_volume() > 0
-                    and (
-                        previous_last_record is None
-                        or x.record_date > previous_last_record.record_date
-                    )
-                ]
-                new_batch_data.extend(new_data)
-                if len(new_batch_data) > self._update_chunk_len:
-                    client_type_data_inserted += self.insert_data_batch_in_database(
-                        new_batch_data
+                client_type_outcomes += 1
+                await writer.put(
+                    self.__convert_outcome(
+                        dataset=CLIENT_TYPE_DATASET,
+                        outcome=FetchOutcome(
+                            item=instrument,
+                            result=outcome.result.client_type_data,
+                            exception=outcome.result.client_type_exception,
+                        ),
+                        previous_last_record_date=client_type_watermarks.get(
+                            instrument.isin
+                        ),
+                        statistics=convert_statistics[CLIENT_TYPE_DATASET.title],
                     )
-            if new_batch_data:
-                client_type_data_inserted += self.insert_data_batch_in_database(
-                    new_batch_data
                 )
+        trade_statistics = convert_statistics[TRADE_DATASET.title]
+        client_type_statistics = convert_statistics[CLIENT_TYPE_DATASET.title]
+        self.__report_dataset(
+            TRADE_DATASET.title,
+            trade_statistics,
+            fetch_statistics.requests,
+        )
+        self.__report_dataset(
+            CLIENT_TYPE_DATASET.title,
+            client_type_statistics,
+            client_type_outcomes,
+        )
         self.report.information.extend(
             [
-                f"Client type inserted ➡️ {client_type_data_inserted}",
-                f"Client type catch success ➡️ {success}",
-                f"Client type catch failure ➡️ {failure}",
+                f"Client type skipped ➡️ \
+{trade_statistics.batches - client_type_outcomes}",
+                f"Daily data requests ➡️ \
+{fetch_statistics.requests + client_type_outcomes}",
             ]
         )
+        self.__report_pipeline("Daily data", fetch_statistics, trade_statistics, writer)
 
-    async def __update_trade_data(self, instruments: list[InstrumentIdentification]):
-        """Gets and updates trade data"""
-        max_record_dates = self.__get_max_trade_data_dates()
-        success = 0
-        failure = 0
-        trade_data_inserted = 0
-        new_batch_data = []
-        async with tsetmc.TsetmcScraper() as scraper:
-            for instrument in instruments:
-                previous_last_record = next(
-                    (x for x in max_record_dates if x.isin == instrument.isin), None
-                )
-                try:
-                    self._logger.info("Catching trade data for %s", repr(instrument))
-                    trade_data = await scraper.get_closing_price_daily_list(
-                        tsetmc_code=instrument.tsetmc_code
-                    )
-                    success += 1
-                except (httpx.RequestError, tsetmc.TsetmcScrapeException):
-                    self._logger.error(
-                        "Catching trade data failed for %s", repr(instrument)
-                    )
-                    failure += 1
-                    continue
-                new_data = [
-                    self.trade_data_tsetmc_to_db(isin=instrument.isin, tsetmc_data=x)
-                    for x in trade_data
-                    if x.trade_volume > 0
-                    and (
-                        previous_last_record is None
-                        or x.last_trade_datetime.date()
-                        > previous_last_record.record_date
-                    )
-                ]
-                new_batch_data.extend(new_data)
-                if len(new_batch_data) > self._update_chunk_len:
-                    trade_data_inserted += self.insert_data_batch_in_database(
-                        new_batch_data
-                    )
-            if new_batch_data:
-                trade_data_inserted += self.insert_data_batch_in_database(
-                    new_batch_data
-                )
+    async def __fetch_single_pass(
+        self,
+        scraper: tsetmc.TsetmcScraper,
+        instrument: InstrumentIdentification,
+        client_type_last_record_date: date,
+    ) -> _SinglePassResult:
+        """
+        Fetches trade data of an instrument, and its client type data \
+        only if a day has been traded after the client type watermark. \
+        Data missing from the replayed response cache is left as None.
+        """
+        self._logger.info("Catching daily data for %s", repr(instrument))
+        result = _SinglePassResult(
+            trade_data=await self.traffic_controller.request_or_skip(
+                TSETMC_HOST,
+                lambda: TRADE_DATASET.fetch(scraper, instrument.tsetmc_code),
+            )
+        )
+        if result.trade_data is None:
+            result.client_type_skipped = True
+            return result
+        last_traded_date = max(
+            (
+                TRADE_DATASET.record_date(x)
+                for x in result.trade_data
+                if TRADE_DATASET.has_trades(x)
+            ),
+            default=None,
+        )
+        if last_traded_date is None or (
+            client_type_last_record_date is not None
+            and last_traded_date <= client_type_last_record_date
+        ):
+            result.client_type_skipped = True
+            return result
+        try:
+            result.client_type_data = await self.traffic_controller.request_or_skip(
+                TSETMC_HOST,
+                lambda: CLIENT_TYPE_DATASET.fetch(scraper, instrument.tsetmc_code),
+            )
+            result.client_type_skipped = result.client_type_data is None
+        except (httpx.RequestError, tsetmc.TsetmcScrapeException) as exc:
+            result.client_type_exception = exc
+        return result
+
+    def __create_writer(self) -> BackgroundWriter[_WriteUnit]:
+        """Creates the background writer of the daily tables"""
+        return BackgroundWriter(
+            write=self.insert_data_batch_in_database,
+            size=lambda unit: len(unit.rows),
+            flush_size=self._update_chunk_len,
+            flush_interval=self._update_interval,
+            queue_size=self._write_queue_size,
+        )
+
+    def __report_dataset(
+        self, title: str, convert_statistics: StageStatistics, outcomes: int
+    ) -> None:
+        """
+        Adds the results of a dataset to the report, \
+        the outcomes being neither successful nor skipped counted as failures
+        """
         self.report.information.extend(
             [
-                f"Trade data inserted ➡️ {trade_data_inserted}",
-                f"Trade catch success ➡️ {success}",
-                f"Trade catch failure ➡️ {failure}",
+                f"{title} inserted ➡️ {convert_statistics.items}",
+                f"{title} catch success ➡️ {convert_statistics.batches}",
+                f"{title} catch skipped ➡️ {self.skipped[title]}",
+                f"{title} catch failure ➡️ \
+{outcomes - convert_statistics.batches - self.skipped[title]}",
             ]
         )
 
-    @classmethod
-    def client_type_data_tsetmc_to_db(
-        cls, isin: str, tsetmc_data: tsetmc.ClientTypeDaily
-    ) -> DailyClientType:
-        """Converts Tsetmc trade data to database model"""
-        return DailyClientType(
+    def __report_pipeline(
+        self,
+        title: str,
+        fetch_statistics: FetchStatistics,
+        convert_statistics: StageStatistics,
+        writer: BackgroundWriter,
+    ) -> None:
+        """Adds the throughput of the pipeline stages to the report"""
+        self.report.information.extend(
+            [
+                f"{title} catch time ➡️ {fetch_statistics.elapsed:.1f}s",
+                f"{title} catch rate ➡️ \
+{fetch_statistics.requests_per_second:.2f} req/s",
+                f"{title} deferred retries ➡️ {fetch_statistics.deferred_retries}",
+                f"{title} convert rate ➡️ \
+{convert_statistics.items_per_second:.0f} rows/s",
+                f"{title} write rate ➡️ \
+{writer.statistics.items_per_second:.0f} rows/s \
+({writer.statistics.batches} flushes, {writer.statistics.busy_time:.1f}s)",
+                f"{title} queue high-water mark ➡️ \
+{writer.queue_high_water_mark}/{writer.queue_size}",
+            ]
+        )
+
+    def __convert_outcome(
+        self,
+        dataset: Dataset,
+        outcome: FetchOutcome[InstrumentIdentification, list[Any]],
+        previous_last_record_date: date,
+        statistics: StageStatistics,
+    ) -> _WriteUnit:
+        """
+        Converts a fetch outcome to the new rows \
+        and the watermark of the instrument. \
+        Requests missing from the replayed response cache are skipped, \
+        leaving the watermark as it is.
+        """
+        instrument = outcome.item
+        if outcome.succeeded and outcome.result is None:
+            self._logger.info(
+                "Skipping %s for %s, which is not cached",
+                dataset.title.lower(),
+                repr(instrument),
+            )
+            self.skipped[dataset.title] += 1
+            return self.__checkpoint_unit(
+                dataset, instrument.isin, CheckpointStatus.SKIPPED
+            )
+        if not outcome.succeeded:
+            self._logger.error(
+                "Catching %s failed for %s",
+                dataset.title.lower(),
+                repr(instrument),
+            )
+            return _WriteUnit(
+                model=dataset.model,
+                rows=ColumnBatch(dataset.model),
+                watermark=watermark_row(
+                    isin=instrument.isin,
+                    dataset=dataset.watermark,
+                    last_record_date=previous_last_record_date,
+                    status=WatermarkStatus.FAILURE,
+                ),
+                checkpoint=self.__checkpoint(
+                    dataset, instrument.isin, CheckpointStatus.FAILED
+                ),
+            )
+        started = time.perf_counter()
+        new_data = self.filter_new_data(
+            dataset=dataset,
+            isin=instrument.isin,
+            tsetmc_data=outcome.result,
+            previous_last_record_date=previous_last_record_date,
+        )
+        statistics.record(len(new_data), time.perf_counter() - started)
+        return _WriteUnit(
+            model=dataset.model,
+            rows=new_data,
+            watermark=watermark_row(
+                isin=instrument.isin,
+                dataset=dataset.watermark,
+                last_record_date=max(
+                    new_data.column("record_date"),
+                    default=previous_last_record_date,
+                ),
+                status=WatermarkStatus.SUCCESS,
+            ),
+            checkpoint=self.__checkpoint(
+                dataset, instrument.isin, CheckpointStatus.SUCCEEDED
+            ),
+        )
+
+    def __checkpoint(
+        self, dataset: Dataset, isin: str, status: CheckpointStatus
+    ) -> dict[str, Any]:
+        """Builds the checkpoint of an instrument, if the run is checkpointed"""
+        if not self.run_id:
+            return None
+        return checkpoint_row(
+            run_id=self.run_id,
+            dataset=dataset.watermark.value,
             isin=isin,
-            record_date=tsetmc_data.record_date,
-            legal_buy_num=tsetmc_data.legal.buy.num,
-            legal_buy_value=tsetmc_data.legal.buy.value,
-            legal_buy_volume=tsetmc_data.legal.buy.volume,
-            legal_sell_num=tsetmc_data.legal.sell.num,
-            legal_sell_value=tsetmc_data.legal.sell.value,
-            legal_sell_volume=tsetmc_data.legal.sell.volume,
-            natural_buy_num=tsetmc_data.natural.buy.num,
-            natural_buy_value=tsetmc_data.natural.buy.value,
-            natural_buy_volume=tsetmc_data.natural.buy.volume,
-            natural_sell_num=tsetmc_data.natural.sell.num,
-            natural_sell_value=tsetmc_data.natural.sell.value,
-            natural_sell_volume=tsetmc_data.natural.sell.volume,
+            status=status,
+        )
+
+    def __checkpoint_unit(
+        self, dataset: Dataset, isin: str, status: CheckpointStatus
+    ) -> _WriteUnit:
+        """Creates a unit that only checkpoints a dataset of an instrument"""
+        return _WriteUnit(
+            model=dataset.model,
+            rows=ColumnBatch(dataset.model),
+            checkpoint=self.__checkpoint(dataset, isin, status),
         )
 
     @classmethod
-    def trade_data_tsetmc_to_db(
-        cls, isin: str, tsetmc_data: tsetmc.ClosingPriceDaily
-    ) -> DailyTradeCandle:
-        """Converts Tsetmc trade data to database model"""
-        return DailyTradeCandle(
-            isin=isin,
-            record_date=tsetmc_data.last_trade_datetime.date(),
-            previous_price=tsetmc_data.previous_price,
-            open_price=tsetmc_data.open_price,
-            max_price=tsetmc_data.max_price,
-            min_price=tsetmc_data.min_price,
-            close_price=tsetmc_data.close_price,
-            last_price=tsetmc_data.last_price,
-            trade_num=tsetmc_data.trade_num,
-            trade_value=tsetmc_data.trade_value,
-            trade_volume=tsetmc_data.trade_volume,
+    def filter_new_data(
+        cls,
+        dataset: Dataset,
+        isin: str,
+        tsetmc_data: list[Any],
+        previous_last_record_date: date,
+    ) -> ColumnBatch:
+        """Converts the traded days after the previous last record to rows"""
+        return ColumnBatch(
+            dataset.model,
+            (
+                dataset.to_db(isin=isin, tsetmc_data=x)
+                for x in tsetmc_data
+                if dataset.has_trades(x)
+                and (
+                    previous_last_record_date is None
+                    or dataset.record_date(x) > previous_last_record_date
+                )
+            ),
         )
 
-    def insert_data_batch_in_database(
-        self, new_batch_data: list[DailyTradeCandle]
-    ) -> int:
-        """Inserts a batch of trade data into database"""
+    def insert_data_batch_in_database(self, units: list[_WriteUnit]) -> int:
+        """
+        Inserts a batch of trade and client type rows into database, \
+        along with the watermarks of the instruments they belong to \
+        and their checkpoints, stamped as committed by this batch. \
+        Runs on the background writer's thread.
+        """
+        row_num = 0
+        committed_at = datetime.now()
         with get_tse_market_session() as session:
-            session.add_all(new_batch_data)
-            self._logger.info(
-                "Inserting %d data rows into database.", len(new_batch_data)
+            for model in dict.fromkeys(x.model for x in units):
+                new_batches = [x.rows for x in units if x.model is model]
+                self._logger.info(
+                    "Inserting %d %s rows into database.",
+                    sum(len(x) for x in new_batches),
+                    model.__name__,
+                )
+                row_num += bulk_insert(
+                    session=session,
+                    model=model,
+                    rows=chain.from_iterable(x.rows() for x in new_batches),
+                    batch_size=self._insert_batch_size,
+                    upsert=bool(self.job_description.upsert),
+                )
+            save_watermarks(
+                session=session, watermarks=[x.watermark for x in units if x.watermark]
+            )
+            save_checkpoints(
+                session=session,
+                checkpoints=[
+                    x.checkpoint | {"committed_at": committed_at}
+                    for x in units
+                    if x.checkpoint
+                ],
             )
-            row_num = len(new_batch_data)
+            if self.run_id:
+                renew_run_lease(session=session, run_id=self.run_id, at=committed_at)
             session.commit()
-            new_batch_data.clear()
-            return row_num
+        return row_num
 
-    def __get_max_client_type_data_dates(self) -> list[DailyClientType]:
-        """Gets max previous record date of client type data for each instrument"""
-        with get_tse_market_session() as session:
-            # pylint: disable=not-callable
-            # sqlalchemy.func.max is indeed callable
-            subq = (
-                session.query(
-                    DailyClientType.isin,
-                    sqlalchemy.func.max(DailyClientType.record_date).label("maxdate"),
-                )
-                .group_by(DailyClientType.isin)
-                .subquery("t2")
+    async def __update_datasets(
+        self, instruments: list[InstrumentIdentification]
+    ) -> None:
+        """Gets and updates the datasets of the job for the instruments"""
+        if (
+            self.job_description.single_pass
+            and self.job_description.get_trade_data
+            and self.job_description.get_client_type_data
+        ):
+            await self.__update_datasets_single_pass(instruments)
+        else:
+            if self.job_description.get_trade_data:
+                await self.__update_dataset(instruments, TRADE_DATASET)
+            if self.job_description.get_client_type_data:
+                await self.__update_dataset(instruments, CLIENT_TYPE_DATASET)
+
+    async def __start_run(
+        self, instruments: list[InstrumentIdentification]
+    ) -> list[InstrumentIdentification]:
+        """
+        Starts a checkpointed run and gets the instruments it has to process. \
+        Resumes today's unfinished run with its pending instruments, \
+        or retries the failed instruments of the last run as a sub-run, \
+        otherwise starts a run with the instruments due by the polling policy \
+        and those left pending by the abandoned runs.
+        """
+        datasets = [
+            x
+            for x, enabled in (
+                (TRADE_DATASET, self.job_description.get_trade_data),
+                (CLIENT_TYPE_DATASET, self.job_description.get_client_type_data),
             )
-            query = session.query(DailyClientType).join(
-                subq,
-                sqlalchemy.and_(
-                    DailyClientType.isin == subq.c.isin,
-                    DailyClientType.record_date == subq.c.maxdate,
-                ),
+            if enabled
+        ]
+        parent_run_id = None
+        async with get_tse_market_async_session() as session:
+            if self.job_description.retry_failed:
+                parent_run_id = await session.run_sync(find_last_run, self._worker)
+                instruments = await self.__filter_run_instruments(
+                    session, instruments, parent_run_id, CheckpointStatus.FAILED
+                )
+                self.report.information.append(f"Retried run ➡️ {parent_run_id}")
+            else:
+                leftover_isins = set()
+                if self.job_description.resume:
+                    self.run_id, leftover_isins = await self.__claim_running_runs(
+                        session
+                    )
+                if self.run_id:
+                    self.report.information.append(f"Resumed run ➡️ {self.run_id}")
+                    instruments = await self.__filter_run_instruments(
+                        session, instruments, self.run_id, CheckpointStatus.PENDING
+                    )
+                    await session.run_sync(take_over_run, self.run_id)
+                    await session.commit()
+                    return instruments
+                if not self.job_description.force_full:
+                    due = await self.__apply_polling_policy(instruments)
+                    due_isins = {x.isin for x in due}
+                    instruments = due + [
+                        x
+                        for x in instruments
+                        if x.isin in leftover_isins and x.isin not in due_isins
+                    ]
+            self.run_id = await session.run_sync(
+                start_run,
+                self._worker,
+                [(x.watermark.value, y.isin) for x in datasets for y in instruments],
+                parent_run_id,
             )
-            max_record_dates = query.all()
-        return max_record_dates
+            await session.commit()
+        self.report.information.append(f"Run id ➡️ {self.run_id}")
+        return instruments
 
-    def __get_max_trade_data_dates(self) -> list[DailyTradeCandle]:
-        """Gets max previous record date of trade data for each instrument"""
-        with get_tse_market_session() as session:
-            # pylint: disable=not-callable
-            # sqlalchemy.func.max is indeed callable
-            subq = (
-                session.query(
-                    DailyTradeCandle.isin,
-                    sqlalchemy.func.max(DailyTradeCandle.record_date).label("maxdate"),
+    async def __claim_running_runs(self, session: AsyncSession) -> tuple[int, set[str]]:
+        """
+        Gets the run to resume, if any, and the isins left pending \
+        by the runs it abandons. A run whose lease is still alive belongs \
+        to another live process, so the task fails rather than catching \
+        the same instruments twice, unless the run was left on this host \
+        by a previous process, which is taken over right away. \
+        The latest run is resumed if it started in the current cron window, \
+        that is today, and the other runs are abandoned.
+        """
+        now = datetime.now()
+        runs = await session.run_sync(find_running_runs, self._worker)
+        for run in runs:
+            if (
+                run.heartbeat_at is not None
+                and now - run.heartbeat_at < self._run_lease
+                and not is_left_by_previous_process(run)
+            ):
+                raise line.TaskException(
+                    f"Run {run.catch_run_id} is still running on {run.owner_host}, \
+last heartbeat at {run.heartbeat_at:%H:%M:%S}."
                 )
-                .group_by(DailyTradeCandle.isin)
-                .subquery("t2")
+        window_start = datetime.combine(now.date(), datetime.min.time())
+        resumed_run_id = (
+            runs[0].catch_run_id
+            if runs and runs[0].started_at >= window_start
+            else None
+        )
+        abandoned_run_ids = [
+            x.catch_run_id for x in runs if x.catch_run_id != resumed_run_id
+        ]
+        leftover_isins = set()
+        for run_id in abandoned_run_ids:
+            items = await session.run_sync(
+                load_run_items, run_id, [CheckpointStatus.PENDING]
             )
-            query = session.query(DailyTradeCandle).join(
-                subq,
-                sqlalchemy.and_(
-                    DailyTradeCandle.isin == subq.c.isin,
-                    DailyTradeCandle.record_date == subq.c.maxdate,
-                ),
+            leftover_isins.update(isin for _, isin in items)
+        await session.run_sync(abandon_runs, abandoned_run_ids)
+        if abandoned_run_ids:
+            self.report.information.extend(
+                [
+                    f"Abandoned runs ➡️ {', '.join(map(str, abandoned_run_ids))}",
+                    f"Leftover instruments ➡️ {len(leftover_isins)}",
+                ]
+            )
+        return resumed_run_id, leftover_isins
+
+    async def __filter_run_instruments(
+        self,
+        session: AsyncSession,
+        instruments: list[InstrumentIdentification],
+        run_id: int,
+        status: CheckpointStatus,
+    ) -> list[InstrumentIdentification]:
+        """Keeps the instruments with any dataset in status in a run"""
+        items = (
+            await session.run_sync(load_run_items, run_id, [status]) if run_id else []
+        )
+        isins = {isin for _, isin in items}
+        instruments = [x for x in instruments if x.isin in isins]
+        self.report.information.append(
+            f"{status.name.capitalize()} instruments ➡️ {len(instruments)}"
+        )
+        return instruments
+
+    async def __apply_polling_policy(
+        self, instruments: list[InstrumentIdentification]
+    ) -> list[InstrumentIdentification]:
+        """
+        Keeps the instruments that are due according to the polling policy, \
+        the most actively traded first
+        """
+        activities = await self.__get_instrument_activities(instruments)
+        schedule = self._polling_policy.schedule(activities)
+        by_isin = {x.isin: x for x in instruments}
+        self.report.information.extend(
+            [
+                f"Polling cadence ➡️ {schedule.cadences_summary()}",
+                f"Skipped by policy ➡️ {len(schedule.skipped)}",
+            ]
+        )
+        return [by_isin[x] for x in schedule.due]
+
+    async def __get_instrument_activities(
+        self, instruments: list[InstrumentIdentification]
+    ) -> list[InstrumentActivity]:
+        """
+        Gets the last traded day and the last trade fetch from data_watermark, \
+        and the number of recently traded days from the rows of daily_trade_candle \
+        within the activity window, sought through its (isin, record_date) key
+        """
+        # pylint: disable=not-callable
+        # sqlalchemy.func members are generated dynamically
+        window_start = date.today() - timedelta(days=self._activity_window_days)
+        activities = {x.isin: InstrumentActivity(key=x.isin) for x in instruments}
+        isins = list(activities)
+        async with get_tse_market_async_session() as session:
+            for i in range(0, len(isins), self._activity_chunk_len):
+                trades = await session.execute(
+                    sqlalchemy.select(DailyTradeCandle.isin, sqlalchemy.func.count())
+                    .where(
+                        DailyTradeCandle.isin.in_(
+                            isins[i : i + self._activity_chunk_len]
+                        ),
+                        DailyTradeCandle.record_date >= window_start,
+                    )
+                    .group_by(DailyTradeCandle.isin)
+                )
+                for isin, recent_trade_days in trades:
+                    activities[isin].recent_trade_days = int(recent_trade_days)
+            watermarks = await session.execute(
+                sqlalchemy.select(
+                    DataWatermark.isin,
+                    DataWatermark.last_record_date,
+                    DataWatermark.last_fetch_at,
+                    DataWatermark.last_status,
+                ).where(DataWatermark.dataset == WatermarkDataset.TRADE.value)
             )
-            max_record_dates = query.all()
-        return max_record_dates
+        for isin, last_trade_date, last_fetch_at, last_status in watermarks:
+            if isin in activities:
+                activities[isin].last_trade_date = last_trade_date
+                activities[isin].last_fetch_at = last_fetch_at
+                activities[isin].last_fetch_failed = (
+                    last_status == WatermarkStatus.FAILURE.value
+                )
+        return list(activities.values())
+
+    async def __get_watermarks(self, dataset: WatermarkDataset) -> dict[str, date]:
+        """Gets last stored record date of a dataset for each instrument"""
+        async with get_tse_market_async_session() as session:
+            return await session.run_sync(load_watermarks, dataset)
 
     @classmethod
-    def get_instruments(
+    async def get_instruments(
         cls, search_by_instrument: str, search_by_type: int
     ) -> list[InstrumentIdentification]:
         """List instruments according to the search_by identifier"""
-        with get_tse_market_session() as session:
+        async with get_tse_market_async_session() as session:
             if search_by_instrument:
-                return (
-                    session.query(InstrumentIdentification)
-                    .filter(
-                        sqlalchemy.or_(
-                            InstrumentIdentification.isin == search_by_instrument,
-                            InstrumentIdentification.ticker.contains(
-                                search_by_instrument
-                            ),
+                return list(
+                    await session.scalars(
+                        sqlalchemy.select(InstrumentIdentification).filter(
+                            sqlalchemy.or_(
+                                InstrumentIdentification.isin == search_by_instrument,
+                                InstrumentIdentification.ticker.contains(
+                                    search_by_instrument
+                                ),
+                            )
                         )
                     )
-                    .all()
                 )
             if search_by_type:
-                return (
-                    session.query(InstrumentIdentification)
-                    .filter(
-                        sqlalchemy.or_(
+                return list(
+                    await session.scalars(
+                        sqlalchemy.select(InstrumentIdentification).filter(
                             InstrumentIdentification.instrument_type_id
                             == search_by_type,
                         )
                     )
-                    .all()
                 )
-            all_instruments = session.query(InstrumentIdentification).all()
+            all_instruments = await session.scalars(
+                sqlalchemy.select(InstrumentIdentification)
+            )
             return [
                 instrument
                 for instrument in all_instruments
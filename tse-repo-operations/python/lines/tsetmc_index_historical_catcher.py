@@ -2,129 +2,276 @@
 Using the line implementation in this module, \
 one can fetch daily historical data for indices from TSETMC.
 """
+from dataclasses import dataclass
+from datetime import date
+from functools import partial
+from typing import Any
+import time
 import httpx
 import sqlalchemy
 from telegram_task import line
 from tse_utils import tsetmc
+from utils.concurrency import FetchOutcome, FetchStatistics
+from utils.pipeline import BackgroundWriter, StageStatistics, fetch_into_writer
+from utils.traffic import TrafficControlled, TSETMC_HOST, traffic_report
+from tse_utils_db.batch import ColumnBatch
+from tse_utils_db.bulk import bulk_insert
+from tse_utils_db.watermark import (
+    WatermarkDataset,
+    WatermarkStatus,
+    load_watermarks,
+    save_watermarks,
+    watermark_row,
+)
 from tse_utils_db.tse_market import (
     get_tse_market_session,
+    get_tse_market_async_session,
     IndexIdentification,
     DailyIndexValue,
 )
 
 
-class TsetmcIndexHistoricalCatcher(line.Worker):
+@dataclass
+class JobDescription(line.JobDescription):
+    """Overriden JobDescription for module tsetmc_index_historical_catcher"""
+
+    upsert: bool = None
+    concurrency: int = None
+
+
+class TsetmcIndexHistoricalCatcher(TrafficControlled, line.Worker):
     """Overriden worker for module tsetmc_index_historical_catcher"""
 
-    async def perform_task(
-        self, job_description: line.JobDescription
-    ) -> line.JobReport:
+    _insert_batch_size: int = 1000
+    _update_chunk_len: int = 10000
+    _update_interval: float = 5.0
+    _write_queue_size: int = 64
+
+    async def perform_task(self, job_description: JobDescription) -> line.JobReport:
         """Performs the task using the provided job description"""
+        started = time.perf_counter()
         report = line.JobReport()
-        indices, max_record_dates = self.__get_indices()
+        indices, watermarks = await self.__get_indices()
         report.information.append(
             f"Indices count ➡️ {len(indices)}",
         )
         await self.__update_historical_data(
-            indices=indices, max_record_dates=max_record_dates, report=report
+            indices=indices,
+            watermarks=watermarks,
+            report=report,
+            job_description=job_description,
         )
+        report.information.append(f"Total time ➡️ {time.perf_counter() - started:.1f}s")
         return report
 
     @classmethod
-    def default_job_description(cls) -> line.JobDescription:
+    def default_job_description(cls) -> JobDescription:
         """Creates the default job description for this worker"""
-        return line.JobDescription()
+        return JobDescription(upsert=True, concurrency=4)
 
     async def __update_historical_data(
         self,
         indices: list[IndexIdentification],
-        max_record_dates: list[DailyIndexValue],
+        watermarks: dict[str, date],
         report: line.JobReport,
+        job_description: JobDescription,
     ) -> None:
-        """Fetches Tsetmc data and adds new data to database"""
-        success = 0
-        failure = 0
-        new_batch_data = []
-        async with tsetmc.TsetmcScraper() as scraper:
-            for index in indices:
-                previous_last_record = next(
-                    (x for x in max_record_dates if x.isin == index.isin), None
+        """
+        Fetches Tsetmc data of the indices concurrently and streams \
+        the new data to database in chunks through a background writer
+        """
+        fetch_statistics = FetchStatistics()
+        convert_statistics = StageStatistics()
+        write_failures: list[str] = []
+        skipped: list[str] = []
+        writer = BackgroundWriter(
+            write=lambda units: self.insert_batch_in_database(
+                units, upsert=bool(job_description.upsert), failures=write_failures
+            ),
+            size=lambda unit: len(unit[0]),
+            flush_size=self._update_chunk_len,
+            flush_interval=self._update_interval,
+            queue_size=self._write_queue_size,
+        )
+        async with self.http_clients.tsetmc_scraper() as scraper, writer:
+
+            async def fetch(index: IndexIdentification) -> list[tsetmc.IndexDaily]:
+                self._LOGGER.info("Catching historical data for %s", repr(index))
+                return await self.traffic_controller.request_or_skip(
+                    TSETMC_HOST,
+                    partial(scraper.get_index_history, tsetmc_code=index.tsetmc_code),
                 )
-                try:
-                    self._LOGGER.info("Catching historical data for %s", repr(index))
-                    index_data = await scraper.get_index_history(
-                        tsetmc_code=index.tsetmc_code
-                    )
-                    success += 1
-                except (httpx.RequestError, tsetmc.TsetmcScrapeException):
-                    self._LOGGER.error(
-                        "Catching historical data failed for %s", repr(index)
-                    )
-                    failure += 1
-                    continue
-                new_data = [
-                    self.index_data_tsetmc_to_db(isin=index.isin, tsetmc_data=x)
-                    for x in index_data
-                    if (
-                        previous_last_record is None
-                        or x.record_date > previous_last_record.record_date
-                    )
-                ]
-                new_batch_data.extend(new_data)
-        if new_batch_data:
-            self.insert_batch_in_database(new_batch_data)
+
+            await fetch_into_writer(
+                writer=writer,
+                convert=lambda outcome: self.__convert_outcome(
+                    outcome,
+                    watermarks.get(outcome.item.isin),
+                    convert_statistics,
+                    skipped,
+                ),
+                items=indices,
+                fetcher=fetch,
+                concurrency=job_description.concurrency,
+                expected_exceptions=(httpx.RequestError, tsetmc.TsetmcScrapeException),
+                statistics=fetch_statistics,
+                deferred_retries=self.traffic_controller.policy.deferred_retries,
+            )
+        chunks = writer.statistics
         report.information.extend(
             [
-                f"Historical data inserted ➡️ {len(new_batch_data)}",
-                f"Index catch success ➡️ {success}",
-                f"Index catch failure ➡️ {failure}",
+                f"Historical data inserted ➡️ {chunks.items}",
+                f"Index catch success ➡️ {convert_statistics.batches}",
+                f"Index catch skipped ➡️ {len(skipped)}",
+                f"Index catch failure ➡️ \
+{fetch_statistics.requests - convert_statistics.batches - len(skipped)}",
+                f"Index write failure ➡️ {len(write_failures)}",
+                f"Index catch time ➡️ {fetch_statistics.elapsed:.1f}s \
+({fetch_statistics.requests_per_second:.2f} req/s)",
+                f"Index deferred retries ➡️ {fetch_statistics.deferred_retries}",
+                f"Index chunks ➡️ {chunks.batches} \
+({chunks.items / chunks.batches if chunks.batches else 0:.0f} rows on average, \
+{chunks.max_batch_items} at most)",
+                f"Index write rate ➡️ {chunks.items_per_second:.0f} rows/s \
+({chunks.busy_time:.1f}s)",
+                f"Index queue high-water mark ➡️ \
+{writer.queue_high_water_mark}/{writer.queue_size}",
             ]
+            + traffic_report(self.traffic_controller, self.http_clients, TSETMC_HOST)
         )
 
-    def insert_batch_in_database(self, new_batch_data: list[DailyIndexValue]) -> int:
-        """Inserts a batch of index data into database"""
-        with get_tse_market_session() as session:
-            session.add_all(new_batch_data)
+    def __convert_outcome(
+        self,
+        outcome: FetchOutcome[IndexIdentification, list[tsetmc.IndexDaily]],
+        previous_last_record_date: date,
+        statistics: StageStatistics,
+        skipped: list[str],
+    ) -> tuple[ColumnBatch, dict[str, Any]]:
+        """
+        Converts a fetch outcome to the new rows \
+        and the watermark of the index. Indices missing from \
+        the replayed response cache are added to skipped and converted to None.
+        """
+        index = outcome.item
+        if outcome.succeeded and outcome.result is None:
             self._LOGGER.info(
-                "Inserting %d DailyIndexValue rows into database.", len(new_batch_data)
+                "Skipping historical data for %s, which is not cached", repr(index)
             )
-            row_num = len(new_batch_data)
-            session.commit()
-            return row_num
+            skipped.append(index.isin)
+            return None
+        if not outcome.succeeded:
+            self._LOGGER.error("Catching historical data failed for %s", repr(index))
+            return (
+                ColumnBatch(DailyIndexValue),
+                watermark_row(
+                    isin=index.isin,
+                    dataset=WatermarkDataset.INDEX,
+                    last_record_date=previous_last_record_date,
+                    status=WatermarkStatus.FAILURE,
+                ),
+            )
+        started = time.perf_counter()
+        new_data = self.filter_new_data(
+            isin=index.isin,
+            tsetmc_data=outcome.result,
+            previous_last_record_date=previous_last_record_date,
+        )
+        statistics.record(len(new_data), time.perf_counter() - started)
+        return (
+            new_data,
+            watermark_row(
+                isin=index.isin,
+                dataset=WatermarkDataset.INDEX,
+                last_record_date=max(
+                    new_data.column("record_date"),
+                    default=previous_last_record_date,
+                ),
+                status=WatermarkStatus.SUCCESS,
+            ),
+        )
+
+    def insert_batch_in_database(
+        self,
+        units: list[tuple[ColumnBatch, dict[str, Any]]],
+        upsert: bool = False,
+        failures: list[str] = None,
+    ) -> int:
+        """
+        Inserts a chunk of index data into database, committing each index \
+        along with its watermark in a transaction of its own, so that \
+        a failing index loses only its own rows and keeps its watermark, \
+        to be caught again on the next run. The failing indices are added \
+        to failures. Runs on the background writer's thread.
+        """
+        started = time.perf_counter()
+        row_num = 0
+        with get_tse_market_session() as session:
+            for rows, watermark in units:
+                try:
+                    inserted = bulk_insert(
+                        session=session,
+                        model=DailyIndexValue,
+                        rows=rows.rows(),
+                        batch_size=self._insert_batch_size,
+                        upsert=upsert,
+                    )
+                    save_watermarks(session=session, watermarks=[watermark])
+                    session.commit()
+                except sqlalchemy.exc.SQLAlchemyError:
+                    session.rollback()
+                    self._LOGGER.exception(
+                        "Inserting historical data failed for %s", watermark["isin"]
+                    )
+                    if failures is not None:
+                        failures.append(watermark["isin"])
+                    continue
+                row_num += inserted
+        self._LOGGER.info(
+            "Inserted %d DailyIndexValue rows of %d indices in %.2fs.",
+            row_num,
+            len(units),
+            time.perf_counter() - started,
+        )
+        return row_num
+
+    @classmethod
+    def filter_new_data(
+        cls,
+        isin: str,
+        tsetmc_data: list[tsetmc.IndexDaily],
+        previous_last_record_date: date,
+    ) -> ColumnBatch:
+        """Converts the days after the previous last record to rows"""
+        return ColumnBatch(
+            DailyIndexValue,
+            (
+                cls.index_data_tsetmc_to_db(isin=isin, tsetmc_data=x)
+                for x in tsetmc_data
+                if previous_last_record_date is None
+                or x.record_date > previous_last_record_date
+            ),
+        )
 
     @classmethod
     def index_data_tsetmc_to_db(
         cls, isin: str, tsetmc_data: tsetmc.IndexDaily
-    ) -> DailyIndexValue:
-        """Converts tsetmc index data to database model"""
-        return DailyIndexValue(
-            isin=isin,
-            record_date=tsetmc_data.record_date,
-            max_value=tsetmc_data.max_value,
-            min_value=tsetmc_data.min_value,
-            close_value=tsetmc_data.close_value,
-        )
+    ) -> dict[str, Any]:
+        """Converts tsetmc index data to a daily_index_value row"""
+        return {
+            "isin": isin,
+            "record_date": tsetmc_data.record_date,
+            "max_value": tsetmc_data.max_value,
+            "min_value": tsetmc_data.min_value,
+            "close_value": tsetmc_data.close_value,
+        }
 
-    def __get_indices(self) -> tuple[list[IndexIdentification], DailyIndexValue]:
-        """Gets list of indices from database"""
-        with get_tse_market_session() as session:
-            indices = session.query(IndexIdentification).all()
-            # pylint: disable=not-callable
-            # sqlalchemy.func.max is indeed callable
-            subq = (
-                session.query(
-                    DailyIndexValue.isin,
-                    sqlalchemy.func.max(DailyIndexValue.record_date).label("maxdate"),
-                )
-                .group_by(DailyIndexValue.isin)
-                .subquery("t2")
-            )
-            query = session.query(DailyIndexValue).join(
-                subq,
-                sqlalchemy.and_(
-                    DailyIndexValue.isin == subq.c.isin,
-                    DailyIndexValue.record_date == subq.c.maxdate,
-                ),
+    async def __get_indices(
+        self,
+    ) -> tuple[list[IndexIdentification], dict[str, date]]:
+        """Gets list of indices and their last stored record dates from database"""
+        async with get_tse_market_async_session() as session:
+            indices = list(
+                await session.scalars(sqlalchemy.select(IndexIdentification))
             )
-            max_record_dates = query.all()
-            return indices, max_record_dates
+            watermarks = await session.run_sync(load_watermarks, WatermarkDataset.INDEX)
+            return indices, watermarks
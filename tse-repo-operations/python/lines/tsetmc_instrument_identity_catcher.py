@@ -3,17 +3,17 @@ Using the line implementation in this module, \
 one can update the instrument identity data from TSETMC.
 """
 from dataclasses import dataclass
-import logging
 import httpx
-from sqlalchemy.orm import Session
+import sqlalchemy
+from sqlalchemy.orm import selectinload
 from telegram_task import line
 from tse_utils import tsetmc
+from utils.dimensions import DimensionChanges, reconcile_dimensions
+from utils.response_cache import CacheMissError
+from utils.traffic import TrafficControlled, TrafficControlledShift, TSETMC_HOST
 from tse_utils_db.tse_market import (
-    get_tse_market_session,
-    InstrumentIdentification,
-    IndustrySector,
-    IndustrySubSector,
-    ExchangeMarket
+    get_tse_market_async_session,
+    InstrumentIdentification
 )
 
 
@@ -23,14 +23,16 @@ class JobDescription(line.JobDescription):
     search_by: str = None
 
 
-class TsetmcInstrumentIdentityCatcher(line.Worker):
+class TsetmcInstrumentIdentityCatcher(TrafficControlled, line.Worker):
     """Overriden worker for module tsetmc_instrument_identity_catcher"""
 
     async def perform_task(self, job_description: JobDescription) -> line.JobReport:
         """Performs the task using the provided job description"""
         return await _Shift(
             job_description=job_description,
-            logger=self._LOGGER
+            logger=self._LOGGER,
+            traffic_controller=self.traffic_controller,
+            http_clients=self.http_clients
         ).perform_task()
 
     @classmethod
@@ -41,21 +43,17 @@ class TsetmcInstrumentIdentityCatcher(line.Worker):
         )
 
 
-class _Shift:
+class _Shift(TrafficControlledShift):
     """Internal class for simpler performance of the worker's task"""
 
-    def __init__(
-            self,
-            job_description: JobDescription,
-            logger: logging.Logger
-    ):
-        self._logger: logging.Logger = logger
-        self.job_description: JobDescription = job_description
-        self.report: line.JobReport = line.JobReport()
+    job_description: JobDescription
+    # Used until the endpoint's latencies are enough for the registry's
+    # latency transport to derive the read timeout
+    _cold_start_timeout: float = 10
 
     async def perform_task(self) -> line.JobReport:
         """Performs the task using the provided job description"""
-        matched_instruments = self.match_instruments(
+        matched_instruments = await self.match_instruments(
             self.job_description.search_by
         )
         match len(matched_instruments):
@@ -79,15 +77,22 @@ Multiple instruments were matched with your search parameter. Please choose one.
                     ])}
 """
                 )
-        self.add_updated_instrument_to_report(isin=matched_instruments[0].isin)
+        await self.add_updated_instrument_to_report(
+            isin=matched_instruments[0].isin
+        )
         return self.report
 
-    def add_updated_instrument_to_report(self, isin: str):
+    async def add_updated_instrument_to_report(self, isin: str):
         """Adds updated instrument data to report"""
-        with get_tse_market_session() as session:
-            instrument = session.query(InstrumentIdentification).where(
-                InstrumentIdentification.isin == isin
-            ).first()
+        async with get_tse_market_async_session() as session:
+            instrument = await session.scalar(
+                sqlalchemy.select(InstrumentIdentification).where(
+                    InstrumentIdentification.isin == isin
+                ).options(
+                    selectinload(InstrumentIdentification.industry_sub_sector),
+                    selectinload(InstrumentIdentification.exchange_market)
+                )
+            )
             self.report.information.extend([
                 f"Instrument ➡️ {tsetmc.ticker_with_tsetmc_homepage_link(
                     ticker=instrument.ticker,
@@ -118,69 +123,35 @@ Multiple instruments were matched with your search parameter. Please choose one.
         this method will fetch and update that instrument's data
         """
         tsetmc_identity = await self.__get_instrument_identity(instrument)
-        with get_tse_market_session() as session:
-            self.__handle_industry(tsetmc_identity, session)
-            self.__handle_exchange_market(tsetmc_identity, session)
-            db_instrument = session.query(InstrumentIdentification).where(
-                InstrumentIdentification.isin == instrument.isin
-            ).first()
-            db_instrument.industry_sub_sector_id = tsetmc_identity.sub_sector_code
-            db_instrument.exchange_market_id = tsetmc_identity.market_code
-            session.commit()
-
-    def __handle_exchange_market(
-        self,
-            tsetmc_identity: tsetmc.InstrumentIdentification,
-            session: Session
-    ) -> None:
-        """Checks if exchange market needs to be updated on database"""
-        current_exchange = session.query(ExchangeMarket).where(
-            ExchangeMarket.exchange_market_id == tsetmc_identity.market_code
-        ).first()
-        if not current_exchange:
-            self._logger.info(
-                "Adding exchange [%d]: [%s] to database.",
-                tsetmc_identity.market_code,
-                tsetmc_identity.market_title
+        async with get_tse_market_async_session() as session:
+            changes = await session.run_sync(
+                reconcile_dimensions,
+                [tsetmc_identity],
+                include_instruments=False
             )
-            session.add(ExchangeMarket(
-                exchange_market_id=tsetmc_identity.market_code,
-                title=tsetmc_identity.market_title
-            ))
-
-    def __handle_industry(
-            self,
-            tsetmc_identity: tsetmc.InstrumentIdentification,
-            session: Session
-    ) -> None:
-        """Checks if industry needs to be updated on database"""
-        current_sector = session.query(IndustrySector).where(
-            IndustrySector.industry_sector_id == tsetmc_identity.sector_code
-        ).first()
-        if not current_sector:
-            self._logger.info(
-                "Adding sector [%d]: [%s] to database.",
-                tsetmc_identity.sector_code,
-                tsetmc_identity.sector_title
+            self.__log_new_dimensions(changes)
+            db_instrument = await session.get(
+                InstrumentIdentification,
+                instrument.isin
             )
-            session.add(IndustrySector(
-                industry_sector_id=tsetmc_identity.sector_code,
-                title=tsetmc_identity.sector_title
-            ))
-        current_sub_sector = session.query(IndustrySubSector).where(
-            IndustrySubSector.industry_sub_sector_id == tsetmc_identity.sub_sector_code
-        ).first()
-        if not current_sub_sector:
-            self._logger.info(
-                "Adding sub sector [%d]: [%s] to database.",
-                tsetmc_identity.sub_sector_code,
-                tsetmc_identity.sub_sector_title
-            )
-            session.add(IndustrySubSector(
-                industry_sector_id=tsetmc_identity.sector_code,
-                title=tsetmc_identity.sub_sector_title,
-                industry_sub_sector_id=tsetmc_identity.sub_sector_code
-            ))
+            db_instrument.industry_sub_sector_id = tsetmc_identity.sub_sector_code
+            db_instrument.exchange_market_id = tsetmc_identity.market_code
+            await session.commit()
+
+    def __log_new_dimensions(self, changes: DimensionChanges) -> None:
+        """Logs the sectors, sub sectors and exchanges added to database"""
+        for title, rows in (
+                ("sector", changes.sectors),
+                ("sub sector", changes.sub_sectors),
+                ("exchange", changes.exchange_markets)
+        ):
+            for key, row in rows.items():
+                self._logger.info(
+                    "Adding %s [%d]: [%s] to database.",
+                    title,
+                    key,
+                    row["title"]
+                )
 
     async def __get_instrument_identity(
             self,
@@ -188,28 +159,35 @@ Multiple instruments were matched with your search parameter. Please choose one.
     ):
         """Gets instrument data from TSETMC"""
         try:
-            async with tsetmc.TsetmcScraper() as scraper:
-                tsetmc_identity = await scraper.get_instrument_identity(
-                    tsetmc_code=instrument.tsetmc_code,
-                    timeout=10
+            async with self.http_clients.tsetmc_scraper() as scraper:
+                tsetmc_identity = await self.traffic_controller.request(
+                    TSETMC_HOST,
+                    lambda: scraper.get_instrument_identity(
+                        tsetmc_code=instrument.tsetmc_code,
+                        timeout=self._cold_start_timeout
+                    )
                 )
-        except httpx.ConnectTimeout as exc:
+        except CacheMissError as exc:
+            raise line.TaskException("TSETMC response is not cached.") from exc
+        except httpx.TimeoutException as exc:
             raise line.TaskException("Timeout on TSETMC request.") from exc
+        except (httpx.RequestError, tsetmc.TsetmcScrapeException) as exc:
+            raise line.TaskException("TSETMC request failed.") from exc
         return tsetmc_identity
 
     @classmethod
-    def match_instruments(
+    async def match_instruments(
             cls,
             search_by: str
     ) -> list[InstrumentIdentification]:
         """Matches the instruments from database with search_by input"""
-        with get_tse_market_session() as session:
-            by_isin = session.query(InstrumentIdentification).where(
-                InstrumentIdentification.isin == search_by
-            ).first()
+        async with get_tse_market_async_session() as session:
+            by_isin = await session.get(InstrumentIdentification, search_by)
             if by_isin:
                 return [by_isin]
-            by_ticker = session.query(InstrumentIdentification).where(
-                InstrumentIdentification.ticker == search_by
-            ).all()
-            return by_ticker
+            by_ticker = await session.scalars(
+                sqlalchemy.select(InstrumentIdentification).where(
+                    InstrumentIdentification.ticker == search_by
+                )
+            )
+            return list(by_ticker)
@@ -3,18 +3,22 @@ Using the line implementation in this module, \
 one can search through the instruments and add new instruments to the database.
 """
 from dataclasses import dataclass
-import logging
+from datetime import datetime, timedelta
+import json
 import httpx
+import sqlalchemy
 from telegram_task import line
 from tse_utils import tsetmc
-from tse_utils_db.tse_market import (
-    get_tse_market_session,
-    InstrumentIdentification,
-    InstrumentType,
-    IndustrySector,
-    IndustrySubSector,
-    ExchangeMarket,
+from utils.concurrency import fetch_concurrently, FetchStatistics
+from utils.dimensions import reconcile_dimensions, existing_tsetmc_codes
+from utils.traffic import (
+    TrafficControlled,
+    TrafficControlledShift,
+    TSETMC_HOST,
+    traffic_report,
 )
+from tse_utils_db.bulk import bulk_insert
+from tse_utils_db.tse_market import get_tse_market_async_session, SearchPrefixCache
 
 
 @dataclass
@@ -23,222 +27,143 @@ class JobDescription(line.JobDescription):
 
     search_by: str = None
     do_recursive: bool = None
+    concurrency: int = None
+    crawl: bool = None
+    request_budget: int = None
+    cache_ttl_days: int = None
 
 
-class TsetmcInstrumentSearcher(line.Worker):
+class TsetmcInstrumentSearcher(TrafficControlled, line.Worker):
     """Overriden worker for module tsetmc_instrument_searcher"""
 
     async def perform_task(self, job_description: JobDescription) -> line.JobReport:
         """Performs the task using the provided job description"""
         return await _Shift(
-            job_description=job_description, logger=self._LOGGER
+            job_description=job_description,
+            traffic_controller=self.traffic_controller,
+            http_clients=self.http_clients,
+            logger=self._LOGGER,
         ).perform_task()
 
     @classmethod
     def default_job_description(cls) -> JobDescription:
         """Creates the default job description for this worker"""
-        return JobDescription(search_by="", do_recursive=True)
+        return JobDescription(
+            search_by="",
+            do_recursive=True,
+            concurrency=8,
+            crawl=False,
+            request_budget=2000,
+            cache_ttl_days=7,
+        )
 
 
-class _Shift:
+class _Shift(TrafficControlledShift):
     """Internal class for simpler performance of the worker's task"""
 
-    def __init__(self, job_description: JobDescription, logger: logging.Logger):
-        self._logger: logging.Logger = logger
-        self.job_description: JobDescription = job_description
-        self.report: line.JobReport = line.JobReport()
+    job_description: JobDescription
+    _saturation_size: int = 40
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.scraper: tsetmc.TsetmcScraper = None
 
     async def perform_task(self) -> line.JobReport:
         """Performs the task using the provided job description"""
-        search_results = await self.search_and_process_tsetmc(
-            self.job_description.search_by
-        )
-        search_results_filtered = self.clean_up_search_results(search_results)
-        new_search_results = self.filter_already_existing(search_results_filtered)
-        new_identifications = await self.get_instrument_identifications(
-            new_search_results
-        )
-        self.insert_to_identifications(new_identifications)
-        return self.report
-
-    def insert_to_identifications(
-        self, new_identifications: list[tsetmc.InstrumentIdentification]
-    ) -> None:
-        """Inserts new records to database"""
-        with get_tse_market_session() as session:
-            instrument_types = session.query(InstrumentType).all()
-            old_sectors = session.query(IndustrySector).all()
-            old_sub_sectors = session.query(IndustrySubSector).all()
-            old_exchange_markets = session.query(ExchangeMarket).all()
-            unknown_type_instruments = [
-                x
-                for x in new_identifications
-                if not any(
-                    y for y in instrument_types if y.instrument_type_id == x.type_id
+        async with self.http_clients.tsetmc_scraper() as scraper:
+            self.scraper = scraper
+            if self.job_description.crawl:
+                search_results = await self.crawl_tsetmc(self.job_description.search_by)
+            else:
+                search_results = await self.search_and_process_tsetmc(
+                    self.job_description.search_by
                 )
-            ]
-            if unknown_type_instruments:
-                set_unknown = {x.type_id for x in unknown_type_instruments}
-                self.report.information.append(f"Unknown types ➡️ {set_unknown!r}")
-                self.report.warnings.append(repr(unknown_type_instruments))
-            instruments_to_add = [
-                InstrumentIdentification(
-                    isin=x.isin,
-                    tsetmc_code=x.tsetmc_code,
-                    name_persian=x.name_persian,
-                    name_english=x.name_english,
-                    ticker=x.ticker,
-                    exchange_market_id=x.market_code,
-                    industry_sub_sector_id=x.sub_sector_code,
-                    instrument_type_id=x.type_id,
-                )
-                for x in new_identifications
-                if any(y for y in instrument_types if y.instrument_type_id == x.type_id)
-            ]
-            session.add_all(self.get_new_sectors(new_identifications, old_sectors))
-            session.add_all(
-                self.get_new_sub_sectors(new_identifications, old_sub_sectors)
-            )
-            session.add_all(
-                self.get_new_exchange_markets(new_identifications, old_exchange_markets)
+            search_results_filtered = self.clean_up_search_results(search_results)
+            new_search_results = await self.filter_already_existing(
+                search_results_filtered
             )
-            session.add_all(instruments_to_add)
-            session.commit()
-            self.report.information.append(
-                f"Inserted instruments ➡️ {len(instruments_to_add)}",
-            )
-
-    def get_new_exchange_markets(
-        self,
-        identifications: list[tsetmc.InstrumentIdentification],
-        old_exchange_markets: list[ExchangeMarket],
-    ) -> list[ExchangeMarket]:
-        """Gets new exchange markets that should be added to the database"""
-        all_exchange_markets: list[ExchangeMarket] = []
-        for identification in identifications:
-            if not any(
-                x
-                for x in all_exchange_markets
-                if x.exchange_market_id == identification.market_code
-            ):
-                all_exchange_markets.append(
-                    ExchangeMarket(
-                        exchange_market_id=identification.market_code,
-                        title=identification.market_title,
-                    )
-                )
-        new_exchange_markets = [
-            x
-            for x in all_exchange_markets
-            if not any(
-                y
-                for y in old_exchange_markets
-                if y.exchange_market_id == x.exchange_market_id
+            new_identifications = await self.get_instrument_identifications(
+                new_search_results
             )
-        ]
-        self.report.information.append(
-            f"Inserted exchange markets ➡️ {len(new_exchange_markets)}",
+        await self.insert_to_identifications(new_identifications)
+        self.report.information.extend(
+            traffic_report(self.traffic_controller, self.http_clients, TSETMC_HOST)
         )
-        return new_exchange_markets
+        return self.report
 
-    def get_new_sub_sectors(
-        self,
-        identifications: list[tsetmc.InstrumentIdentification],
-        old_sub_sectors: list[IndustrySubSector],
-    ) -> list[IndustrySubSector]:
-        """Gets new sub sectors that should be added to the database"""
-        all_sub_sectors: list[IndustrySubSector] = []
-        for identification in identifications:
-            if not any(
-                x
-                for x in all_sub_sectors
-                if x.industry_sub_sector_id == identification.sub_sector_code
-            ):
-                all_sub_sectors.append(
-                    IndustrySubSector(
-                        industry_sub_sector_id=identification.sub_sector_code,
-                        title=identification.sub_sector_title,
-                        industry_sector_id=identification.sector_code,
-                    )
-                )
-        new_sub_sectors = [
-            x
-            for x in all_sub_sectors
-            if not any(
-                y
-                for y in old_sub_sectors
-                if y.industry_sub_sector_id == x.industry_sub_sector_id
-            )
-        ]
+    def report_statistics(self, title: str, statistics: FetchStatistics) -> None:
+        """Adds the timing of a stage's requests to the report"""
         self.report.information.append(
-            f"Inserted sub sectors ➡️ {len(new_sub_sectors)}",
+            f"{title} requests ➡️ {statistics.requests} in {statistics.elapsed:.1f}s \
+(avg {statistics.average_request_time:.2f}s, max {statistics.max_request_time:.2f}s)"
         )
-        return new_sub_sectors
 
-    def get_new_sectors(
-        self,
-        identifications: list[tsetmc.InstrumentIdentification],
-        old_sectors: list[IndustrySector],
-    ) -> list[IndustrySector]:
-        """Gets new sectors that should be added to the database"""
-        all_sectors: list[IndustrySector] = []
-        for identification in identifications:
-            if not any(
-                x
-                for x in all_sectors
-                if x.industry_sector_id == identification.sector_code
-            ):
-                all_sectors.append(
-                    IndustrySector(
-                        industry_sector_id=identification.sector_code,
-                        title=identification.sector_title,
-                    )
-                )
-        new_sectors = [
-            x
-            for x in all_sectors
-            if not any(
-                y for y in old_sectors if y.industry_sector_id == x.industry_sector_id
-            )
-        ]
-        self.report.information.append(
-            f"Inserted sectors ➡️ {len(new_sectors)}",
+    async def insert_to_identifications(
+        self, new_identifications: list[tsetmc.InstrumentIdentification]
+    ) -> None:
+        """Inserts new records to database"""
+        async with get_tse_market_async_session() as session:
+            changes = await session.run_sync(reconcile_dimensions, new_identifications)
+            await session.commit()
+        if changes.unknown_type_instruments:
+            set_unknown = {x.type_id for x in changes.unknown_type_instruments}
+            self.report.information.append(f"Unknown types ➡️ {set_unknown!r}")
+            self.report.warnings.append(repr(changes.unknown_type_instruments))
+        self.report.information.extend(
+            [
+                f"Inserted sectors ➡️ {len(changes.sectors)}",
+                f"Inserted sub sectors ➡️ {len(changes.sub_sectors)}",
+                f"Inserted exchange markets ➡️ {len(changes.exchange_markets)}",
+                f"Inserted instruments ➡️ {len(changes.instruments)}",
+            ]
         )
-        return new_sectors
 
     async def get_instrument_identifications(
         self, search_results: list[tsetmc.InstrumentSearchItem]
     ) -> list[tsetmc.InstrumentIdentification]:
         """Gets identification from Tsetmc for new instruments"""
         results: list[tsetmc.InstrumentIdentification] = []
-        async with tsetmc.TsetmcScraper() as scraper:
-            for search_result in search_results:
-                try:
-                    self._logger.info(
-                        "Getting instrument identity for [%s].",
-                        repr(search_result),
-                    )
-                    instrument_identity = await scraper.get_instrument_identity(
-                        tsetmc_code=search_result.tsetmc_code
-                    )
-                    results.append(instrument_identity)
-                except (httpx.RequestError, tsetmc.TsetmcScrapeException):
-                    self.report.warnings.append(
-                        f"Getting instrument identity for [{search_result}] failed.",
-                    )
+        statistics = FetchStatistics()
+
+        async def fetch(
+            search_result: tsetmc.InstrumentSearchItem,
+        ) -> tsetmc.InstrumentIdentification:
+            self._logger.info(
+                "Getting instrument identity for [%s].",
+                repr(search_result),
+            )
+            return await self.traffic_controller.request_or_skip(
+                TSETMC_HOST,
+                lambda: self.scraper.get_instrument_identity(
+                    tsetmc_code=search_result.tsetmc_code
+                ),
+            )
+
+        async for outcome in fetch_concurrently(
+            items=search_results,
+            fetcher=fetch,
+            concurrency=self.job_description.concurrency,
+            expected_exceptions=(httpx.RequestError, tsetmc.TsetmcScrapeException),
+            statistics=statistics,
+            deferred_retries=self.traffic_controller.policy.deferred_retries,
+        ):
+            if outcome.succeeded:
+                if outcome.result is not None:
+                    results.append(outcome.result)
+            else:
+                self.report.warnings.append(
+                    f"Getting instrument identity for [{outcome.item}] failed.",
+                )
+        self.report_statistics("Identity", statistics)
         return results
 
-    def filter_already_existing(
+    async def filter_already_existing(
         self, search_results: list[tsetmc.InstrumentSearchItem]
     ) -> list[tsetmc.InstrumentSearchItem]:
         """Filters instruments that already exist on the database"""
-        with get_tse_market_session() as session:
-            tsetmc_codes = session.query(InstrumentIdentification).all()
-        new_results = [
-            x
-            for x in search_results
-            if not any(y for y in tsetmc_codes if y.tsetmc_code == x.tsetmc_code)
-        ]
+        async with get_tse_market_async_session() as session:
+            tsetmc_codes = await session.run_sync(existing_tsetmc_codes)
+        new_results = [x for x in search_results if x.tsetmc_code not in tsetmc_codes]
         self.report.information.append(
             f"New items ➡️ {len(new_results)}",
         )
@@ -264,35 +189,182 @@ class _Shift:
 
     async def search_and_process_tsetmc(
         self, search_by: str
-    ) -> list[InstrumentIdentification]:
+    ) -> list[tsetmc.InstrumentSearchItem]:
         """Search Tsetmc for instruments and processes the results"""
-        search_results = await self.search_tsetmc(search_by)
+        statistics = FetchStatistics()
+        search_results = await self.search_all_tsetmc([search_by], statistics)
         obsolete_count = len([x for x in search_results if not x.is_active])
-        if (
-            self.job_description.do_recursive
-            and len(search_results) >= 40
-            and obsolete_count == 0
+        if self.job_description.do_recursive and obsolete_count == 0:
+            new_search_bys = self.saturated_children(search_by, search_results)
+            search_results.extend(
+                await self.search_all_tsetmc(sorted(new_search_bys), statistics)
+            )
+        self.report_statistics("Search", statistics)
+        return search_results
+
+    async def search_all_tsetmc(
+        self, search_bys: list[str], statistics: FetchStatistics
+    ) -> list[tsetmc.InstrumentSearchItem]:
+        """Searchs Tsetmc for several values concurrently"""
+        search_results: list[tsetmc.InstrumentSearchItem] = []
+        async for outcome in fetch_concurrently(
+            items=search_bys,
+            fetcher=self.search_tsetmc,
+            concurrency=self.job_description.concurrency,
+            statistics=statistics,
         ):
-            new_search_bys = {
-                x.ticker[: len(search_by) + 1]
-                for x in search_results
-                if x.ticker.startswith(search_by) and len(x.ticker) > len(search_by)
-            }
-            for new_search_by in new_search_bys:
-                search_results.extend(await self.search_tsetmc(search_by=new_search_by))
+            search_results.extend(outcome.result)
         return search_results
 
+    async def crawl_tsetmc(self, root: str) -> list[tsetmc.InstrumentSearchItem]:
+        """
+        Explores the ticker prefix tree breadth-first from root, \
+        expanding every prefix whose search saturates. \
+        Searches are memoised in the database, so an interrupted \
+        or budget-limited crawl resumes where it stopped.
+        """
+        cache = await self.load_prefix_cache()
+        statistics = FetchStatistics()
+        found: dict[str, tsetmc.InstrumentSearchItem] = {}
+        queued: set[str] = {root}
+        frontier: list[str] = [root]
+        requests_left = self.job_description.request_budget
+        cache_hits = unexplored = 0
+        while frontier:
+            level_results = {x: cache[x] for x in frontier if x in cache}
+            cache_hits += len(level_results)
+            to_search = [x for x in frontier if x not in cache]
+            unexplored += max(0, len(to_search) - requests_left)
+            to_search = to_search[:requests_left]
+            requests_left -= len(to_search)
+            level_results.update(await self.search_prefixes(to_search, statistics))
+            frontier = []
+            for prefix, items in level_results.items():
+                found.update((x.tsetmc_code, x) for x in items)
+                children = self.saturated_children(prefix, items) - queued
+                queued.update(children)
+                frontier.extend(sorted(children))
+        self.report.information.extend(
+            [
+                f"Crawled prefixes ➡️ {len(queued) - unexplored}",
+                f"Prefix cache hits ➡️ {cache_hits}",
+                f"Unexplored prefixes ➡️ {unexplored}",
+            ]
+        )
+        self.report_statistics("Search", statistics)
+        return list(found.values())
+
+    def saturated_children(
+        self, prefix: str, items: list[tsetmc.InstrumentSearchItem]
+    ) -> set[str]:
+        """Gets the one letter longer prefixes to search if a search saturated"""
+        if len(items) < self._saturation_size:
+            return set()
+        return {
+            x.ticker[: len(prefix) + 1]
+            for x in items
+            if x.ticker.startswith(prefix) and len(x.ticker) > len(prefix)
+        }
+
+    async def search_prefixes(
+        self, prefixes: list[str], statistics: FetchStatistics
+    ) -> dict[str, list[tsetmc.InstrumentSearchItem]]:
+        """Searchs Tsetmc for prefixes and caches the successful results"""
+        results: dict[str, list[tsetmc.InstrumentSearchItem]] = {}
+
+        async def fetch(prefix: str) -> list[tsetmc.InstrumentSearchItem]:
+            self._logger.info("Searching for [%s]", prefix)
+            return await self.traffic_controller.request_or_skip(
+                TSETMC_HOST,
+                lambda: self.scraper.get_instrument_search(search_value=prefix),
+            )
+
+        async for outcome in fetch_concurrently(
+            items=prefixes,
+            fetcher=fetch,
+            concurrency=self.job_description.concurrency,
+            expected_exceptions=(httpx.RequestError, tsetmc.TsetmcScrapeException),
+            statistics=statistics,
+            deferred_retries=self.traffic_controller.policy.deferred_retries,
+        ):
+            if outcome.succeeded:
+                if outcome.result is not None:
+                    results[outcome.item] = outcome.result
+            else:
+                self.report.warnings.append(f"Searching for [{outcome.item}] failed.")
+        await self.save_prefix_cache(results)
+        return results
+
+    async def load_prefix_cache(
+        self,
+    ) -> dict[str, list[tsetmc.InstrumentSearchItem]]:
+        """Gets the prefix searches that are not older than the cache TTL"""
+        oldest = datetime.now() - timedelta(days=self.job_description.cache_ttl_days)
+        async with get_tse_market_async_session() as session:
+            rows = (
+                await session.execute(
+                    sqlalchemy.select(
+                        SearchPrefixCache.prefix, SearchPrefixCache.results
+                    ).where(SearchPrefixCache.searched_at >= oldest)
+                )
+            ).all()
+        return {
+            prefix: [tsetmc.InstrumentSearchItem(x) for x in json.loads(results)]
+            for prefix, results in rows
+        }
+
+    async def save_prefix_cache(
+        self, results: dict[str, list[tsetmc.InstrumentSearchItem]]
+    ) -> None:
+        """Stores the results of prefix searches in the database"""
+        if not results:
+            return
+        searched_at = datetime.now()
+        async with get_tse_market_async_session() as session:
+            await session.run_sync(
+                bulk_insert,
+                model=SearchPrefixCache,
+                rows=[
+                    {
+                        "prefix": prefix,
+                        "result_count": len(items),
+                        "results": json.dumps(
+                            [self.search_item_to_raw(x) for x in items],
+                            ensure_ascii=False,
+                        ),
+                        "searched_at": searched_at,
+                    }
+                    for prefix, items in results.items()
+                ],
+                upsert=True,
+            )
+            await session.commit()
+
+    @staticmethod
+    def search_item_to_raw(item: tsetmc.InstrumentSearchItem) -> dict:
+        """Converts a search item back to the Tsetmc format it is parsed from"""
+        return {
+            "lVal18AFC": item.ticker,
+            "lVal30": item.name_persian,
+            "insCode": item.tsetmc_code,
+            "flowTitle": item.market_title,
+            "lastDate": 1 if item.is_active else 0,
+        }
+
     async def search_tsetmc(self, search_by) -> list[tsetmc.InstrumentSearchItem]:
         """Searchs Tsetmc for instruments"""
         search_results: list[tsetmc.InstrumentSearchItem] = []
-        async with tsetmc.TsetmcScraper() as scraper:
-            try:
-                self._logger.info("Searching for [%s]", search_by)
-                search_results = await scraper.get_instrument_search(
-                    search_value=search_by
-                )
-            except (httpx.RequestError, tsetmc.TsetmcScrapeException):
-                self.report.warnings.append(
-                    f"Searching for [{search_by}] failed.",
+        try:
+            self._logger.info("Searching for [%s]", search_by)
+            search_results = (
+                await self.traffic_controller.request_or_skip(
+                    TSETMC_HOST,
+                    lambda: self.scraper.get_instrument_search(search_value=search_by),
                 )
+                or []
+            )
+        except (httpx.RequestError, tsetmc.TsetmcScrapeException):
+            self.report.warnings.append(
+                f"Searching for [{search_by}] failed.",
+            )
         return search_results
@@ -11,11 +11,20 @@ from telegram_task.line import (
     LineManager,
     CronJobOrder,
 )
+from tse_utils_db.engine import dispose_tse_market_async_engine
+from utils.http_clients import HttpClientRegistry, HttpClientSettings, ProxyBalancing
+from utils.response_archive import ResponseArchive, ResponseArchiveSettings
+from utils.response_cache import CacheMode, ResponseCache, ResponseCacheSettings
+from utils.traffic import TrafficController, TrafficPolicy
 from lines.tse_client_instruments_updater import TseClientInstrumentsUpdater
 from lines.tsetmc_instrument_identity_catcher import TsetmcInstrumentIdentityCatcher
 from lines.tsetmc_daily_historical_catcher import TsetmcDailyHistoricalCatcher
 from lines.tsetmc_index_historical_catcher import TsetmcIndexHistoricalCatcher
-from lines.tsetmc_instrument_searcher import TsetmcInstrumentSearcher
+from lines.tsetmc_archive_reparser import TsetmcArchiveReparser
+from lines.tsetmc_instrument_searcher import (
+    TsetmcInstrumentSearcher,
+    JobDescription as SearcherJobDescription,
+)
 
 load_dotenv()
 
@@ -27,6 +36,23 @@ MYSQL_DB = os.getenv("MYSQL_DB")
 MYSQL_USER = os.getenv("MYSQL_USER")
 MYSQL_PORT = os.getenv("MYSQL_PORT")
 MYSQL_PASSWORD = os.getenv("MYSQL_PASSWORD")
+TSETMC_MAX_REQUESTS_PER_SECOND = float(
+    os.getenv("TSETMC_MAX_REQUESTS_PER_SECOND", "40")
+)
+TSETMC_MAX_CONNECTIONS = int(os.getenv("TSETMC_MAX_CONNECTIONS", "32"))
+TSETMC_PROXY_URLS = [
+    x.strip() for x in os.getenv("TSETMC_PROXY_URLS", "").split(",") if x.strip()
+]
+TSETMC_HEDGING = os.getenv("TSETMC_HEDGING", "").lower() in ("1", "true")
+TSETMC_PROXY_BALANCING = ProxyBalancing(
+    os.getenv("TSETMC_PROXY_BALANCING", ProxyBalancing.ROUND_ROBIN.value)
+)
+TSETMC_CACHE_MODE = CacheMode(os.getenv("TSETMC_CACHE_MODE", CacheMode.OFF.value))
+TSETMC_CACHE_DIR = os.getenv("TSETMC_CACHE_DIR", "cache/responses")
+TSETMC_CACHE_TTL = float(os.getenv("TSETMC_CACHE_TTL", "21600"))
+TSETMC_CACHE_MAX_MB = int(os.getenv("TSETMC_CACHE_MAX_MB", "1024"))
+TSETMC_ARCHIVE = os.getenv("TSETMC_ARCHIVE", "").lower() in ("1", "true")
+TSETMC_ARCHIVE_DIR = os.getenv("TSETMC_ARCHIVE_DIR", "archive/responses")
 
 
 async def main():
@@ -55,6 +81,35 @@ async def main():
         .token(TELEGRAM_BOT_TOKEN)
         .build()
     )
+    traffic_controller = TrafficController(
+        TrafficPolicy(
+            max_rate=TSETMC_MAX_REQUESTS_PER_SECOND,
+            throttled=TSETMC_CACHE_MODE is not CacheMode.REPLAY,
+        )
+    )
+    http_clients = HttpClientRegistry(
+        HttpClientSettings(
+            max_connections=TSETMC_MAX_CONNECTIONS,
+            max_keepalive_connections=TSETMC_MAX_CONNECTIONS,
+            proxies=TSETMC_PROXY_URLS,
+            balancing=TSETMC_PROXY_BALANCING,
+            hedging=TSETMC_HEDGING,
+        ),
+        cache=ResponseCache(
+            ResponseCacheSettings(
+                directory=TSETMC_CACHE_DIR,
+                mode=TSETMC_CACHE_MODE,
+                ttl=TSETMC_CACHE_TTL,
+                max_size=TSETMC_CACHE_MAX_MB << 20,
+            )
+        ),
+        archive=ResponseArchive(
+            ResponseArchiveSettings(
+                directory=TSETMC_ARCHIVE_DIR,
+                enabled=TSETMC_ARCHIVE,
+            )
+        ),
+    )
     president = President(
         telegram_deputy=TelegramDeputy(
             telegram_app=application, telegram_admin_id=TELEGRAM_CHAT_ID
@@ -62,16 +117,24 @@ async def main():
     )
     president.add_line(
         LineManager(
-            worker=TseClientInstrumentsUpdater(),
+            worker=TseClientInstrumentsUpdater(
+                traffic_controller=traffic_controller, http_clients=http_clients
+            ),
             cron_job_orders=[
                 CronJobOrder(
                     daily_run_time=time(hour=15, minute=3, second=0), off_days=[4]
                 )
             ],
         ),
-        LineManager(worker=TsetmcInstrumentIdentityCatcher()),
         LineManager(
-            worker=TsetmcDailyHistoricalCatcher(),
+            worker=TsetmcInstrumentIdentityCatcher(
+                traffic_controller=traffic_controller, http_clients=http_clients
+            )
+        ),
+        LineManager(
+            worker=TsetmcDailyHistoricalCatcher(
+                traffic_controller=traffic_controller, http_clients=http_clients
+            ),
             cron_job_orders=[
                 CronJobOrder(
                     daily_run_time=time(hour=8, minute=15, second=0), off_days=[4]
@@ -79,16 +142,41 @@ async def main():
             ],
         ),
         LineManager(
-            worker=TsetmcIndexHistoricalCatcher(),
+            worker=TsetmcIndexHistoricalCatcher(
+                traffic_controller=traffic_controller, http_clients=http_clients
+            ),
             cron_job_orders=[
                 CronJobOrder(
                     daily_run_time=time(hour=8, minute=10, second=0), off_days=[4]
                 )
             ],
         ),
-        LineManager(worker=TsetmcInstrumentSearcher()),
+        LineManager(worker=TsetmcArchiveReparser(archive=http_clients.archive)),
+        LineManager(
+            worker=TsetmcInstrumentSearcher(
+                traffic_controller=traffic_controller, http_clients=http_clients
+            ),
+            cron_job_orders=[
+                CronJobOrder(
+                    daily_run_time=time(hour=10, minute=0, second=0),
+                    job_description=SearcherJobDescription(
+                        search_by="",
+                        do_recursive=True,
+                        concurrency=8,
+                        crawl=True,
+                        request_budget=2000,
+                        cache_ttl_days=6,
+                    ),
+                    off_days=[0, 1, 2, 3, 5, 6],
+                )
+            ],
+        ),
     )
-    await president.start_operation_async()
+    try:
+        await president.start_operation_async()
+    finally:
+        await http_clients.aclose()
+        await dispose_tse_market_async_engine()
 
 
 if __name__ == "__main__":
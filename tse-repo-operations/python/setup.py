@@ -3,13 +3,19 @@ import setuptools
 
 setuptools.setup(
     name="tse_utils_db",
-    version="1.1.11",
+    version="1.3.0",
     author="Arka Equities & Securities",
     author_email="info@arkaequities.com",
     description="Database for Tehran Stock Exchange (TSE).",
     long_description="Database utilities for Tehran Stock Exchange, used for saving market data.",
     packages=["tse_utils_db"],
-    install_requires=["python-dotenv", "SQLAlchemy", "mysql-connector-python"],
+    install_requires=[
+        "python-dotenv",
+        "SQLAlchemy[asyncio]",
+        "mysql-connector-python",
+        "aiomysql",
+    ],
+    extras_require={"sqlite": ["aiosqlite"]},
     classifiers=[
         "Programming Language :: Python :: 3",
         "Operating System :: POSIX :: Linux",
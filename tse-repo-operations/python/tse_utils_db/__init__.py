@@ -1,2 +1,7 @@
 """Init module for tse_utils_db"""
+from .engine import *
 from .tse_market import *
+from .bulk import *
+from .batch import *
+from .watermark import *
+from .checkpoint import *
@@ -0,0 +1,151 @@
+"""
+This module holds the bulk writers for the tse_market database, \
+which bypass the ORM unit of work for large volumes of rows
+"""
+from __future__ import annotations
+from itertools import islice
+from typing import Any, Iterable, Iterator, Mapping, Sequence
+import sqlalchemy
+from sqlalchemy.dialects import mysql, sqlite
+from sqlalchemy.orm import Session
+from .tse_market import Base
+
+DEFAULT_BATCH_SIZE: int = 1000
+
+
+def _chunked(rows: Iterable[Any], batch_size: int) -> Iterator[list[Any]]:
+    """Splits rows into lists of at most batch_size items"""
+    iterator = iter(rows)
+    while batch := list(islice(iterator, batch_size)):
+        yield batch
+
+
+def rows_from_columns(columns: Mapping[str, Sequence[Any]]) -> Iterator[dict[str, Any]]:
+    """Turns column arrays of equal length into row dictionaries"""
+    names = list(columns)
+    return (dict(zip(names, values)) for values in zip(*columns.values()))
+
+
+def _unique_key_columns(table: sqlalchemy.Table) -> list[str]:
+    """
+    Gets the column names of the first unique constraint of a table, \
+    falling back to the primary key
+    """
+    unique_constraint = next(
+        (x for x in table.constraints if isinstance(x, sqlalchemy.UniqueConstraint)),
+        table.primary_key,
+    )
+    return [x.name for x in unique_constraint.columns]
+
+
+def _greatest(
+    dialect_name: str, existing: sqlalchemy.ColumnElement, new: sqlalchemy.ColumnElement
+) -> sqlalchemy.ColumnElement:
+    """
+    Builds the greater of an existing and a new value, \
+    either of them being taken when the other is NULL
+    """
+    # pylint: disable=not-callable
+    # sqlalchemy.func members are generated dynamically
+    greatest = (
+        sqlalchemy.func.greatest if dialect_name == "mysql" else sqlalchemy.func.max
+    )
+    return greatest(
+        sqlalchemy.func.coalesce(existing, new), sqlalchemy.func.coalesce(new, existing)
+    )
+
+
+def _upsert_statement(
+    session: Session,
+    table: sqlalchemy.Table,
+    update_columns: Iterable[str],
+    keep_greatest: Iterable[str] = (),
+) -> sqlalchemy.Insert:
+    """
+    Builds an INSERT that updates the existing row \
+    when the unique key of the table is already present. \
+    Columns in keep_greatest only ever move forward. \
+    Raises ValueError on dialects other than MySQL and SQLite.
+    """
+    key_columns = _unique_key_columns(table)
+    update_columns = [
+        x
+        for x in update_columns
+        if x not in key_columns and not table.columns[x].primary_key
+    ]
+    keep_greatest = set(keep_greatest)
+    dialect_name = session.get_bind().dialect.name
+    if dialect_name == "mysql":
+        statement = mysql.insert(table)
+        new = statement.inserted
+    elif dialect_name == "sqlite":
+        statement = sqlite.insert(table)
+        new = statement.excluded
+    else:
+        raise ValueError(
+            f"Upsert needs a MySQL or SQLite database, not a [{dialect_name}] one."
+        )
+    updates = {
+        x: _greatest(dialect_name, table.columns[x], new[x])
+        if x in keep_greatest
+        else new[x]
+        for x in update_columns
+    }
+    if dialect_name == "mysql":
+        return statement.on_duplicate_key_update(updates)
+    return statement.on_conflict_do_update(index_elements=key_columns, set_=updates)
+
+
+def bulk_insert(
+    session: Session,
+    model: type[Base],
+    rows: Iterable[Mapping[str, Any] | Sequence[Any]],
+    columns: Sequence[str] = None,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    upsert: bool = False,
+    keep_greatest: Sequence[str] = (),
+) -> int:
+    """
+    Inserts rows into the table of model using Core executemany, \
+    one statement per batch_size rows. Rows are dictionaries keyed \
+    by column name, or tuples ordered as columns. \
+    With upsert, rows colliding on the unique key of the table \
+    overwrite the existing ones instead of failing, \
+    but for the keep_greatest columns, which keep the greater value. \
+    The caller is responsible for committing the session.
+    """
+    # pylint: disable=too-many-arguments
+    # All the arguments are needed to describe a bulk write
+    table = model.__table__
+    statement = None
+    connection = session.connection()
+    inserted = 0
+    for batch in _chunked(rows, batch_size):
+        if columns is not None:
+            batch = [dict(zip(columns, x)) for x in batch]
+        if statement is None:
+            statement = (
+                _upsert_statement(session, table, batch[0].keys(), keep_greatest)
+                if upsert
+                else sqlalchemy.insert(table)
+            )
+        connection.execute(statement, batch)
+        inserted += len(batch)
+    return inserted
+
+
+def bulk_insert_columns(
+    session: Session,
+    model: type[Base],
+    columns: Mapping[str, Sequence[Any]],
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    upsert: bool = False,
+) -> int:
+    """Inserts column arrays of equal length into the table of model"""
+    return bulk_insert(
+        session=session,
+        model=model,
+        rows=rows_from_columns(columns),
+        batch_size=batch_size,
+        upsert=upsert,
+    )
@@ -0,0 +1,204 @@
+"""
+This module keeps checkpoints of catcher runs in the tse_market database, \
+so that an interrupted run can be resumed and its failures retried
+"""
+from __future__ import annotations
+from datetime import datetime
+from enum import Enum
+from typing import Any, Iterable
+import socket
+import uuid
+import sqlalchemy
+from sqlalchemy.orm import Session
+from .tse_market import CatchRun, CatchRunItem
+from .bulk import bulk_insert
+
+RUN_OWNER_HOST: str = socket.gethostname()[:64]
+RUN_OWNER_PROCESS: str = uuid.uuid4().hex
+
+
+class RunStatus(Enum):
+    """State of a catcher run"""
+
+    RUNNING = "running"
+    COMPLETED = "completed"
+    ABANDONED = "abandoned"
+
+
+class CheckpointStatus(Enum):
+    """State of a dataset of an instrument in a catcher run"""
+
+    PENDING = "pending"
+    SUCCEEDED = "succeeded"
+    FAILED = "failed"
+    SKIPPED = "skipped"
+
+
+def start_run(
+    session: Session,
+    worker: str,
+    items: Iterable[tuple[str, str]],
+    parent_run_id: int = None,
+) -> int:
+    """
+    Creates a run with a pending checkpoint \
+    for every (dataset, isin) item, and returns its id
+    """
+    started_at = datetime.now()
+    run = CatchRun(
+        worker=worker,
+        parent_run_id=parent_run_id,
+        started_at=started_at,
+        heartbeat_at=started_at,
+        owner_host=RUN_OWNER_HOST,
+        owner_process=RUN_OWNER_PROCESS,
+        status=RunStatus.RUNNING.value,
+    )
+    session.add(run)
+    session.flush()
+    bulk_insert(
+        session=session,
+        model=CatchRunItem,
+        rows=(
+            checkpoint_row(run.catch_run_id, dataset, isin, CheckpointStatus.PENDING)
+            for dataset, isin in items
+        ),
+    )
+    return run.catch_run_id
+
+
+def find_last_run(session: Session, worker: str, status: RunStatus = None) -> int:
+    """Gets the id of the latest run of a worker, optionally of a status"""
+    statement = (
+        sqlalchemy.select(CatchRun.catch_run_id)
+        .where(CatchRun.worker == worker)
+        .order_by(CatchRun.catch_run_id.desc())
+        .limit(1)
+    )
+    if status:
+        statement = statement.where(CatchRun.status == status.value)
+    return session.scalar(statement)
+
+
+def find_running_runs(session: Session, worker: str) -> list[CatchRun]:
+    """Gets the runs of a worker that are still marked as running, latest first"""
+    return list(
+        session.scalars(
+            sqlalchemy.select(CatchRun)
+            .where(
+                CatchRun.worker == worker,
+                CatchRun.status == RunStatus.RUNNING.value,
+            )
+            .order_by(CatchRun.catch_run_id.desc())
+        )
+    )
+
+
+def renew_run_lease(session: Session, run_id: int, at: datetime = None) -> None:
+    """
+    Stamps the heartbeat of a run in the session's transaction, \
+    telling other processes that the run is still alive
+    """
+    session.execute(
+        sqlalchemy.update(CatchRun)
+        .where(CatchRun.catch_run_id == run_id)
+        .values(heartbeat_at=at if at else datetime.now())
+    )
+
+
+def take_over_run(session: Session, run_id: int) -> None:
+    """
+    Makes this process the owner of a run in the session's transaction \
+    and renews its lease
+    """
+    session.execute(
+        sqlalchemy.update(CatchRun)
+        .where(CatchRun.catch_run_id == run_id)
+        .values(
+            heartbeat_at=datetime.now(),
+            owner_host=RUN_OWNER_HOST,
+            owner_process=RUN_OWNER_PROCESS,
+        )
+    )
+
+
+def release_run(session: Session, run_id: int) -> None:
+    """
+    Clears the lease of a run its process has stopped working on, \
+    in the session's transaction, so that the next run resumes it right away
+    """
+    session.execute(
+        sqlalchemy.update(CatchRun)
+        .where(CatchRun.catch_run_id == run_id)
+        .values(heartbeat_at=None)
+    )
+
+
+def is_left_by_previous_process(run: CatchRun) -> bool:
+    """
+    Checks if a run was started on this host by another process, \
+    which is gone since a host runs a single instance of the lines, \
+    as when its container is restarted after a crash
+    """
+    return run.owner_host == RUN_OWNER_HOST and run.owner_process != RUN_OWNER_PROCESS
+
+
+def abandon_runs(session: Session, run_ids: Iterable[int]) -> None:
+    """Marks runs as abandoned, so that they are never resumed"""
+    run_ids = list(run_ids)
+    if not run_ids:
+        return
+    session.execute(
+        sqlalchemy.update(CatchRun)
+        .where(CatchRun.catch_run_id.in_(run_ids))
+        .values(finished_at=datetime.now(), status=RunStatus.ABANDONED.value)
+    )
+
+
+def load_run_items(
+    session: Session, run_id: int, statuses: Iterable[CheckpointStatus]
+) -> list[tuple[str, str]]:
+    """Gets the (dataset, isin) items of a run that are in any of statuses"""
+    rows = session.execute(
+        sqlalchemy.select(CatchRunItem.dataset, CatchRunItem.isin).where(
+            CatchRunItem.catch_run_id == run_id,
+            CatchRunItem.status.in_([x.value for x in statuses]),
+        )
+    )
+    return list(rows.tuples())
+
+
+def checkpoint_row(
+    run_id: int,
+    dataset: str,
+    isin: str,
+    status: CheckpointStatus,
+    committed_at: datetime = None,
+) -> dict[str, Any]:
+    """Builds a catch_run_item row"""
+    return {
+        "catch_run_id": run_id,
+        "dataset": dataset,
+        "isin": isin,
+        "status": status.value,
+        "committed_at": committed_at,
+    }
+
+
+def save_checkpoints(session: Session, checkpoints: Iterable[dict[str, Any]]) -> int:
+    """
+    Upserts checkpoint rows in the session's transaction, \
+    so that they are committed together with the data they describe
+    """
+    return bulk_insert(
+        session=session, model=CatchRunItem, rows=checkpoints, upsert=True
+    )
+
+
+def finish_run(session: Session, run_id: int) -> None:
+    """Marks a run as completed"""
+    session.execute(
+        sqlalchemy.update(CatchRun)
+        .where(CatchRun.catch_run_id == run_id)
+        .values(finished_at=datetime.now(), status=RunStatus.COMPLETED.value)
+    )
@@ -0,0 +1,254 @@
+"""
+This module holds the process-wide engines and session factories \
+for the tse_market database, both synchronous and asynchronous
+"""
+from __future__ import annotations
+import os
+import threading
+import time
+from dataclasses import dataclass
+from dotenv import load_dotenv
+import sqlalchemy
+from sqlalchemy import URL, Engine
+from sqlalchemy.ext.asyncio import (
+    AsyncEngine,
+    AsyncSession,
+    async_sessionmaker,
+    create_async_engine,
+)
+from sqlalchemy.orm import Session, sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool, PoolProxiedConnection
+
+
+@dataclass
+class PoolSettings:
+    """Tunable settings of the connection pool"""
+
+    pool_size: int = 5
+    max_overflow: int = 10
+    pool_timeout: float = 30
+    pool_recycle: int = 3600
+    pool_pre_ping: bool = True
+
+    @classmethod
+    def from_environment(cls) -> PoolSettings:
+        """Reads the pool settings from MYSQL_POOL_* environment variables"""
+        default = cls()
+        return cls(
+            pool_size=int(os.getenv("MYSQL_POOL_SIZE", str(default.pool_size))),
+            max_overflow=int(
+                os.getenv("MYSQL_POOL_MAX_OVERFLOW", str(default.max_overflow))
+            ),
+            pool_timeout=float(
+                os.getenv("MYSQL_POOL_TIMEOUT", str(default.pool_timeout))
+            ),
+            pool_recycle=int(
+                os.getenv("MYSQL_POOL_RECYCLE", str(default.pool_recycle))
+            ),
+            pool_pre_ping=os.getenv(
+                "MYSQL_POOL_PRE_PING", str(default.pool_pre_ping)
+            ).lower()
+            in ["true", "1", "y"],
+        )
+
+
+@dataclass
+class PoolStatistics:
+    """Snapshot of the connection pool usage"""
+
+    pool_size: int
+    checked_in: int
+    checked_out: int
+    overflow: int
+    checkouts: int
+    total_wait_time: float
+    max_wait_time: float
+
+    @property
+    def average_wait_time(self) -> float:
+        """Average time spent waiting for a connection on checkout"""
+        return self.total_wait_time / self.checkouts if self.checkouts else 0.0
+
+
+class _InstrumentedQueuePool(QueuePool):
+    """QueuePool that keeps track of the time spent on checkouts"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.checkouts: int = 0
+        self.total_wait_time: float = 0.0
+        self.max_wait_time: float = 0.0
+
+    def connect(self) -> PoolProxiedConnection:
+        start = time.perf_counter()
+        connection = super().connect()
+        wait_time = time.perf_counter() - start
+        self.checkouts += 1
+        self.total_wait_time += wait_time
+        self.max_wait_time = max(self.max_wait_time, wait_time)
+        return connection
+
+
+class _InstrumentedAsyncAdaptedQueuePool(_InstrumentedQueuePool, AsyncAdaptedQueuePool):
+    """AsyncAdaptedQueuePool that keeps track of the time spent on checkouts"""
+
+
+_ENGINE_LOCK = threading.Lock()
+_ENGINE: Engine = None
+_SESSION_FACTORY: sessionmaker[Session] = None
+_ASYNC_ENGINE: AsyncEngine = None
+_ASYNC_SESSION_FACTORY: async_sessionmaker[AsyncSession] = None
+_POOL_SETTINGS: PoolSettings = None
+
+
+def configure_tse_market_engine(pool_settings: PoolSettings) -> None:
+    """
+    Sets the pool settings used when the engine is created. \
+    An already created engine is disposed so that the new settings apply.
+    """
+    global _POOL_SETTINGS  # pylint: disable=global-statement
+    with _ENGINE_LOCK:
+        _POOL_SETTINGS = pool_settings
+    dispose_tse_market_engine()
+
+
+def get_tse_market_url() -> URL:
+    """
+    Builds the tse_market database URL from the environment. \
+    If TSE_MARKET_SQLITE_PATH is set, that SQLite file is used instead, \
+    which is meant for local testing.
+    """
+    load_dotenv()
+    sqlite_path = os.getenv("TSE_MARKET_SQLITE_PATH")
+    if sqlite_path:
+        return URL.create("sqlite", database=sqlite_path)
+    mysql_host = os.getenv("MYSQL_HOST")
+    mysql_db = os.getenv("MYSQL_DB")
+    mysql_user = os.getenv("MYSQL_USER")
+    mysql_port = os.getenv("MYSQL_PORT")
+    mysql_password = os.getenv("MYSQL_PASSWORD")
+    if not mysql_password:
+        mysql_password_file = os.getenv("MYSQL_PASSWORD_FILE")
+        with open(mysql_password_file, "r", encoding="utf-8") as file:
+            mysql_password = file.read().rstrip()
+    return URL.create(
+        "mysql+mysqlconnector",
+        username=mysql_user,
+        password=mysql_password,
+        host=mysql_host,
+        port=mysql_port,
+        database=mysql_db,
+    )
+
+
+def get_tse_market_async_url() -> URL:
+    """Builds the tse_market database URL for the asyncio drivers"""
+    url = get_tse_market_url()
+    if url.drivername == "sqlite":
+        return url.set(drivername="sqlite+aiosqlite")
+    return url.set(drivername="mysql+aiomysql")
+
+
+def _pool_arguments() -> dict:
+    """Gets the engine arguments for the configured pool settings"""
+    settings = _POOL_SETTINGS if _POOL_SETTINGS else PoolSettings.from_environment()
+    return {
+        "pool_size": settings.pool_size,
+        "max_overflow": settings.max_overflow,
+        "pool_timeout": settings.pool_timeout,
+        "pool_recycle": settings.pool_recycle,
+        "pool_pre_ping": settings.pool_pre_ping,
+    }
+
+
+def get_tse_market_engine() -> Engine:
+    """Gets the process-wide engine, creating it on first use"""
+    global _ENGINE, _SESSION_FACTORY  # pylint: disable=global-statement
+    if _ENGINE is not None:
+        return _ENGINE
+    with _ENGINE_LOCK:
+        if _ENGINE is None:
+            _ENGINE = sqlalchemy.create_engine(
+                get_tse_market_url(),
+                echo=False,
+                poolclass=_InstrumentedQueuePool,
+                **_pool_arguments(),
+            )
+            _SESSION_FACTORY = sessionmaker(bind=_ENGINE)
+    return _ENGINE
+
+
+def get_tse_market_async_engine() -> AsyncEngine:
+    """Gets the process-wide asyncio engine, creating it on first use"""
+    global _ASYNC_ENGINE, _ASYNC_SESSION_FACTORY  # pylint: disable=global-statement
+    if _ASYNC_ENGINE is not None:
+        return _ASYNC_ENGINE
+    with _ENGINE_LOCK:
+        if _ASYNC_ENGINE is None:
+            _ASYNC_ENGINE = create_async_engine(
+                get_tse_market_async_url(),
+                echo=False,
+                poolclass=_InstrumentedAsyncAdaptedQueuePool,
+                **_pool_arguments(),
+            )
+            _ASYNC_SESSION_FACTORY = async_sessionmaker(
+                bind=_ASYNC_ENGINE, expire_on_commit=False
+            )
+    return _ASYNC_ENGINE
+
+
+def get_tse_market_session_factory() -> sessionmaker[Session]:
+    """Gets the process-wide session factory bound to the shared engine"""
+    get_tse_market_engine()
+    return _SESSION_FACTORY
+
+
+def get_tse_market_async_session_factory() -> async_sessionmaker[AsyncSession]:
+    """Gets the process-wide asyncio session factory bound to the shared engine"""
+    get_tse_market_async_engine()
+    return _ASYNC_SESSION_FACTORY
+
+
+def dispose_tse_market_engine() -> None:
+    """Closes all pooled connections and forgets the shared engine"""
+    global _ENGINE, _SESSION_FACTORY  # pylint: disable=global-statement
+    with _ENGINE_LOCK:
+        if _ENGINE is not None:
+            _ENGINE.dispose()
+        _ENGINE = None
+        _SESSION_FACTORY = None
+
+
+async def dispose_tse_market_async_engine() -> None:
+    """Closes all pooled asyncio connections and forgets the shared engine"""
+    global _ASYNC_ENGINE, _ASYNC_SESSION_FACTORY  # pylint: disable=global-statement
+    with _ENGINE_LOCK:
+        engine = _ASYNC_ENGINE
+        _ASYNC_ENGINE = None
+        _ASYNC_SESSION_FACTORY = None
+    if engine is not None:
+        await engine.dispose()
+
+
+def get_tse_market_pool_statistics() -> PoolStatistics:
+    """Gets a snapshot of the shared connection pool usage"""
+    return _pool_statistics(get_tse_market_engine().pool)
+
+
+def get_tse_market_async_pool_statistics() -> PoolStatistics:
+    """Gets a snapshot of the shared asyncio connection pool usage"""
+    return _pool_statistics(get_tse_market_async_engine().pool)
+
+
+def _pool_statistics(pool: _InstrumentedQueuePool) -> PoolStatistics:
+    """Gets a snapshot of an instrumented pool's usage"""
+    # QueuePool.overflow() counts down from -pool_size while under capacity
+    return PoolStatistics(
+        pool_size=pool.size(),
+        checked_in=pool.checkedin(),
+        checked_out=pool.checkedout(),
+        overflow=max(0, pool.overflow()),
+        checkouts=pool.checkouts,
+        total_wait_time=pool.total_wait_time,
+        max_wait_time=pool.max_wait_time,
+    )
@@ -1,14 +1,13 @@
 """This module holds the models for the tse_market database"""
 from __future__ import annotations
-import os
 from datetime import date, datetime
 from typing import Optional
 from dataclasses import dataclass
-from dotenv import load_dotenv
-import sqlalchemy
-from sqlalchemy import ForeignKey, URL
-from sqlalchemy.types import NCHAR, NVARCHAR, BIGINT
+from sqlalchemy import ForeignKey, UniqueConstraint
+from sqlalchemy.types import NCHAR, NVARCHAR, BIGINT, TEXT
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import relationship, mapped_column, Mapped, DeclarativeBase, Session
+from .engine import get_tse_market_session_factory, get_tse_market_async_session_factory
 
 
 @dataclass
@@ -140,6 +139,11 @@ class DailyTradeCandle(Base):
     # pylint: disable=too-many-instance-attributes
     # Since this table imitates a database table, the attribute count is ok
     __tablename__ = "daily_trade_candle"
+    __table_args__ = (
+        UniqueConstraint(
+            "isin", "record_date", name="uq_daily_trade_candle_isin_record_date"
+        ),
+    )
 
     daily_trade_candle_id: Mapped[int] = mapped_column(
         primary_key=True, autoincrement=True
@@ -170,6 +174,11 @@ class DailyClientType(Base):
     # pylint: disable=too-many-instance-attributes
     # Since this table imitates a database table, the attribute count is ok
     __tablename__ = "daily_client_type"
+    __table_args__ = (
+        UniqueConstraint(
+            "isin", "record_date", name="uq_daily_client_type_isin_record_date"
+        ),
+    )
 
     daily_client_type_id: Mapped[int] = mapped_column(
         primary_key=True, autoincrement=True
@@ -199,6 +208,11 @@ class DailyInstrumentDetail(Base):
     # pylint: disable=too-many-instance-attributes
     # Since this table imitates a database table, the attribute count is ok
     __tablename__ = "daily_instrument_detail"
+    __table_args__ = (
+        UniqueConstraint(
+            "isin", "record_date", name="uq_daily_instrument_detail_isin_record_date"
+        ),
+    )
 
     daily_instrument_detail_id: Mapped[int] = mapped_column(
         primary_key=True, autoincrement=True
@@ -237,6 +251,11 @@ class DailyIndexValue(Base):
     """Value of an index historically in a daily period"""
 
     __tablename__ = "daily_index_value"
+    __table_args__ = (
+        UniqueConstraint(
+            "isin", "record_date", name="uq_daily_index_value_isin_record_date"
+        ),
+    )
 
     daily_index_value_id: Mapped[int] = mapped_column(
         primary_key=True, autoincrement=True
@@ -250,25 +269,87 @@ class DailyIndexValue(Base):
     instrument_identification: Mapped[InstrumentIdentification] = relationship()
 
 
+@dataclass
+class DataWatermark(Base):
+    """Last stored record date and fetch status of a dataset for each instrument"""
+
+    __tablename__ = "data_watermark"
+
+    dataset: Mapped[str] = mapped_column(NVARCHAR(32), primary_key=True)
+    isin: Mapped[str] = mapped_column(NCHAR(12), primary_key=True)
+    last_record_date: Mapped[Optional[date]] = mapped_column()
+    last_fetch_at: Mapped[Optional[datetime]] = mapped_column()
+    last_status: Mapped[Optional[str]] = mapped_column(NVARCHAR(16))
+
+    def __repr__(self) -> str:
+        return f"DataWatermark(isin={self.isin}, dataset={self.dataset}, \
+last_record_date={self.last_record_date})"
+
+
+@dataclass
+class SnapshotFingerprint(Base):
+    """Content hash of an upstream snapshot as of its last successful processing"""
+
+    __tablename__ = "snapshot_fingerprint"
+
+    snapshot_key: Mapped[str] = mapped_column(NVARCHAR(64), primary_key=True)
+    fingerprint: Mapped[str] = mapped_column(NCHAR(64))
+    updated_at: Mapped[datetime] = mapped_column()
+
+
+@dataclass
+class SearchPrefixCache(Base):
+    """Results of a Tsetmc instrument search for a prefix, reused by the crawler"""
+
+    __tablename__ = "search_prefix_cache"
+
+    prefix: Mapped[str] = mapped_column(NVARCHAR(32), primary_key=True)
+    result_count: Mapped[int] = mapped_column()
+    results: Mapped[str] = mapped_column(TEXT)
+    searched_at: Mapped[datetime] = mapped_column()
+
+
+@dataclass
+class CatchRun(Base):
+    """A run of a catcher, checkpointed so that it can be resumed"""
+
+    # pylint: disable=too-many-instance-attributes
+    # Since this table imitates a database table, the attribute count is ok
+    __tablename__ = "catch_run"
+
+    catch_run_id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
+    worker: Mapped[str] = mapped_column(NVARCHAR(64))
+    parent_run_id: Mapped[Optional[int]] = mapped_column(
+        ForeignKey("catch_run.catch_run_id")
+    )
+    started_at: Mapped[datetime] = mapped_column()
+    heartbeat_at: Mapped[Optional[datetime]] = mapped_column()
+    owner_host: Mapped[Optional[str]] = mapped_column(NVARCHAR(64))
+    owner_process: Mapped[Optional[str]] = mapped_column(NCHAR(32))
+    finished_at: Mapped[Optional[datetime]] = mapped_column()
+    status: Mapped[str] = mapped_column(NVARCHAR(16))
+
+
+@dataclass
+class CatchRunItem(Base):
+    """Checkpoint of a dataset of an instrument in a catcher run"""
+
+    __tablename__ = "catch_run_item"
+
+    catch_run_id: Mapped[int] = mapped_column(
+        ForeignKey("catch_run.catch_run_id"), primary_key=True
+    )
+    dataset: Mapped[str] = mapped_column(NVARCHAR(32), primary_key=True)
+    isin: Mapped[str] = mapped_column(NCHAR(12), primary_key=True)
+    status: Mapped[str] = mapped_column(NVARCHAR(16))
+    committed_at: Mapped[Optional[datetime]] = mapped_column()
+
+
 def get_tse_market_session() -> Session:
     """Get a Session object for working with the tse_market database"""
-    load_dotenv()
-    mysql_host = os.getenv("MYSQL_HOST")
-    mysql_db = os.getenv("MYSQL_DB")
-    mysql_user = os.getenv("MYSQL_USER")
-    mysql_port = os.getenv("MYSQL_PORT")
-    mysql_password = os.getenv("MYSQL_PASSWORD")
-    if not mysql_password:
-        mysql_password_file = os.getenv("MYSQL_PASSWORD_FILE")
-        with open(mysql_password_file, "r", encoding="utf-8") as file:
-            mysql_password = file.read().rstrip()
-    url_object = URL.create(
-        "mysql+mysqlconnector",
-        username=mysql_user,
-        password=mysql_password,
-        host=mysql_host,
-        port=mysql_port,
-        database=mysql_db,
-    )
-    engine = sqlalchemy.create_engine(url_object, echo=False)
-    return Session(engine)
+    return get_tse_market_session_factory()()
+
+
+def get_tse_market_async_session() -> AsyncSession:
+    """Get an AsyncSession object for working with the tse_market database"""
+    return get_tse_market_async_session_factory()()
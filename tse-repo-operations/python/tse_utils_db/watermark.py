@@ -0,0 +1,70 @@
+"""
+This module keeps track of how far each dataset \
+of each instrument has been stored in the tse_market database
+"""
+from __future__ import annotations
+from datetime import date, datetime
+from enum import Enum
+from typing import Any, Iterable
+import sqlalchemy
+from sqlalchemy.orm import Session
+from .tse_market import DataWatermark
+from .bulk import bulk_insert
+
+
+class WatermarkDataset(Enum):
+    """Datasets whose progress is kept in the data_watermark table"""
+
+    TRADE = "trade"
+    CLIENT_TYPE = "client_type"
+    INDEX = "index"
+
+
+class WatermarkStatus(Enum):
+    """Result of the last fetch of a dataset for an instrument"""
+
+    SUCCESS = "success"
+    FAILURE = "failure"
+
+
+def load_watermarks(session: Session, dataset: WatermarkDataset) -> dict[str, date]:
+    """Gets the last stored record date of a dataset, keyed by isin"""
+    rows = session.execute(
+        sqlalchemy.select(DataWatermark.isin, DataWatermark.last_record_date).where(
+            DataWatermark.dataset == dataset.value
+        )
+    )
+    return dict(rows.tuples().all())
+
+
+def watermark_row(
+    isin: str,
+    dataset: WatermarkDataset,
+    last_record_date: date,
+    status: WatermarkStatus,
+    fetch_time: datetime = None,
+) -> dict[str, Any]:
+    """Builds a data_watermark row for a fetch attempt"""
+    return {
+        "isin": isin,
+        "dataset": dataset.value,
+        "last_record_date": last_record_date,
+        "last_fetch_at": fetch_time if fetch_time else datetime.now(),
+        "last_status": status.value,
+    }
+
+
+def save_watermarks(session: Session, watermarks: Iterable[dict[str, Any]]) -> int:
+    """
+    Upserts watermark rows in the session's transaction, \
+    so that they are committed together with the data they describe. \
+    The last record date never moves backwards, whatever the order \
+    the watermarks of overlapping runs are saved in.
+    """
+    return bulk_insert(
+        session=session,
+        model=DataWatermark,
+        rows=watermarks,
+        upsert=True,
+        keep_greatest=["last_record_date"],
+    )
@@ -0,0 +1,53 @@
+"""
+Computes the difference between two keyed snapshots of records, \
+field by field, using hash lookups
+"""
+from __future__ import annotations
+from collections import Counter
+from collections.abc import Hashable
+from dataclasses import dataclass, field
+from typing import Any, Iterable, Mapping
+
+
+@dataclass
+class ChangeSet:
+    """Added, changed and removed records between an old and a new snapshot"""
+
+    added: dict[Hashable, dict[str, Any]] = field(default_factory=dict)
+    changed: dict[Hashable, dict[str, Any]] = field(default_factory=dict)
+    removed: set[Hashable] = field(default_factory=set)
+    field_changes: Counter[str] = field(default_factory=Counter)
+
+    def is_empty(self) -> bool:
+        """True if the snapshots were identical"""
+        return not (self.added or self.changed or self.removed)
+
+    def field_changes_summary(self) -> str:
+        """Formats the per-field change counts for reports"""
+        return ", ".join(f"{x}: {y}" for x, y in self.field_changes.most_common())
+
+
+def diff_by_key(
+    old: Mapping[Hashable, Mapping[str, Any]],
+    new: Mapping[Hashable, Mapping[str, Any]],
+    fields: Iterable[str],
+) -> ChangeSet:
+    """
+    Compares two snapshots keyed by the same identifier. \
+    Changed records hold only the fields whose values differ.
+    """
+    fields = list(fields)
+    change_set = ChangeSet()
+    for key, new_record in new.items():
+        old_record = old.get(key)
+        if old_record is None:
+            change_set.added[key] = dict(new_record)
+            continue
+        differences = {
+            x: new_record[x] for x in fields if old_record[x] != new_record[x]
+        }
+        if differences:
+            change_set.changed[key] = differences
+            change_set.field_changes.update(differences.keys())
+    change_set.removed = old.keys() - new.keys()
+    return change_set
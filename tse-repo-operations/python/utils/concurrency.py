@@ -0,0 +1,136 @@
+"""
+Helpers for running many independent network requests \
+with a bounded number of them in flight.
+"""
+from __future__ import annotations
+import asyncio
+import time
+from dataclasses import dataclass, field
+from itertools import islice
+from typing import AsyncIterator, Awaitable, Callable, Generic, Iterable, TypeVar
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+
+@dataclass
+class FetchOutcome(Generic[T, R]):
+    """Result of fetching data for a single item"""
+
+    item: T
+    result: R = None
+    exception: BaseException = None
+    elapsed: float = 0.0
+
+    @property
+    def succeeded(self) -> bool:
+        """True if the fetch did not raise an expected exception"""
+        return self.exception is None
+
+
+@dataclass
+class FetchStatistics:
+    """Wall-clock statistics of a bounded concurrent fetch"""
+
+    requests: int = 0
+    deferred_retries: int = 0
+    started_at: float = field(default_factory=time.perf_counter)
+    finished_at: float = None
+    total_request_time: float = 0.0
+    max_request_time: float = 0.0
+
+    def record(self, outcome: FetchOutcome) -> None:
+        """Accounts for a completed request"""
+        self.requests += 1
+        self.total_request_time += outcome.elapsed
+        self.max_request_time = max(self.max_request_time, outcome.elapsed)
+
+    def finish(self) -> None:
+        """Marks the end of the fetch"""
+        self.finished_at = time.perf_counter()
+
+    @property
+    def elapsed(self) -> float:
+        """Elapsed wall-clock seconds"""
+        end = self.finished_at if self.finished_at else time.perf_counter()
+        return end - self.started_at
+
+    @property
+    def requests_per_second(self) -> float:
+        """Average number of completed requests per second"""
+        return self.requests / self.elapsed if self.elapsed > 0 else 0.0
+
+    @property
+    def average_request_time(self) -> float:
+        """Average duration of a single request"""
+        return self.total_request_time / self.requests if self.requests else 0.0
+
+
+async def fetch_concurrently(
+    items: Iterable[T],
+    fetcher: Callable[[T], Awaitable[R]],
+    concurrency: int,
+    expected_exceptions: tuple[type[BaseException], ...] = (),
+    statistics: FetchStatistics = None,
+    deferred_retries: int = 0,
+) -> AsyncIterator[FetchOutcome[T, R]]:
+    """
+    Calls fetcher for every item while keeping at most concurrency \
+    calls in flight, and yields the outcomes in order of completion.
+    Expected exceptions are captured in the outcome, others propagate.
+    Items that failed are queued and fetched again once all the others \
+    are done, up to deferred_retries more rounds, and only their last \
+    outcome is yielded.
+    """
+    # pylint: disable=too-many-arguments
+    # Every argument is an independent knob of the fetch
+    concurrency = max(1, concurrency or 1)
+
+    async def run(item: T) -> FetchOutcome[T, R]:
+        start = time.perf_counter()
+        try:
+            result = await fetcher(item)
+        except expected_exceptions as exc:
+            return FetchOutcome(
+                item=item, exception=exc, elapsed=time.perf_counter() - start
+            )
+        return FetchOutcome(
+            item=item, result=result, elapsed=time.perf_counter() - start
+        )
+
+    # Fetches are only started as others complete, so that no more than
+    # concurrency outcomes are held besides the ones in flight
+    pending: set[asyncio.Task[FetchOutcome[T, R]]] = set()
+    try:
+        round_items: Iterable[T] = items
+        for retries_left in range(max(0, deferred_retries), -1, -1):
+            iterator = iter(round_items)
+            retry_queue: list[T] = []
+            pending.update(
+                asyncio.create_task(run(x)) for x in islice(iterator, concurrency)
+            )
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                pending.update(
+                    asyncio.create_task(run(x)) for x in islice(iterator, len(done))
+                )
+                for task in done:
+                    outcome = task.result()
+                    if not outcome.succeeded and retries_left:
+                        retry_queue.append(outcome.item)
+                        continue
+                    if statistics:
+                        statistics.record(outcome)
+                    yield outcome
+            if not retry_queue:
+                break
+            if statistics:
+                statistics.deferred_retries += len(retry_queue)
+            round_items = retry_queue
+    finally:
+        for task in pending:
+            task.cancel()
+        if statistics:
+            statistics.finish()
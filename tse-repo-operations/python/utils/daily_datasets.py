@@ -0,0 +1,90 @@
+"""
+Descriptions of the daily historical datasets of TSETMC, \
+shared by the lines which fetch them and those which rebuild them
+"""
+from __future__ import annotations
+from dataclasses import dataclass
+from datetime import date
+from typing import Any, Awaitable, Callable
+from tse_utils import tsetmc
+from tse_utils_db.watermark import WatermarkDataset
+from tse_utils_db.tse_market import DailyClientType, DailyTradeCandle
+
+
+@dataclass
+class Dataset:
+    """Describes how a daily dataset is fetched from TSETMC and stored"""
+
+    title: str
+    watermark: WatermarkDataset
+    model: type[DailyTradeCandle] | type[DailyClientType]
+    fetch: Callable[[tsetmc.TsetmcScraper, str], Awaitable[list[Any]]]
+    to_db: Callable[..., dict[str, Any]]
+    record_date: Callable[[Any], date]
+    has_trades: Callable[[Any], bool]
+
+
+def client_type_data_tsetmc_to_db(
+    isin: str, tsetmc_data: tsetmc.ClientTypeDaily
+) -> dict[str, Any]:
+    """Converts Tsetmc client type data to a daily_client_type row"""
+    return {
+        "isin": isin,
+        "record_date": tsetmc_data.record_date,
+        "legal_buy_num": tsetmc_data.legal.buy.num,
+        "legal_buy_value": tsetmc_data.legal.buy.value,
+        "legal_buy_volume": tsetmc_data.legal.buy.volume,
+        "legal_sell_num": tsetmc_data.legal.sell.num,
+        "legal_sell_value": tsetmc_data.legal.sell.value,
+        "legal_sell_volume": tsetmc_data.legal.sell.volume,
+        "natural_buy_num": tsetmc_data.natural.buy.num,
+        "natural_buy_value": tsetmc_data.natural.buy.value,
+        "natural_buy_volume": tsetmc_data.natural.buy.volume,
+        "natural_sell_num": tsetmc_data.natural.sell.num,
+        "natural_sell_value": tsetmc_data.natural.sell.value,
+        "natural_sell_volume": tsetmc_data.natural.sell.volume,
+    }
+
+
+def trade_data_tsetmc_to_db(
+    isin: str, tsetmc_data: tsetmc.ClosingPriceDaily
+) -> dict[str, Any]:
+    """Converts Tsetmc trade data to a daily_trade_candle row"""
+    return {
+        "isin": isin,
+        "record_date": tsetmc_data.last_trade_datetime.date(),
+        "previous_price": tsetmc_data.previous_price,
+        "open_price": tsetmc_data.open_price,
+        "max_price": tsetmc_data.max_price,
+        "min_price": tsetmc_data.min_price,
+        "close_price": tsetmc_data.close_price,
+        "last_price": tsetmc_data.last_price,
+        "trade_num": tsetmc_data.trade_num,
+        "trade_value": tsetmc_data.trade_value,
+        "trade_volume": tsetmc_data.trade_volume,
+    }
+
+
+TRADE_DATASET = Dataset(
+    title="Trade data",
+    watermark=WatermarkDataset.TRADE,
+    model=DailyTradeCandle,
+    fetch=lambda scraper, tsetmc_code: scraper.get_closing_price_daily_list(
+        tsetmc_code=tsetmc_code
+    ),
+    to_db=trade_data_tsetmc_to_db,
+    record_date=lambda x: x.last_trade_datetime.date(),
+    has_trades=lambda x: x.trade_volume > 0,
+)
+
+CLIENT_TYPE_DATASET = Dataset(
+    title="Client type",
+    watermark=WatermarkDataset.CLIENT_TYPE,
+    model=DailyClientType,
+    fetch=lambda scraper, tsetmc_code: scraper.get_client_type_daily_list(
+        tsetmc_code=tsetmc_code
+    ),
+    to_db=client_type_data_tsetmc_to_db,
+    record_date=lambda x: x.record_date,
+    has_trades=lambda x: x.trade_volume() > 0,
+)
@@ -0,0 +1,218 @@
+"""
+Reconciles instrument identifications from Tsetmc \
+with the dimension tables of the tse_market database, \
+using key sets instead of per-row queries
+"""
+from __future__ import annotations
+from dataclasses import dataclass, field
+from itertools import islice
+from typing import Any, Iterable
+import sqlalchemy
+from sqlalchemy.orm import Session
+from tse_utils import tsetmc
+from tse_utils_db.bulk import bulk_insert
+from tse_utils_db.tse_market import (
+    InstrumentIdentification,
+    InstrumentType,
+    IndustrySector,
+    IndustrySubSector,
+    ExchangeMarket,
+)
+
+
+def existing_tsetmc_codes(session: Session) -> set[str]:
+    """Gets the tsetmc codes of the instruments already on the database"""
+    return set(session.scalars(sqlalchemy.select(InstrumentIdentification.tsetmc_code)))
+
+
+class _KeySet:
+    """
+    Keys of a column known to be on the database, \
+    looked up only for the values asked about, each at most once
+    """
+
+    _lookup_chunk_len: int = 1000
+
+    def __init__(self, session: Session, column: sqlalchemy.Column):
+        self.session: Session = session
+        self.column: sqlalchemy.Column = column
+        self.present: set[Any] = set()
+        self.checked: set[Any] = set()
+
+    def __contains__(self, value: Any) -> bool:
+        return value in self.present
+
+    def load(self, values: Iterable[Any]) -> None:
+        """Looks up the values that have not been looked up yet"""
+        iterator = iter({x for x in values if x is not None} - self.checked)
+        while chunk := list(islice(iterator, self._lookup_chunk_len)):
+            self.present.update(
+                self.session.scalars(
+                    sqlalchemy.select(self.column).where(self.column.in_(chunk))
+                )
+            )
+            self.checked.update(chunk)
+
+    def update(self, values: Iterable[Any]) -> None:
+        """Records values that have just been inserted"""
+        values = set(values)
+        self.present.update(values)
+        self.checked.update(values)
+
+
+@dataclass
+class DimensionChanges:
+    """Rows missing from the database, keyed by their identifiers"""
+
+    sectors: dict[int, dict[str, Any]] = field(default_factory=dict)
+    sub_sectors: dict[int, dict[str, Any]] = field(default_factory=dict)
+    exchange_markets: dict[int, dict[str, Any]] = field(default_factory=dict)
+    instruments: dict[str, dict[str, Any]] = field(default_factory=dict)
+    unknown_type_instruments: list[tsetmc.InstrumentIdentification] = field(
+        default_factory=list
+    )
+
+
+class DimensionReconciler:
+    """
+    Looks up the keys of the dimension tables that the identifications \
+    being reconciled refer to, rather than whole tables, \
+    then finds and inserts whatever they need
+    """
+
+    def __init__(self, session: Session):
+        self.session: Session = session
+        self.sector_ids: _KeySet = _KeySet(session, IndustrySector.industry_sector_id)
+        self.sub_sector_ids: _KeySet = _KeySet(
+            session, IndustrySubSector.industry_sub_sector_id
+        )
+        self.exchange_market_ids: _KeySet = _KeySet(
+            session, ExchangeMarket.exchange_market_id
+        )
+        self.instrument_type_ids: _KeySet = _KeySet(
+            session, InstrumentType.instrument_type_id
+        )
+        self.isins: _KeySet = _KeySet(session, InstrumentIdentification.isin)
+
+    def __load_keys(
+        self, identifications: list[tsetmc.InstrumentIdentification]
+    ) -> None:
+        """Looks up the keys the identifications refer to"""
+        for keys, attribute in (
+            (self.sector_ids, "sector_code"),
+            (self.sub_sector_ids, "sub_sector_code"),
+            (self.exchange_market_ids, "market_code"),
+            (self.instrument_type_ids, "type_id"),
+            (self.isins, "isin"),
+        ):
+            keys.load(getattr(x, attribute) for x in identifications)
+
+    def reconcile(
+        self,
+        identifications: Iterable[tsetmc.InstrumentIdentification],
+        include_instruments: bool = True,
+    ) -> DimensionChanges:
+        """
+        Finds the sectors, sub sectors and exchange markets of identifications \
+        that are not on the database, and optionally the instruments themselves
+        """
+        identifications = list(identifications)
+        self.__load_keys(identifications)
+        changes = DimensionChanges()
+        for identification in identifications:
+            self.__reconcile_dimensions(identification, changes)
+            if not include_instruments or identification.isin in self.isins:
+                continue
+            if identification.type_id not in self.instrument_type_ids:
+                changes.unknown_type_instruments.append(identification)
+                continue
+            changes.instruments.setdefault(
+                identification.isin,
+                {
+                    "isin": identification.isin,
+                    "tsetmc_code": identification.tsetmc_code,
+                    "name_persian": identification.name_persian,
+                    "name_english": identification.name_english,
+                    "ticker": identification.ticker,
+                    "exchange_market_id": identification.market_code,
+                    "industry_sub_sector_id": identification.sub_sector_code,
+                    "instrument_type_id": identification.type_id,
+                },
+            )
+        return changes
+
+    def __reconcile_dimensions(
+        self,
+        identification: tsetmc.InstrumentIdentification,
+        changes: DimensionChanges,
+    ) -> None:
+        """Adds the missing dimensions of a single identification to changes"""
+        if (
+            identification.sector_code is not None
+            and identification.sector_code not in self.sector_ids
+        ):
+            changes.sectors.setdefault(
+                identification.sector_code,
+                {
+                    "industry_sector_id": identification.sector_code,
+                    "title": identification.sector_title,
+                },
+            )
+        if (
+            identification.sub_sector_code is not None
+            and identification.sub_sector_code not in self.sub_sector_ids
+        ):
+            changes.sub_sectors.setdefault(
+                identification.sub_sector_code,
+                {
+                    "industry_sub_sector_id": identification.sub_sector_code,
+                    "title": identification.sub_sector_title,
+                    "industry_sector_id": identification.sector_code,
+                },
+            )
+        if (
+            identification.market_code is not None
+            and identification.market_code not in self.exchange_market_ids
+        ):
+            changes.exchange_markets.setdefault(
+                identification.market_code,
+                {
+                    "exchange_market_id": identification.market_code,
+                    "title": identification.market_title,
+                },
+            )
+
+    def apply(self, changes: DimensionChanges) -> None:
+        """
+        Inserts the changes in the session's transaction, \
+        parents before children. The caller commits the session.
+        """
+        for model, rows in (
+            (IndustrySector, changes.sectors),
+            (IndustrySubSector, changes.sub_sectors),
+            (ExchangeMarket, changes.exchange_markets),
+            (InstrumentIdentification, changes.instruments),
+        ):
+            if rows:
+                bulk_insert(session=self.session, model=model, rows=rows.values())
+        self.sector_ids.update(changes.sectors)
+        self.sub_sector_ids.update(changes.sub_sectors)
+        self.exchange_market_ids.update(changes.exchange_markets)
+        self.isins.update(changes.instruments)
+
+
+def reconcile_dimensions(
+    session: Session,
+    identifications: Iterable[tsetmc.InstrumentIdentification],
+    include_instruments: bool = True,
+) -> DimensionChanges:
+    """
+    Finds and inserts whatever identifications need in the session's \
+    transaction. Works with AsyncSession.run_sync as well.
+    """
+    reconciler = DimensionReconciler(session)
+    changes = reconciler.reconcile(
+        identifications, include_instruments=include_instruments
+    )
+    reconciler.apply(changes)
+    return changes
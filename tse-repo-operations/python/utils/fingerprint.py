@@ -0,0 +1,23 @@
+"""
+Stable content hashes of record lists, \
+used to detect whether a snapshot changed since it was last processed
+"""
+import hashlib
+import json
+from typing import Any, Iterable, Sequence
+
+
+def fingerprint_records(records: Iterable[Sequence[Any]]) -> str:
+    """
+    Hashes a list of records independent of their order. \
+    Each record is a sequence of JSON-serializable values \
+    (dates and other values are serialized with str).
+    """
+    serialized = sorted(
+        json.dumps(list(x), ensure_ascii=False, default=str) for x in records
+    )
+    digest = hashlib.sha256()
+    for record in serialized:
+        digest.update(record.encode("utf-8"))
+        digest.update(b"\n")
+    return digest.hexdigest()
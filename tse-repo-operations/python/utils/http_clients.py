@@ -0,0 +1,566 @@
+"""
+Keeps long-lived HTTP clients shared by all the lines, \
+so that requests reuse warm keep-alive connections \
+instead of paying the TCP, proxy and TLS setup every time
+"""
+from __future__ import annotations
+import asyncio
+import itertools
+import time
+from dataclasses import dataclass, field
+from enum import Enum
+from importlib.util import find_spec
+from typing import Any
+import httpx
+from tse_utils import tsetmc
+from tse_utils.tse_client import TseClientScraper
+from .latency import EndpointLatency, endpoint_name
+from .response_archive import ResponseArchive
+from .response_cache import CacheMissError, ResponseCache, decoded_headers
+
+TSETMC_HEADERS: dict[str, str] = {
+    "user-agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) \
+AppleWebKit/537.36 (KHTML, like Gecko) Chrome/89.0.4389.114 Safari/537.36",
+    "accept": "application/json, text/plain, */*",
+}
+TSE_CLIENT_HEADERS: dict[str, str] = {
+    "Host": "service.tsetmc.com",
+    "SOAPAction": "http://tsetmc.com/Instrument",
+    "accept": "text/xml",
+    "Content-type": "text/xml",
+}
+
+
+class ProxyBalancing(Enum):
+    """How requests are distributed across the proxies"""
+
+    ROUND_ROBIN = "round_robin"
+    LEAST_LATENCY = "least_latency"
+
+
+@dataclass
+class HttpClientSettings:
+    """
+    Connection limits of every client of a registry. HTTP/2 is used \
+    where the server supports it and the h2 package is installed. \
+    base_urls replaces the base URL of a host's client, \
+    e.g. to point the lines at a stand-in server. \
+    Requests are spread over the proxies, if any, by balancing. A proxy \
+    failing proxy_eject_threshold times in a row is ejected for \
+    proxy_eject_cooldown seconds, doubled on every failed probe after it. \
+    Once an endpoint has latency_min_samples latencies, its read timeout \
+    is timeout_multiplier times its timeout_percentile latency, clamped \
+    to [min_timeout, max_timeout], and with hedging, a GET request still \
+    unanswered at its hedge_percentile latency is duplicated, \
+    for at most hedge_budget of the requests.
+    """
+
+    # pylint: disable=too-many-instance-attributes
+    # Each attribute is a knob of the connection pools or the proxies
+    max_connections: int = 32
+    max_keepalive_connections: int = 32
+    keepalive_expiry: float = 120.0
+    http2: bool = True
+    base_urls: dict[str, str] = field(default_factory=dict)
+    proxies: list[str] = field(default_factory=list)
+    balancing: ProxyBalancing = ProxyBalancing.ROUND_ROBIN
+    proxy_eject_threshold: int = 3
+    proxy_eject_cooldown: float = 30.0
+    proxy_max_eject_cooldown: float = 600.0
+    adaptive_timeouts: bool = True
+    latency_min_samples: int = 20
+    timeout_percentile: float = 0.99
+    timeout_multiplier: float = 3.0
+    min_timeout: float = 2.0
+    max_timeout: float = 30.0
+    hedging: bool = False
+    hedge_percentile: float = 0.95
+    hedge_budget: float = 0.05
+
+
+@dataclass
+class ConnectionStatistics:
+    """Requests sent by a client and the connections opened for them"""
+
+    requests: int = 0
+    connections: int = 0
+    tls_handshakes: int = 0
+    connect_time: float = 0.0
+
+    @property
+    def reuse_ratio(self) -> float:
+        """Share of the requests sent over an already open connection"""
+        return 1 - self.connections / self.requests if self.requests else 0.0
+
+
+@dataclass
+class ProxyStatistics:
+    """Requests sent through a proxy and how they went"""
+
+    requests: int = 0
+    failures: int = 0
+    ejections: int = 0
+    total_latency: float = 0.0
+    started_at: float = field(default_factory=time.perf_counter)
+
+    @property
+    def error_rate(self) -> float:
+        """Share of the requests that failed at the transport level"""
+        return self.failures / self.requests if self.requests else 0.0
+
+    @property
+    def average_latency(self) -> float:
+        """Average duration of a request through the proxy"""
+        return self.total_latency / self.requests if self.requests else 0.0
+
+    @property
+    def requests_per_second(self) -> float:
+        """Requests sent per second since the proxy was first used"""
+        elapsed = time.perf_counter() - self.started_at
+        return self.requests / elapsed if elapsed > 0 else 0.0
+
+
+class _ProxyEndpoint:
+    """A pooled transport through a single proxy, or none, and its health"""
+
+    # pylint: disable=too-many-instance-attributes
+    # The endpoint keeps its transport, its load and its health
+
+    _latency_smoothing: float = 0.2
+
+    def __init__(self, name: str, transport: httpx.AsyncBaseTransport):
+        self.name: str = name
+        self.transport: httpx.AsyncBaseTransport = transport
+        self.statistics: ProxyStatistics = ProxyStatistics()
+        self.in_flight: int = 0
+        self.latency: float = 0.0
+        self.consecutive_failures: int = 0
+        self.eject_cooldown: float = 0.0
+        self.ejected_until: float = 0.0
+
+    def is_available(self, now: float) -> bool:
+        """True if the endpoint is not ejected"""
+        return now >= self.ejected_until
+
+    def expected_latency(self) -> float:
+        """Smoothed latency of the endpoint, scaled by its queued requests"""
+        return self.latency * (self.in_flight + 1)
+
+    def record(self, latency: float, failed: bool, settings: HttpClientSettings):
+        """Accounts for a request, ejecting the endpoint if it keeps failing"""
+        self.statistics.requests += 1
+        self.statistics.total_latency += latency
+        if not failed:
+            self.latency += self._latency_smoothing * (latency - self.latency)
+            self.consecutive_failures = 0
+            self.eject_cooldown = 0.0
+            self.ejected_until = 0.0
+            return
+        self.statistics.failures += 1
+        self.consecutive_failures += 1
+        if self.eject_cooldown or (
+            self.consecutive_failures >= settings.proxy_eject_threshold
+        ):
+            self.eject_cooldown = min(
+                settings.proxy_max_eject_cooldown,
+                self.eject_cooldown * 2
+                if self.eject_cooldown
+                else settings.proxy_eject_cooldown,
+            )
+            self.ejected_until = time.perf_counter() + self.eject_cooldown
+            self.statistics.ejections += 1
+
+
+class _ProxyFanOutTransport(httpx.AsyncBaseTransport):
+    """
+    Spreads requests over the endpoints of the proxies. An ejected \
+    endpoint gets a single probe request once its cooldown is over, \
+    and is back in rotation as soon as a probe succeeds.
+    """
+
+    def __init__(self, endpoints: list[_ProxyEndpoint], settings: HttpClientSettings):
+        self.endpoints: list[_ProxyEndpoint] = endpoints
+        self.settings: HttpClientSettings = settings
+        self.__round_robin: itertools.cycle = itertools.cycle(endpoints)
+
+    def __choose(self) -> _ProxyEndpoint:
+        """Chooses the endpoint of the next request"""
+        now = time.perf_counter()
+        available = [x for x in self.endpoints if x.is_available(now)]
+        if not available:
+            return min(self.endpoints, key=lambda x: x.ejected_until)
+        if self.settings.balancing is ProxyBalancing.LEAST_LATENCY:
+            return min(available, key=lambda x: x.expected_latency())
+        return next(x for x in self.__round_robin if x.is_available(now))
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        endpoint = self.__choose()
+        if endpoint.consecutive_failures:
+            endpoint.ejected_until = time.perf_counter() + endpoint.eject_cooldown
+        endpoint.in_flight += 1
+        started = time.perf_counter()
+        try:
+            response = await endpoint.transport.handle_async_request(request)
+        except httpx.TransportError:
+            endpoint.record(time.perf_counter() - started, True, self.settings)
+            raise
+        finally:
+            endpoint.in_flight -= 1
+        endpoint.record(time.perf_counter() - started, False, self.settings)
+        return response
+
+    async def aclose(self) -> None:
+        for endpoint in self.endpoints:
+            await endpoint.transport.aclose()
+
+
+class _LatencyTransport(httpx.AsyncBaseTransport):
+    """
+    Records the latency of every endpoint, up to the response headers, \
+    and uses it to tune the read timeout and to hedge slow GET requests
+    """
+
+    def __init__(
+        self,
+        transport: httpx.AsyncBaseTransport,
+        latencies: dict[str, EndpointLatency],
+        settings: HttpClientSettings,
+    ):
+        self.transport: httpx.AsyncBaseTransport = transport
+        self.latencies: dict[str, EndpointLatency] = latencies
+        self.settings: HttpClientSettings = settings
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        latency = self.latencies.setdefault(
+            endpoint_name(request.url), EndpointLatency()
+        )
+        latency.requests += 1
+        warm = latency.histogram.count >= self.settings.latency_min_samples
+        if warm and self.settings.adaptive_timeouts:
+            request.extensions = {
+                **request.extensions,
+                "timeout": {
+                    **request.extensions.get("timeout", {}),
+                    "read": self.__timeout(latency),
+                },
+            }
+        started = time.perf_counter()
+        if (
+            warm
+            and self.settings.hedging
+            and request.method == "GET"
+            and latency.hedges < self.settings.hedge_budget * latency.requests
+        ):
+            response = await self.__send_hedged(request, latency)
+        else:
+            response = await self.transport.handle_async_request(request)
+        latency.histogram.record(time.perf_counter() - started)
+        return response
+
+    def __timeout(self, latency: EndpointLatency) -> float:
+        """Derives the read timeout of an endpoint from its latencies"""
+        return min(
+            self.settings.max_timeout,
+            max(
+                self.settings.min_timeout,
+                latency.histogram.percentile(self.settings.timeout_percentile)
+                * self.settings.timeout_multiplier,
+            ),
+        )
+
+    async def __send_hedged(
+        self, request: httpx.Request, latency: EndpointLatency
+    ) -> httpx.Response:
+        """
+        Sends a request, and a duplicate of it if no response has come \
+        by the hedge percentile latency. The first response wins, \
+        and the exception of the primary request is raised if both fail.
+        """
+        primary = asyncio.ensure_future(self.transport.handle_async_request(request))
+        pending = {primary}
+        try:
+            done, pending = await asyncio.wait(
+                pending,
+                timeout=latency.histogram.percentile(self.settings.hedge_percentile),
+            )
+            if not done:
+                latency.hedges += 1
+                pending.add(
+                    asyncio.ensure_future(self.transport.handle_async_request(request))
+                )
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                winner = next((x for x in done if not x.exception()), None)
+                if winner:
+                    latency.hedge_wins += winner is not primary
+                    for task in done - {winner}:
+                        if not task.exception():
+                            await task.result().aclose()
+                    return winner.result()
+            return primary.result()
+        finally:
+            for task in pending:
+                task.cancel()
+
+
+class _CachingTransport(httpx.AsyncBaseTransport):
+    """
+    Serves requests from a response cache, caching the successful responses \
+    of the transport it wraps, which is never reached when replaying
+    """
+
+    def __init__(self, transport: httpx.AsyncBaseTransport, cache: ResponseCache):
+        self.transport: httpx.AsyncBaseTransport = transport
+        self.cache: ResponseCache = cache
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        cached = await self.cache.get(request)
+        if cached:
+            return cached.to_response(request)
+        if self.cache.replaying:
+            raise CacheMissError(
+                f"No cached response for {request.url}.", request=request
+            )
+        response = await self.transport.handle_async_request(request)
+        if response.status_code != 200:
+            return response
+        try:
+            await response.aread()
+        finally:
+            await response.aclose()
+        return (await self.cache.put(request, response)).to_response(request)
+
+    async def aclose(self) -> None:
+        await self.transport.aclose()
+
+
+class _ArchivingTransport(httpx.AsyncBaseTransport):
+    """Archives the successful responses of the transport it wraps"""
+
+    def __init__(self, transport: httpx.AsyncBaseTransport, archive: ResponseArchive):
+        self.transport: httpx.AsyncBaseTransport = transport
+        self.archive: ResponseArchive = archive
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        response = await self.transport.handle_async_request(request)
+        if response.status_code != 200:
+            return response
+        try:
+            await response.aread()
+        finally:
+            await response.aclose()
+        await self.archive.append(request, response)
+        return httpx.Response(
+            status_code=response.status_code,
+            headers=decoded_headers(response),
+            content=response.content,
+            request=request,
+        )
+
+    async def aclose(self) -> None:
+        await self.transport.aclose()
+
+
+class _StatisticsTransport(httpx.AsyncBaseTransport):
+    """Counts the connections a transport opens through httpcore's trace events"""
+
+    def __init__(
+        self, transport: httpx.AsyncBaseTransport, statistics: ConnectionStatistics
+    ):
+        self.transport: httpx.AsyncBaseTransport = transport
+        self.statistics: ConnectionStatistics = statistics
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        self.statistics.requests += 1
+        started: dict[str, float] = {}
+
+        async def trace(event: str, _: dict[str, Any]) -> None:
+            step, _, state = event.rpartition(".")
+            if state == "started":
+                started[step] = time.perf_counter()
+                return
+            if state != "complete":
+                return
+            if step.endswith(".connect_tcp"):
+                self.statistics.connections += 1
+            elif step.endswith(".start_tls"):
+                self.statistics.tls_handshakes += 1
+            else:
+                return
+            self.statistics.connect_time += time.perf_counter() - started.pop(
+                step, time.perf_counter()
+            )
+
+        request.extensions = {**request.extensions, "trace": trace}
+        return await self.transport.handle_async_request(request)
+
+    async def aclose(self) -> None:
+        await self.transport.aclose()
+
+
+class SharedTsetmcScraper(tsetmc.TsetmcScraper):
+    """TsetmcScraper over a registry's client, which it leaves open on exit"""
+
+    def __init__(self, client: httpx.AsyncClient, tsetmc_domain: str):
+        # pylint: disable=super-init-not-called,invalid-name
+        # The parent would open a client of its own, so its private one is set
+        self.tsetmc_domain = tsetmc_domain
+        self._TsetmcScraper__client = client
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+class SharedTseClientScraper(TseClientScraper):
+    """TseClientScraper over a registry's client, which it leaves open on exit"""
+
+    def __init__(self, client: httpx.AsyncClient):
+        # pylint: disable=super-init-not-called,invalid-name
+        # The parent would open a client of its own, so its private one is set
+        self._TseClientScraper__client = client
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+class HttpClientRegistry:
+    """
+    Process-wide HTTP clients, one per host, created on first use \
+    and closed together with the registry. Their requests are served \
+    from the response cache first, if it is enabled, \
+    and the responses from the network are archived, if archiving is.
+    """
+
+    def __init__(
+        self,
+        settings: HttpClientSettings = None,
+        cache: ResponseCache = None,
+        archive: ResponseArchive = None,
+    ):
+        self.settings: HttpClientSettings = (
+            settings if settings else HttpClientSettings()
+        )
+        self.cache: ResponseCache = cache if cache else ResponseCache()
+        self.archive: ResponseArchive = archive if archive else ResponseArchive()
+        self.__clients: dict[str, httpx.AsyncClient] = {}
+        self.__statistics: dict[str, ConnectionStatistics] = {}
+        self.__fan_outs: dict[str, _ProxyFanOutTransport] = {}
+        self.__latencies: dict[str, dict[str, EndpointLatency]] = {}
+
+    def client(
+        self, host: str, base_url: str, headers: dict[str, str]
+    ) -> httpx.AsyncClient:
+        """Gets the client of a host, creating it on first use"""
+        if host not in self.__clients:
+            self.__fan_outs[host] = _ProxyFanOutTransport(
+                endpoints=[
+                    _ProxyEndpoint(
+                        name=self.__proxy_name(x), transport=self.__create_transport(x)
+                    )
+                    for x in (self.settings.proxies or [None])
+                ],
+                settings=self.settings,
+            )
+            transport = _StatisticsTransport(
+                transport=_LatencyTransport(
+                    transport=self.__fan_outs[host],
+                    latencies=self.latencies(host),
+                    settings=self.settings,
+                ),
+                statistics=self.statistics(host),
+            )
+            if self.archive.enabled:
+                transport = _ArchivingTransport(
+                    transport=transport, archive=self.archive
+                )
+            self.__clients[host] = httpx.AsyncClient(
+                headers=headers,
+                base_url=self.settings.base_urls.get(host, base_url),
+                transport=_CachingTransport(transport=transport, cache=self.cache)
+                if self.cache.enabled
+                else transport,
+            )
+        return self.__clients[host]
+
+    def __create_transport(self, proxy: str) -> httpx.AsyncHTTPTransport:
+        """Creates a pooled transport through a proxy, or none"""
+        return httpx.AsyncHTTPTransport(
+            http2=self.settings.http2 and find_spec("h2") is not None,
+            limits=httpx.Limits(
+                max_connections=self.settings.max_connections,
+                max_keepalive_connections=self.settings.max_keepalive_connections,
+                keepalive_expiry=self.settings.keepalive_expiry,
+            ),
+            proxy=httpx.Proxy(proxy) if proxy else None,
+        )
+
+    @classmethod
+    def __proxy_name(cls, proxy: str) -> str:
+        """Names a proxy in reports, leaving its credentials out"""
+        if not proxy:
+            return "direct"
+        url = httpx.URL(proxy)
+        return f"{url.host}:{url.port}" if url.port else url.host
+
+    def tsetmc_scraper(
+        self, tsetmc_domain: str = "cdn.tsetmc.com"
+    ) -> SharedTsetmcScraper:
+        """Creates a TsetmcScraper over the shared client of the domain"""
+        return SharedTsetmcScraper(
+            client=self.client(
+                host=tsetmc_domain,
+                base_url=f"https://{tsetmc_domain}/",
+                headers=TSETMC_HEADERS,
+            ),
+            tsetmc_domain=tsetmc_domain,
+        )
+
+    def tse_client_scraper(self) -> SharedTseClientScraper:
+        """Creates a TseClientScraper over the shared client of TSE client"""
+        return SharedTseClientScraper(
+            client=self.client(
+                host=httpx.URL(TseClientScraper.base_address).host,
+                base_url=TseClientScraper.base_address,
+                headers=TSE_CLIENT_HEADERS,
+            )
+        )
+
+    def statistics(self, host: str) -> ConnectionStatistics:
+        """Gets the connection statistics of a host"""
+        return self.__statistics.setdefault(host, ConnectionStatistics())
+
+    def summary(self, host: str) -> str:
+        """Formats the connection reuse of a host for reports"""
+        statistics = self.statistics(host)
+        return f"{statistics.requests} requests over {statistics.connections} \
+connections ({statistics.reuse_ratio:.0%} reused, \
+{statistics.connect_time:.1f}s connecting)"
+
+    def latencies(self, host: str) -> dict[str, EndpointLatency]:
+        """Gets the latencies of the endpoints of a host"""
+        return self.__latencies.setdefault(host, {})
+
+    def proxy_statistics(self, host: str) -> dict[str, ProxyStatistics]:
+        """Gets the statistics of each proxy used for a host"""
+        fan_out = self.__fan_outs.get(host)
+        return {x.name: x.statistics for x in fan_out.endpoints} if fan_out else {}
+
+    def proxies_summary(self, host: str) -> str:
+        """Formats the throughput and error rate of each proxy for reports"""
+        return (
+            ", ".join(
+                f"{name}: {x.requests} requests ({x.requests_per_second:.1f} req/s, \
+{x.error_rate:.0%} errors, {x.average_latency:.2f}s avg, {x.ejections} ejections)"
+                for name, x in self.proxy_statistics(host).items()
+            )
+            or "none"
+        )
+
+    async def aclose(self) -> None:
+        """Closes all the clients and flushes the archive"""
+        await self.archive.flush()
+        for client in self.__clients.values():
+            await client.aclose()
+        self.__clients.clear()
@@ -0,0 +1,78 @@
+"""
+Latency histograms of the scraped endpoints, \
+from which request timeouts and hedging delays are derived
+"""
+from __future__ import annotations
+import bisect
+import math
+from dataclasses import dataclass, field
+import httpx
+
+_BUCKET_RATIO: float = 1.2
+_MIN_BUCKET: float = 0.001
+_MAX_BUCKET: float = 120.0
+_BUCKET_BOUNDS: list[float] = [
+    _MIN_BUCKET * _BUCKET_RATIO**x
+    for x in range(math.ceil(math.log(_MAX_BUCKET / _MIN_BUCKET, _BUCKET_RATIO)) + 1)
+]
+
+
+def endpoint_name(url: httpx.URL) -> str:
+    """
+    Names the endpoint of a URL, leaving its parameters out. \
+    TSETMC API paths look like api/<controller>/<action>/<parameters>.
+    """
+    segments = [x for x in url.path.split("/") if x]
+    if len(segments) >= 3 and segments[0] == "api":
+        return segments[2]
+    return segments[-1] if segments else url.host
+
+
+class LatencyHistogram:
+    """
+    Counts latencies in exponentially growing buckets, \
+    so that percentiles are within 20% at a constant memory cost
+    """
+
+    def __init__(self):
+        self.counts: list[int] = [0] * (len(_BUCKET_BOUNDS) + 1)
+        self.count: int = 0
+
+    def record(self, latency: float) -> None:
+        """Adds a latency in seconds"""
+        self.counts[bisect.bisect_left(_BUCKET_BOUNDS, latency)] += 1
+        self.count += 1
+
+    def percentile(self, percentile: float) -> float:
+        """
+        Gets the upper bound of the bucket holding a percentile, \
+        given between 0 and 1, or None if nothing is recorded
+        """
+        if not self.count:
+            return None
+        rank = math.ceil(percentile * self.count)
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return _BUCKET_BOUNDS[min(index, len(_BUCKET_BOUNDS) - 1)]
+        return _BUCKET_BOUNDS[-1]
+
+
+@dataclass
+class EndpointLatency:
+    """Latencies of the successful requests to an endpoint, and its hedging"""
+
+    histogram: LatencyHistogram = field(default_factory=LatencyHistogram)
+    requests: int = 0
+    hedges: int = 0
+    hedge_wins: int = 0
+
+    def summary(self) -> str:
+        """Formats the percentiles of the endpoint for reports"""
+        percentiles = ", ".join(
+            f"p{round(x * 100)} {self.histogram.percentile(x) or 0:.2f}s"
+            for x in (0.5, 0.95, 0.99)
+        )
+        return f"{percentiles} ({self.requests} requests, \
+{self.hedges} hedged, {self.hedge_wins} won by the hedge)"
@@ -0,0 +1,163 @@
+"""
+Streaming stages for the catchers: the event loop keeps fetching \
+while a dedicated thread writes the fetched data to the database
+"""
+from __future__ import annotations
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Generic, Iterable, TypeVar
+from .concurrency import fetch_concurrently, FetchOutcome, FetchStatistics
+
+T = TypeVar("T")
+R = TypeVar("R")
+U = TypeVar("U")
+
+
+@dataclass
+class StageStatistics:
+    """Throughput of a single pipeline stage"""
+
+    items: int = 0
+    batches: int = 0
+    busy_time: float = 0.0
+    max_batch_items: int = 0
+
+    def record(self, items: int, elapsed: float) -> None:
+        """Accounts for a batch of items processed by the stage"""
+        self.items += items
+        self.batches += 1
+        self.busy_time += elapsed
+        self.max_batch_items = max(self.max_batch_items, items)
+
+    @property
+    def items_per_second(self) -> float:
+        """Items processed per second of the stage being busy"""
+        return self.items / self.busy_time if self.busy_time > 0 else 0.0
+
+
+class BackgroundWriter(Generic[U]):
+    """
+    Buffers units of work put on a bounded queue and hands them \
+    to write in a dedicated thread, whenever the buffered units reach \
+    flush_size or the oldest buffered unit is flush_interval seconds old. \
+    Producers wait when the queue is full, which caps the memory used.
+    """
+
+    # pylint: disable=too-many-instance-attributes
+    # The writer keeps its configuration, its state and its statistics
+
+    def __init__(
+        self,
+        write: Callable[[list[U]], int],
+        size: Callable[[U], int],
+        flush_size: int,
+        flush_interval: float,
+        queue_size: int,
+    ):
+        # pylint: disable=too-many-arguments
+        # All the arguments are needed to describe when and how to write
+        self.__write: Callable[[list[U]], int] = write
+        self.__size: Callable[[U], int] = size
+        self.flush_size: int = flush_size
+        self.flush_interval: float = flush_interval
+        self.queue_size: int = queue_size
+        self.statistics: StageStatistics = StageStatistics()
+        self.queue_high_water_mark: int = 0
+        self.__queue: asyncio.Queue = None
+        self.__consumer: asyncio.Task = None
+        self.__executor: ThreadPoolExecutor = None
+
+    async def __aenter__(self) -> BackgroundWriter[U]:
+        self.__queue = asyncio.Queue(maxsize=self.queue_size)
+        self.__executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="background_writer"
+        )
+        self.__consumer = asyncio.create_task(self.__consume())
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback) -> None:
+        try:
+            if not self.__consumer.done():
+                await self.__queue.put(None)
+            await self.__consumer
+        finally:
+            self.__executor.shutdown(wait=True)
+
+    async def put(self, unit: U) -> None:
+        """
+        Queues a unit for writing, waiting while the queue is full. \
+        Raises the writer's exception if writing has failed.
+        """
+        put = asyncio.ensure_future(self.__queue.put(unit))
+        await asyncio.wait({put, self.__consumer}, return_when=asyncio.FIRST_COMPLETED)
+        if not put.done():
+            put.cancel()
+            self.__consumer.result()
+        self.queue_high_water_mark = max(
+            self.queue_high_water_mark, self.__queue.qsize()
+        )
+
+    async def __consume(self) -> None:
+        """Collects units from the queue and flushes them"""
+        buffer: list[U] = []
+        buffered_size = 0
+        deadline: float = None
+        while True:
+            timeout = None if deadline is None else max(0, deadline - time.monotonic())
+            try:
+                unit = await asyncio.wait_for(self.__queue.get(), timeout=timeout)
+            except asyncio.TimeoutError:
+                unit = None
+            else:
+                if unit is None:
+                    await self.__flush(buffer)
+                    return
+                buffer.append(unit)
+                buffered_size += self.__size(unit)
+                if deadline is None:
+                    deadline = time.monotonic() + self.flush_interval
+            if unit is None or buffered_size >= self.flush_size:
+                await self.__flush(buffer)
+                buffer, buffered_size, deadline = [], 0, None
+
+    async def __flush(self, buffer: list[U]) -> None:
+        """Writes the buffered units in the writer thread"""
+        if not buffer:
+            return
+        started = time.perf_counter()
+        written = await asyncio.get_running_loop().run_in_executor(
+            self.__executor, self.__write, buffer
+        )
+        self.statistics.record(written, time.perf_counter() - started)
+
+
+async def fetch_into_writer(
+    writer: BackgroundWriter[U],
+    convert: Callable[[FetchOutcome[T, R]], U],
+    items: Iterable[T],
+    fetcher: Callable[[T], Awaitable[R]],
+    concurrency: int,
+    expected_exceptions: tuple[type[BaseException], ...] = (),
+    statistics: FetchStatistics = None,
+    deferred_retries: int = 0,
+) -> None:
+    """
+    Fetches the items as fetch_concurrently does and puts every outcome \
+    on the writer once converted, so that fetching waits on a full queue. \
+    Outcomes converted to None are left out.
+    """
+    # pylint: disable=too-many-arguments
+    # The arguments of fetch_concurrently are passed through
+    async for outcome in fetch_concurrently(
+        items=items,
+        fetcher=fetcher,
+        concurrency=concurrency,
+        expected_exceptions=expected_exceptions,
+        statistics=statistics,
+        deferred_retries=deferred_retries,
+    ):
+        unit = convert(outcome)
+        if unit is not None:
+            await writer.put(unit)
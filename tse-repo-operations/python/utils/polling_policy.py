@@ -0,0 +1,104 @@
+"""
+Decides which instruments are worth polling on a run, \
+polling liquid instruments every day and idle ones on a decaying cadence
+"""
+from __future__ import annotations
+from collections import Counter
+from collections.abc import Hashable
+from dataclasses import dataclass, field
+from datetime import date, datetime, timedelta
+from enum import Enum
+from typing import Iterable
+
+
+class PollingCadence(Enum):
+    """How often an instrument is polled"""
+
+    DAILY = timedelta(days=1)
+    WEEKLY = timedelta(days=7)
+    MONTHLY = timedelta(days=30)
+
+
+@dataclass
+class InstrumentActivity:
+    """What is known about the recent activity of an instrument"""
+
+    key: Hashable
+    last_trade_date: date = None
+    recent_trade_days: int = 0
+    last_fetch_at: datetime = None
+    last_fetch_failed: bool = False
+
+
+@dataclass
+class PollingSchedule:
+    """Keys of the instruments to poll, most active first, and the skipped ones"""
+
+    due: list[Hashable] = field(default_factory=list)
+    skipped: list[Hashable] = field(default_factory=list)
+    cadences: Counter[PollingCadence] = field(default_factory=Counter)
+
+    def cadences_summary(self) -> str:
+        """Formats the per-cadence instrument counts for reports"""
+        return ", ".join(
+            f"{x.name.lower()}: {self.cadences[x]}" for x in PollingCadence
+        )
+
+
+@dataclass
+class PollingPolicy:
+    """
+    Instruments idle for at most daily_max_idle_days are polled daily, \
+    those idle for at most weekly_max_idle_days weekly, the rest monthly. \
+    An instrument is due once its cadence has passed since the last fetch, \
+    less the slack that absorbs the drift of the run time.
+    """
+
+    daily_max_idle_days: int = 14
+    weekly_max_idle_days: int = 90
+    slack: timedelta = timedelta(hours=6)
+
+    def cadence(self, activity: InstrumentActivity, today: date) -> PollingCadence:
+        """Gets the cadence an instrument should be polled on"""
+        if activity.last_trade_date is None:
+            return PollingCadence.DAILY
+        idle_days = (today - activity.last_trade_date).days
+        if idle_days <= self.daily_max_idle_days:
+            return PollingCadence.DAILY
+        if idle_days <= self.weekly_max_idle_days:
+            return PollingCadence.WEEKLY
+        return PollingCadence.MONTHLY
+
+    def is_due(
+        self, activity: InstrumentActivity, cadence: PollingCadence, now: datetime
+    ) -> bool:
+        """Checks if an instrument has to be polled now"""
+        if activity.last_fetch_at is None or activity.last_fetch_failed:
+            return True
+        return now - activity.last_fetch_at >= cadence.value - self.slack
+
+    def schedule(
+        self, activities: Iterable[InstrumentActivity], now: datetime = None
+    ) -> PollingSchedule:
+        """
+        Splits instruments into due and skipped ones. Due instruments \
+        are ordered by their recent trading frequency, then by recency.
+        """
+        now = now if now else datetime.now()
+        result = PollingSchedule()
+        due: list[InstrumentActivity] = []
+        for activity in activities:
+            cadence = self.cadence(activity, now.date())
+            result.cadences[cadence] += 1
+            if self.is_due(activity, cadence, now):
+                due.append(activity)
+            else:
+                result.skipped.append(activity.key)
+        due.sort(
+            key=lambda x: (
+                -x.recent_trade_days,
+                -(x.last_trade_date.toordinal() if x.last_trade_date else 0),
+            )
+        )
+        result.due = [x.key for x in due]
+        return result
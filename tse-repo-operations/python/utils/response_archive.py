@@ -0,0 +1,226 @@
+"""
+Append-only archive of the raw scraped responses, \
+from which the tables can be rebuilt without scraping them again
+"""
+from __future__ import annotations
+import asyncio
+import gzip
+import json
+import threading
+import zlib
+from dataclasses import dataclass
+from datetime import date, datetime
+from pathlib import Path
+from typing import Any, Iterator
+import httpx
+from .latency import endpoint_name
+
+_SEGMENT_SUFFIX: str = ".ndjson.gz"
+_INDEX_SUFFIX: str = ".index.ndjson"
+_READ_CHUNK_SIZE: int = 1 << 16
+
+
+def archive_key(url: httpx.URL) -> str:
+    """
+    Gets the parameters of a TSETMC API path, \
+    e.g. <tsetmc_code>/0 of api/ClosingPrice/GetClosingPriceDailyList/<tsetmc_code>/0
+    """
+    segments = [x for x in url.path.split("/") if x]
+    if len(segments) >= 3 and segments[0] == "api":
+        return "/".join(segments[3:])
+    return url.query.decode()
+
+
+@dataclass
+class ResponseArchiveSettings:
+    """
+    Configuration of a ResponseArchive. Archived responses are buffered \
+    and appended once flush_records of them are buffered, \
+    or flush_interval seconds after the first of them.
+    """
+
+    directory: str = "archive/responses"
+    enabled: bool = False
+    flush_records: int = 500
+    flush_interval: float = 60.0
+    compress_level: int = 6
+
+
+@dataclass
+class ArchiveStatistics:
+    """Responses appended to an archive and their size"""
+
+    records: int = 0
+    raw_bytes: int = 0
+    compressed_bytes: int = 0
+    write_failures: int = 0
+
+    @property
+    def compression_ratio(self) -> float:
+        """Raw size of the archived responses per byte written"""
+        return self.raw_bytes / self.compressed_bytes if self.compressed_bytes else 0.0
+
+
+class ResponseArchive:
+    """
+    Keeps a segment a day for every endpoint, a gzip file of NDJSON records \
+    appended a gzip member per flush, with an index of the archive key \
+    and the member offset of every record, so that the segments \
+    and members holding an instrument can be found without decompressing them
+    """
+
+    def __init__(self, settings: ResponseArchiveSettings = None):
+        self.settings: ResponseArchiveSettings = (
+            settings if settings else ResponseArchiveSettings()
+        )
+        self.statistics: ArchiveStatistics = ArchiveStatistics()
+        self.__buffers: dict[tuple[date, str], list[dict[str, Any]]] = {}
+        self.__buffered: int = 0
+        self.__flush_timer: asyncio.TimerHandle = None
+        self.__flush_task: asyncio.Task = None
+        self.__lock: threading.Lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        """True if the responses are archived"""
+        return self.settings.enabled
+
+    def segment(self, day: date, endpoint: str) -> Path:
+        """Gets the path of the segment of an endpoint on a day"""
+        return (
+            Path(self.settings.directory)
+            / day.isoformat()
+            / (endpoint + _SEGMENT_SUFFIX)
+        )
+
+    async def append(self, request: httpx.Request, response: httpx.Response) -> None:
+        """Buffers a response, whose body must be read, flushing when due"""
+        fetched_at = datetime.now()
+        self.__buffers.setdefault(
+            (fetched_at.date(), endpoint_name(request.url)), []
+        ).append(
+            {
+                "fetched_at": fetched_at.isoformat(),
+                "key": archive_key(request.url),
+                "url": str(request.url),
+                "body": response.text,
+            }
+        )
+        self.__buffered += 1
+        if self.__buffered >= self.settings.flush_records:
+            await self.flush()
+        elif not self.__flush_timer:
+            self.__flush_timer = asyncio.get_running_loop().call_later(
+                self.settings.flush_interval, self.__flush_later
+            )
+
+    def __flush_later(self) -> None:
+        """Flushes the buffered responses once the interval is over"""
+        self.__flush_timer = None
+        self.__flush_task = asyncio.ensure_future(self.flush())
+
+    async def flush(self) -> None:
+        """
+        Appends the buffered responses to their segments, \
+        after those of a flush already under way
+        """
+        if self.__flush_task and self.__flush_task is not asyncio.current_task():
+            await self.__flush_task
+        if self.__flush_timer:
+            self.__flush_timer.cancel()
+            self.__flush_timer = None
+        buffers, self.__buffers = self.__buffers, {}
+        self.__buffered = 0
+        for (day, endpoint), records in buffers.items():
+            try:
+                await asyncio.to_thread(
+                    self.__write, self.segment(day, endpoint), records
+                )
+            except OSError:
+                self.statistics.write_failures += len(records)
+
+    def __write(self, path: Path, records: list[dict[str, Any]]) -> None:
+        """Appends records to a segment as a gzip member, and then to its index"""
+        raw = "".join(json.dumps(x, ensure_ascii=False) + "\n" for x in records)
+        member = gzip.compress(raw.encode(), compresslevel=self.settings.compress_level)
+        with self.__lock:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            with open(path, "ab") as file:
+                offset = file.tell()
+                file.write(member)
+            with open(_index_path(path), "a", encoding="utf-8") as file:
+                file.writelines(
+                    json.dumps({"key": x["key"], "offset": offset}) + "\n"
+                    for x in records
+                )
+            self.statistics.records += len(records)
+            self.statistics.raw_bytes += len(raw.encode())
+            self.statistics.compressed_bytes += len(member)
+
+    def segments(
+        self, endpoint: str, start: date = None, end: date = None
+    ) -> list[Path]:
+        """Lists the segments of an endpoint between two days if given, oldest first"""
+        return [
+            x
+            for x in sorted(
+                Path(self.settings.directory).glob(f"*/{endpoint}{_SEGMENT_SUFFIX}")
+            )
+            if (start is None or x.parent.name >= start.isoformat())
+            and (end is None or x.parent.name <= end.isoformat())
+        ]
+
+    def summary(self) -> str:
+        """Formats the size of the archived responses for reports"""
+        if not self.enabled:
+            return "off"
+        return f"{self.statistics.records} responses \
+({self.statistics.compressed_bytes / (1 << 20):.1f} MB, \
+{self.statistics.compression_ratio:.1f}x compressed, \
+{self.statistics.write_failures} failed writes)"
+
+
+def _index_path(segment: Path) -> Path:
+    """Gets the path of the index of a segment"""
+    return segment.with_name(segment.name.removesuffix(_SEGMENT_SUFFIX) + _INDEX_SUFFIX)
+
+
+def read_index(segment: Path) -> Iterator[tuple[str, int]]:
+    """Reads the archive key and the member offset of the records of a segment"""
+    try:
+        with open(_index_path(segment), encoding="utf-8") as file:
+            for line in file:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    return
+                yield entry["key"], entry["offset"]
+    except FileNotFoundError:
+        return
+
+
+def read_records(segment: Path, offsets: list[int] = None) -> Iterator[dict[str, Any]]:
+    """
+    Reads the records of a segment, or only those of the members at offsets. \
+    A member cut short by a crash ends the segment.
+    """
+    with open(segment, "rb") as file:
+        for offset in sorted(set(offsets)) if offsets is not None else [0]:
+            file.seek(offset)
+            decompressor = zlib.decompressobj(wbits=zlib.MAX_WBITS | 16)
+            pending = b""
+            while True:
+                chunk = decompressor.unused_data or file.read(_READ_CHUNK_SIZE)
+                if decompressor.eof:
+                    if offsets is not None or not chunk:
+                        break
+                    decompressor = zlib.decompressobj(wbits=zlib.MAX_WBITS | 16)
+                if not chunk:
+                    return
+                try:
+                    pending += decompressor.decompress(chunk)
+                except zlib.error:
+                    return
+                *lines, pending = pending.split(b"\n")
+                for line in lines:
+                    yield json.loads(line)
@@ -0,0 +1,256 @@
+"""
+On-disk cache of the scraped responses, addressed by the content of the requests, \
+so that reprocessing recent data does not download it again, \
+and so that workers can be replayed offline from what was once fetched
+"""
+from __future__ import annotations
+import asyncio
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from enum import Enum
+from pathlib import Path
+import httpx
+from .latency import endpoint_name
+
+_DECODED_HEADERS: frozenset[str] = frozenset(
+    ("content-encoding", "content-length", "transfer-encoding")
+)
+
+
+def decoded_headers(response: httpx.Response) -> list[tuple[str, str]]:
+    """
+    Gets the headers of a read response, leaving out those \
+    which describe its encoded body rather than the decoded content
+    """
+    return [
+        (key, value)
+        for key, value in response.headers.items()
+        if key.lower() not in _DECODED_HEADERS
+    ]
+
+
+class CacheMode(Enum):
+    """How the scraping clients use the response cache"""
+
+    OFF = "off"
+    CACHE = "cache"
+    REPLAY = "replay"
+
+
+@dataclass
+class ResponseCacheSettings:
+    """
+    Configuration of a ResponseCache. Responses older than ttl seconds \
+    are fetched again, except when replaying, and the least recently used \
+    responses are evicted once the cache grows beyond max_size bytes.
+    """
+
+    directory: str = "cache/responses"
+    mode: CacheMode = CacheMode.OFF
+    ttl: float = 21600.0
+    max_size: int = 1 << 30
+
+
+@dataclass
+class CacheStatistics:
+    """Lookups of a response cache and how they went"""
+
+    hits: int = 0
+    misses: int = 0
+    writes: int = 0
+    write_failures: int = 0
+    evictions: int = 0
+
+    @property
+    def hit_ratio(self) -> float:
+        """Share of the lookups served from the cache"""
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+
+class CacheMissError(Exception):
+    """
+    Raised when replaying a request whose response is not cached. \
+    It is no transport error, so it is neither retried nor taken \
+    for a failure of the host, and the lines skip the request.
+    """
+
+    def __init__(self, message: str, request: httpx.Request):
+        super().__init__(message)
+        self.request: httpx.Request = request
+
+
+@dataclass
+class CachedResponse:
+    """A cached response, whose body is already decoded"""
+
+    status_code: int
+    headers: list[tuple[str, str]]
+    content: bytes
+    stored_at: float
+
+    def to_response(self, request: httpx.Request) -> httpx.Response:
+        """Creates an httpx response of the cached one"""
+        return httpx.Response(
+            status_code=self.status_code,
+            headers=self.headers,
+            content=self.content,
+            request=request,
+        )
+
+
+class ResponseCache:
+    """
+    Keeps a file per response, named by the hash of the method, the URL \
+    and the body of its request, under a folder per endpoint. \
+    The URL holds the endpoint, the instrument and the date of a request, \
+    and the SOAP body holds those of the TSE client's. Requests for \
+    the latest data hold no date, so their responses are kept fresh by ttl \
+    rather than by the key, and can still be replayed on later days.
+    """
+
+    def __init__(self, settings: ResponseCacheSettings = None):
+        self.settings: ResponseCacheSettings = (
+            settings if settings else ResponseCacheSettings()
+        )
+        self.statistics: CacheStatistics = CacheStatistics()
+        self.__index: OrderedDict[Path, int] = None
+        self.__size: int = 0
+        self.__lock: threading.Lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        """True if the responses are cached"""
+        return self.settings.mode is not CacheMode.OFF
+
+    @property
+    def replaying(self) -> bool:
+        """True if the requests are only served from the cache"""
+        return self.settings.mode is CacheMode.REPLAY
+
+    def path(self, request: httpx.Request) -> Path:
+        """Gets the path of the cached response of a request"""
+        digest = hashlib.sha256()
+        for part in (request.method.encode(), bytes(request.url.raw_path)):
+            digest.update(part)
+            digest.update(b"\0")
+        digest.update(request.content)
+        return (
+            Path(self.settings.directory)
+            / request.url.host
+            / endpoint_name(request.url)
+            / digest.hexdigest()
+        )
+
+    async def get(self, request: httpx.Request) -> CachedResponse:
+        """Gets the cached response of a request, or None if there is none"""
+        response = await asyncio.to_thread(self.__read, self.path(request))
+        if response and not self.replaying:
+            if time.time() - response.stored_at > self.settings.ttl:
+                response = None
+        if response:
+            self.statistics.hits += 1
+        else:
+            self.statistics.misses += 1
+        return response
+
+    async def put(
+        self, request: httpx.Request, response: httpx.Response
+    ) -> CachedResponse:
+        """
+        Caches a response, whose body must be read, and returns it. \
+        A response which cannot be written is returned all the same.
+        """
+        cached = CachedResponse(
+            status_code=response.status_code,
+            headers=decoded_headers(response),
+            content=response.content,
+            stored_at=time.time(),
+        )
+        try:
+            await asyncio.to_thread(self.__write, self.path(request), cached)
+        except OSError:
+            self.statistics.write_failures += 1
+        else:
+            self.statistics.writes += 1
+        return cached
+
+    def __read(self, path: Path) -> CachedResponse:
+        """Reads a cached response and marks it as recently used"""
+        try:
+            with open(path, "rb") as file:
+                header = json.loads(file.readline())
+                content = file.read()
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        with self.__lock:
+            if self.__index and path in self.__index:
+                self.__index.move_to_end(path)
+        return CachedResponse(
+            status_code=header["status_code"],
+            headers=[tuple(x) for x in header["headers"]],
+            content=content,
+            stored_at=header["stored_at"],
+        )
+
+    def __write(self, path: Path, response: CachedResponse) -> None:
+        """Writes a cached response atomically and evicts the oldest if needed"""
+        path.parent.mkdir(parents=True, exist_ok=True)
+        descriptor, temporary = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+        with os.fdopen(descriptor, "wb") as file:
+            file.write(
+                json.dumps(
+                    {
+                        "status_code": response.status_code,
+                        "headers": response.headers,
+                        "stored_at": response.stored_at,
+                    }
+                ).encode()
+            )
+            file.write(b"\n")
+            file.write(response.content)
+        os.replace(temporary, path)
+        with self.__lock:
+            self.__load_index()
+            self.__size -= self.__index.pop(path, 0)
+            self.__index[path] = path.stat().st_size
+            self.__size += self.__index[path]
+            self.__evict()
+
+    def __load_index(self) -> None:
+        """
+        Lists the cached responses on the first write, \
+        from the least to the most recently used
+        """
+        if self.__index is not None:
+            return
+        stats = [
+            (x, x.stat())
+            for x in Path(self.settings.directory).glob("*/*/*")
+            if x.suffix != ".tmp"
+        ]
+        stats.sort(key=lambda x: x[1].st_mtime)
+        self.__index = OrderedDict((x, y.st_size) for x, y in stats)
+        self.__size += sum(self.__index.values())
+
+    def __evict(self) -> None:
+        """Removes the least recently used responses beyond the size limit"""
+        while self.__size > self.settings.max_size and self.__index:
+            path, size = self.__index.popitem(last=False)
+            path.unlink(missing_ok=True)
+            self.__size -= size
+            self.statistics.evictions += 1
+
+    def summary(self) -> str:
+        """Formats the use of the cache for reports"""
+        return f"{self.settings.mode.value} ({self.statistics.hits} hits, \
+{self.statistics.misses} misses, {self.statistics.hit_ratio:.0%} hit ratio, \
+{self.statistics.evictions} evictions, \
+{self.statistics.write_failures} failed writes)"
@@ -0,0 +1,340 @@
+"""
+Shapes the traffic of all lines towards the scraped hosts: \
+an adaptive token bucket keeps the aggregate request rate within a budget, \
+failed requests are retried with jittered exponential backoff \
+and a circuit breaker pauses a host that keeps failing
+"""
+from __future__ import annotations
+import asyncio
+import random
+import time
+from dataclasses import dataclass
+from typing import Awaitable, Callable, TypeVar
+import logging
+import httpx
+from telegram_task import line
+from tse_utils import tsetmc
+from .http_clients import HttpClientRegistry
+from .response_cache import CacheMissError
+
+R = TypeVar("R")
+
+TSETMC_HOST: str = "cdn.tsetmc.com"
+TSE_CLIENT_HOST: str = "service.tsetmc.com"
+
+RETRYABLE_EXCEPTIONS: tuple[type[Exception], ...] = (
+    httpx.RequestError,
+    tsetmc.TsetmcScrapeException,
+)
+
+
+@dataclass
+class TrafficPolicy:
+    """
+    Configuration of a TrafficController. The request rate starts at \
+    initial_rate and moves between min_rate and max_rate, the latter \
+    being the budget of all lines together. It grows by additive_increase \
+    requests per second for each second of healthy traffic, and is multiplied \
+    by multiplicative_decrease on a failure or a response slower than \
+    latency_target, at most once per decrease_interval seconds. \
+    Unless throttled, e.g. while requests are replayed \
+    from the response cache, the limiter lets them all through.
+    """
+
+    # pylint: disable=too-many-instance-attributes
+    # Each attribute is a knob of the limiter, the retries or the breaker
+    throttled: bool = True
+    initial_rate: float = 10.0
+    min_rate: float = 1.0
+    max_rate: float = 40.0
+    burst: int = 10
+    additive_increase: float = 1.0
+    multiplicative_decrease: float = 0.5
+    latency_target: float = 5.0
+    decrease_interval: float = 1.0
+    max_attempts: int = 3
+    backoff_base: float = 0.5
+    backoff_max: float = 30.0
+    breaker_threshold: int = 10
+    breaker_cooldown: float = 30.0
+    breaker_max_trips: int = 3
+    deferred_retries: int = 1
+
+    def backoff(self, attempt: int) -> float:
+        """Gets a full-jitter exponential backoff delay for a failed attempt"""
+        return random.uniform(
+            0, min(self.backoff_max, self.backoff_base * 2 ** (attempt - 1))
+        )
+
+
+class CircuitOpenError(httpx.TransportError):
+    """
+    Raised instead of sending a request to a host whose breaker \
+    keeps opening, so that the callers fail fast as on a transport error
+    """
+
+
+@dataclass
+class TrafficStatistics:
+    """Counters of the traffic shaped by a TrafficController"""
+
+    requests: int = 0
+    failures: int = 0
+    retries: int = 0
+    throttle_time: float = 0.0
+    breaker_trips: int = 0
+    breaker_wait_time: float = 0.0
+
+
+class AdaptiveRateLimiter:
+    """Token bucket whose refill rate adapts by AIMD to the traffic signals"""
+
+    def __init__(self, policy: TrafficPolicy):
+        self.policy: TrafficPolicy = policy
+        self.rate: float = policy.initial_rate
+        self.__tokens: float = float(policy.burst)
+        self.__refilled_at: float = time.monotonic()
+        self.__decreased_at: float = 0.0
+        self.__lock: asyncio.Lock = asyncio.Lock()
+
+    def __refill(self) -> None:
+        """Adds the tokens accumulated since the last refill"""
+        now = time.monotonic()
+        self.__tokens = min(
+            self.policy.burst, self.__tokens + (now - self.__refilled_at) * self.rate
+        )
+        self.__refilled_at = now
+
+    async def acquire(self) -> float:
+        """Waits for a token and returns the seconds waited"""
+        if not self.policy.throttled:
+            return 0.0
+        started = time.monotonic()
+        async with self.__lock:
+            self.__refill()
+            while self.__tokens < 1:
+                await asyncio.sleep((1 - self.__tokens) / self.rate)
+                self.__refill()
+            self.__tokens -= 1
+        return time.monotonic() - started
+
+    def on_success(self, latency: float) -> None:
+        """Increases the rate additively, unless the response was slow"""
+        if latency > self.policy.latency_target:
+            self.on_failure()
+            return
+        self.rate = min(
+            self.policy.max_rate, self.rate + self.policy.additive_increase / self.rate
+        )
+
+    def on_failure(self) -> None:
+        """Decreases the rate multiplicatively"""
+        now = time.monotonic()
+        if now - self.__decreased_at < self.policy.decrease_interval:
+            return
+        self.__decreased_at = now
+        self.rate = max(
+            self.policy.min_rate, self.rate * self.policy.multiplicative_decrease
+        )
+
+
+class CircuitBreaker:
+    """
+    Opens after breaker_threshold consecutive failures of a host, \
+    holding its requests back for breaker_cooldown seconds. \
+    Then it lets requests through again, and a single failure reopens it \
+    until a request succeeds. Once it has opened breaker_max_trips times \
+    without a success in between, requests fail fast while it is open.
+    """
+
+    def __init__(self, policy: TrafficPolicy):
+        self.policy: TrafficPolicy = policy
+        self.consecutive_failures: int = 0
+        self.trips: int = 0
+        self.open_until: float = 0.0
+        self.half_open: bool = False
+
+    @property
+    def is_open(self) -> bool:
+        """True while requests to the host are held back"""
+        return time.monotonic() < self.open_until
+
+    async def wait(self) -> float:
+        """
+        Waits while the breaker is open and returns the seconds waited. \
+        Raises CircuitOpenError instead if the host seems to be down.
+        """
+        started = time.monotonic()
+        while self.is_open:
+            if self.trips >= self.policy.breaker_max_trips:
+                raise CircuitOpenError("Circuit breaker of the host is open.")
+            await asyncio.sleep(self.open_until - time.monotonic())
+        return time.monotonic() - started
+
+    def on_success(self) -> None:
+        """Closes the breaker"""
+        self.consecutive_failures = 0
+        self.trips = 0
+        self.half_open = False
+
+    def on_failure(self) -> bool:
+        """Counts a failure and returns True if it opened the breaker"""
+        self.consecutive_failures += 1
+        if self.is_open or not (
+            self.half_open or self.consecutive_failures >= self.policy.breaker_threshold
+        ):
+            return False
+        self.open_until = time.monotonic() + self.policy.breaker_cooldown
+        self.trips += 1
+        self.half_open = True
+        return True
+
+
+class TrafficController:
+    """
+    Shared by all the lines, so that their aggregate traffic \
+    to every host stays within the policy's budget
+    """
+
+    def __init__(self, policy: TrafficPolicy = None):
+        self.policy: TrafficPolicy = policy if policy else TrafficPolicy()
+        self.__limiters: dict[str, AdaptiveRateLimiter] = {}
+        self.__breakers: dict[str, CircuitBreaker] = {}
+        self.__statistics: dict[str, TrafficStatistics] = {}
+
+    def limiter(self, host: str) -> AdaptiveRateLimiter:
+        """Gets the rate limiter of a host"""
+        if host not in self.__limiters:
+            self.__limiters[host] = AdaptiveRateLimiter(self.policy)
+        return self.__limiters[host]
+
+    def breaker(self, host: str) -> CircuitBreaker:
+        """Gets the circuit breaker of a host"""
+        if host not in self.__breakers:
+            self.__breakers[host] = CircuitBreaker(self.policy)
+        return self.__breakers[host]
+
+    def statistics(self, host: str) -> TrafficStatistics:
+        """Gets the traffic counters of a host"""
+        if host not in self.__statistics:
+            self.__statistics[host] = TrafficStatistics()
+        return self.__statistics[host]
+
+    async def request(self, host: str, send: Callable[[], Awaitable[R]]) -> R:
+        """
+        Sends a request to a host once the breaker and the limiter allow, \
+        retrying failures in RETRYABLE_EXCEPTIONS with backoff \
+        up to max_attempts times. \
+        The exception of the last attempt propagates.
+        """
+        limiter, breaker = self.limiter(host), self.breaker(host)
+        statistics = self.statistics(host)
+        attempt = 0
+        while True:
+            attempt += 1
+            statistics.breaker_wait_time += await breaker.wait()
+            statistics.throttle_time += await limiter.acquire()
+            statistics.requests += 1
+            started = time.monotonic()
+            try:
+                result = await send()
+            except RETRYABLE_EXCEPTIONS:
+                statistics.failures += 1
+                limiter.on_failure()
+                if breaker.on_failure():
+                    statistics.breaker_trips += 1
+                if attempt >= self.policy.max_attempts:
+                    raise
+                statistics.retries += 1
+                await asyncio.sleep(self.policy.backoff(attempt))
+                continue
+            limiter.on_success(time.monotonic() - started)
+            breaker.on_success()
+            return result
+
+    async def request_or_skip(
+        self, host: str, send: Callable[[], Awaitable[R]]
+    ) -> R | None:
+        """
+        Sends a request as request does, but returns None \
+        if its response is missing from the replayed response cache
+        """
+        try:
+            return await self.request(host, send)
+        except CacheMissError:
+            return None
+
+    def summary(self, host: str) -> str:
+        """Formats the state of a host's traffic for reports"""
+        statistics = self.statistics(host)
+        return f"{self.limiter(host).rate:.1f} req/s \
+({statistics.requests} requests, {statistics.retries} retries, \
+{statistics.breaker_trips} breaker trips, \
+{statistics.throttle_time:.1f}s throttled)"
+
+
+def traffic_report(
+    traffic_controller: TrafficController,
+    http_clients: HttpClientRegistry,
+    host: str,
+    title: str = "TSETMC",
+) -> list[str]:
+    """
+    Formats the traffic, the connections, the proxies, the response cache \
+    and archive, and the latency of every endpoint of a host
+    """
+    return [
+        f"{title} traffic ➡️ {traffic_controller.summary(host)}",
+        f"{title} connections ➡️ {http_clients.summary(host)}",
+        f"{title} proxies ➡️ {http_clients.proxies_summary(host)}",
+        f"Response cache ➡️ {http_clients.cache.summary()}",
+        f"Response archive ➡️ {http_clients.archive.summary()}",
+    ] + [
+        f"{name} latency ➡️ {x.summary()}"
+        for name, x in sorted(http_clients.latencies(host).items())
+    ]
+
+
+class TrafficControlled:
+    """
+    Mixin of the workers whose requests go through a TrafficController \
+    and the clients of an HttpClientRegistry
+    """
+
+    # pylint: disable=too-few-public-methods
+    # The mixin only holds what is shared with the other workers
+
+    def __init__(
+        self,
+        traffic_controller: TrafficController = None,
+        http_clients: HttpClientRegistry = None,
+    ):
+        self.traffic_controller: TrafficController = (
+            traffic_controller if traffic_controller else TrafficController()
+        )
+        self.http_clients: HttpClientRegistry = (
+            http_clients if http_clients else HttpClientRegistry()
+        )
+
+
+class TrafficControlledShift:
+    """
+    Base of the internal classes that perform a single task \
+    of a TrafficControlled worker, holding what they all share
+    """
+
+    # pylint: disable=too-few-public-methods
+    # The base only holds the state shared by the shifts
+
+    def __init__(
+        self,
+        job_description: line.JobDescription,
+        logger: logging.Logger,
+        traffic_controller: TrafficController,
+        http_clients: HttpClientRegistry,
+    ):
+        self._logger: logging.Logger = logger
+        self.job_description: line.JobDescription = job_description
+        self.traffic_controller: TrafficController = traffic_controller
+        self.http_clients: HttpClientRegistry = http_clients
+        self.report: line.JobReport = line.JobReport()